@@ -0,0 +1,132 @@
+"""
+Geometric properties of a structure, shared by all energy terms
+evaluated for this structure.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class GeometryCache(object):
+    """
+    Lazily computes and memoizes geometric properties of one structure.
+
+    CombinedEnergy.eval_energy creates one instance per evaluation and passes it
+    to all contributions as the `geometry` keyword argument.
+    It is only valid as long as the structure does not change.
+    """
+    def __init__(self, cg):
+        self.cg = cg
+        self._values = {}
+
+    def segment_distance_matrix(self, elems):
+        """
+        The shortest distances between the line segments of all pairs of elements.
+
+        :param elems: A sequence of element names
+        :returns: A tuple matrix, index. matrix[index[elem1], index[elem2]] is the distance.
+        """
+        elems = tuple(elems)
+        def calculate():
+            coords = self.cg.coords
+            starts = np.array([coords[elem][0] for elem in elems], dtype=float).reshape((-1, 3))
+            ends = np.array([coords[elem][1] for elem in elems], dtype=float).reshape((-1, 3))
+            matrix = segment_distances(starts, ends, starts, ends)
+            return matrix, { elem: i for i, elem in enumerate(elems) }
+        return self.get(("segment_distance_matrix", elems), calculate)
+
+    def get(self, key, function):
+        """
+        Return function(), which is only called the first time a key is requested.
+
+        :param key: A hashable key describing the value
+        :param function: A callable without arguments.
+        """
+        try:
+            return self._values[key]
+        except KeyError:
+            value = function()
+            self._values[key] = value
+            return value
+
+
+def segment_distances(starts1, ends1, starts2, ends2):
+    """
+    The shortest distances between all pairs of line segments.
+
+    :param starts1, ends1: Nx3 arrays. The first set of segments.
+    :param starts2, ends2: Mx3 arrays. The second set of segments.
+    :returns: A NxM array of distances
+    """
+    p1, p2 = closest_points(starts1[:,np.newaxis,:], ends1[:,np.newaxis,:],
+                            starts2[np.newaxis,:,:], ends2[np.newaxis,:,:])
+    direction = p2 - p1
+    return np.sqrt(np.sum(direction*direction, axis=-1))
+
+
+def closest_points(s1_p0, s1_p1, s2_p0, s2_p1):
+    """
+    A vectorized version of ftuv.line_segment_distance.
+
+    All arguments are arrays of shape (...,3), which are broadcast against each other.
+
+    :param s1_p0, s1_p1: Start and end points of the first segments
+    :param s2_p0, s2_p1: Start and end points of the second segments
+    :returns: A tuple of arrays (i1, i2) containing the points on the first
+              segments closest to the points i2 on the second segments.
+    """
+    SMALL_NUM = 0.000001
+    u = s1_p1 - s1_p0
+    v = s2_p1 - s2_p0
+    w = s1_p0 - s2_p0
+    a = np.sum(u*u, axis=-1)
+    b = np.sum(u*v, axis=-1)
+    c = np.sum(v*v, axis=-1)
+    d = np.sum(u*w, axis=-1)
+    e = np.sum(v*w, axis=-1)
+
+    D = a*c - b*b
+    # Closest points of the infinite lines, or of P0 of the first segment if they are parallel.
+    parallel = D < SMALL_NUM
+    sN = np.where(parallel, 0., b*e - c*d)
+    sD = np.where(parallel, 1., D)
+    tN = np.where(parallel, e, a*e - b*d)
+    tD = np.where(parallel, c, D)
+    # Clamp s to the first segment
+    s_low = ~parallel & (sN < 0.)
+    s_high = ~parallel & ~s_low & (sN > sD)
+    sN = np.where(s_low, 0., np.where(s_high, sD, sN))
+    tN = np.where(s_low, e, np.where(s_high, e + b, tN))
+    tD = np.where(s_low | s_high, c, tD)
+    # Clamp t to the second segment and recompute s for this edge
+    t_low = tN < 0.
+    t_high = ~t_low & (tN > tD)
+    edge_sN = np.where(t_low, -d, -d + b)
+    new_sN = np.where(edge_sN < 0., 0., np.where(edge_sN > a, sD, edge_sN))
+    new_sD = np.where((edge_sN < 0.) | (edge_sN > a), sD, a)
+    on_edge = t_low | t_high
+    sN = np.where(on_edge, new_sN, sN)
+    sD = np.where(on_edge, new_sD, sD)
+    tN = np.where(t_low, 0., np.where(t_high, tD, tN))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sc = np.where(np.abs(sN) < SMALL_NUM, 0., sN/sD)
+        tc = np.where(np.abs(tN) < SMALL_NUM, 0., tN/tD)
+    return s1_p0 + sc[...,np.newaxis]*u, s2_p0 + tc[...,np.newaxis]*v
+
+
+def geometry_for(cg, geometry=None):
+    """
+    :param geometry: A GeometryCache or None
+    :returns: geometry, if it belongs to cg, else a new GeometryCache
+    """
+    if geometry is None or geometry.cg is not cg:
+        return GeometryCache(cg)
+    return geometry
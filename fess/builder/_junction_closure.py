@@ -0,0 +1,555 @@
+"""
+Check many combinations of multiloop stats for junction closure at once.
+
+EnergeticJunctionMover tries up to thousands of stat combinations per move.
+Building the loop and evaluating the junction constraint energy for each
+of them is slow. JunctionClosure does the same calculation with numpy
+for a whole batch of combinations. If closing combinations are rare,
+a meet-in-the-middle search over the two halves of the loop finds
+all of them at once.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+import itertools as it
+
+import numpy as np
+
+import fess.builder.energy as fbe
+
+log = logging.getLogger(__name__)
+
+#: The prefilters only rule out combinations that exceed the cutoffs
+#: by more than this relative tolerance. The deviations are calculated in
+#: different coordinate systems than during building, so rounding must not
+#: drop a combination that EnergeticJunctionMover._check_junction accepts.
+#: It verifies every candidate.
+TOLERANCE = 1e-9
+
+
+class JunctionClosure(object):
+    """
+    Evaluates, which stat combinations for a multiloop fulfill its
+    junction constraint energy.
+
+    The stems along the loop are placed like SpatialModel._place_stem does and
+    the deviation at the broken ml-segment is calculated like
+    FragmentBasedJunctionClosureEnergy does (via cytvec.get_broken_ml_deviation).
+
+    Only valid as long as the spatial model does not change.
+    Use `for_loop` to create an instance.
+
+    Combinations are first checked batch by batch. Once more combinations
+    have been checked than a meet-in-the-middle search would enumerate,
+    all closing combinations are found at once with `closing_combinations`.
+    """
+    #: Do not use the meet-in-the-middle search if one half of the loop
+    #: has more stat combinations than this.
+    MAX_ENUMERATION_SIZE = 10**6
+    #: Do not use the meet-in-the-middle search if more pairs than this
+    #: have to be evaluated.
+    MAX_CANDIDATE_PAIRS = 2*10**7
+    def __init__(self, sm, elems, loop, whole_loop, choices, fjc, cutoff):
+        """
+        :param elems: The ml-segments for which stats are sampled.
+        :param loop, whole_loop: See EnergeticJunctionMover._check_junction.
+                                 The last element of both is the broken ml-segment.
+        :param choices: A list of lists of stats for each element of elems.
+        :param fjc: The FragmentBasedJunctionClosureEnergy of the broken ml-segment
+        :param cutoff: None, if fjc is the junction constraint energy,
+                       else the threshold of the MaxEnergyValue wrapping it.
+        """
+        self.fjc = fjc
+        self.cutoff = cutoff
+        columns = { elem: i for i, elem in enumerate(elems) }
+        params = [ np.array([_angle_params(stat) for stat in stats]) for stats in choices ]
+        self._params = params
+        def params_of(elem):
+            if elem in columns:
+                return columns[elem], params[columns[elem]]
+            return None, np.array([_angle_params(sm.elem_defs[elem])])
+        #: For the precheck: The (column, params) for all ml-segments of the loop
+        self._loop_params = [ params_of(elem) for elem in whole_loop ]
+        build_order = sm.bg.build_order or sm.bg.traverse_graph()
+        #: For every stem placed, a tuple (s1, (column, params), s2, s1b, s1e, reverse, stem_stat)
+        self._steps = []
+        for elem in loop[:-1]:
+            s1, l, s2 = [ step for step in build_order if step[1]==elem ][0]
+            connection_ends = sm.bg.connection_ends(sm.bg.connection_type(l, [s1, s2]))
+            if connection_ends[0] == 0:
+                s1b, s1e = 1, 0
+            else:
+                s1b, s1e = 0, 1
+            self._steps.append((s1, params_of(l), s2, s1b, s1e,
+                                connection_ends[1] == 1, sm.elem_defs[s2]))
+        self._static_stems = { stem: (np.array(sm.stems[stem].mids)[np.newaxis],
+                                      np.array(sm.stems[stem].twists)[np.newaxis])
+                               for stem in sm.bg.edges[loop[-1]] }
+        for s1, _, _, _, _, _, _ in self._steps:
+            if s1 not in self._static_stems:
+                self._static_stems[s1] = (np.array(sm.stems[s1].mids)[np.newaxis],
+                                          np.array(sm.stems[s1].twists)[np.newaxis])
+        self._broken = params_of(loop[-1])
+        fixed_stem, orig_stem = sorted(sm.bg.edges[loop[-1]], key=sm.bg.buildorder_of)
+        self._fixed_stem = fixed_stem, sm.bg.get_sides(fixed_stem, loop[-1])
+        self._orig_stem = orig_stem, sm.bg.get_sides(orig_stem, loop[-1])
+        #: The number of combinations checked batch by batch
+        self._checked = 0
+        #: The set of closing combinations, once closing_combinations was called
+        self._closing = None
+        self._enumeration_size = self._enumeration_size_or_none(len(elems))
+
+    @classmethod
+    def for_loop(cls, sm, elems, loop, whole_loop, choices):
+        """
+        :returns: A JunctionClosure or None, if the junction constraint energy
+                  of the loop cannot be evaluated in batches.
+        """
+        broken = loop[-1]
+        if broken not in sm.junction_constraint_energy:
+            return None
+        energy = _only_energy(sm.junction_constraint_energy[broken])
+        cutoff = None
+        if isinstance(energy, fbe.MaxEnergyValue):
+            cutoff = energy.adjustment
+            energy = _only_energy(energy._other_energy)
+        if (type(energy) is not fbe.FragmentBasedJunctionClosureEnergy
+                or energy.element != broken):
+            log.debug("Junction energy for %s cannot be evaluated in batches.", broken)
+            return None
+        if broken not in elems and broken not in sm.elem_defs:
+            # The energy would search for the best fitting stat.
+            return None
+        return cls(sm, elems, loop, whole_loop, choices, energy, cutoff)
+
+    def closes(self, indices):
+        """
+        :param indices: An integer array with one row per combination,
+                        as returned by StatCombinations.draw
+        :returns: A boolean array, True for the combinations for which
+                  EnergeticJunctionMover._check_junction would return True
+                  (up to TOLERANCE).
+        """
+        if self._closing is None and self._enumeration_size is not None:
+            if self._checked >= self._enumeration_size:
+                self._closing = self.closing_combinations()
+                if self._closing is None:
+                    self._enumeration_size = None
+        if self._closing is not None:
+            return np.array([ tuple(row) in self._closing for row in indices.tolist() ], dtype=bool)
+        self._checked += len(indices)
+        params = lambda p: p[1] if p[0] is None else p[1][indices[:, p[0]]]
+        stems = dict(self._static_stems)
+        for s1, angle, s2, s1b, s1e, reverse, stem_stat in self._steps:
+            stems[s2] = _place_stems(stems[s1][0], stems[s1][1], s1b, s1e,
+                                     params(angle), stem_stat, reverse)
+        virtual = _virtual_stem(stems[self._fixed_stem[0]], self._fixed_stem[1], params(self._broken))
+        orig = _orig_stem(stems[self._orig_stem[0]], self._orig_stem[1])
+        may_close = self._may_close(_deviation(virtual, orig))
+        lengths = [ np.broadcast_to(params(p)[:,3], (len(indices),)) for p in self._loop_params ]
+        return self._precheck(lengths) & may_close
+
+    def closing_combinations(self):
+        """
+        Find all combinations which close the loop with a meet-in-the-middle search.
+
+        The loop is split at a pivot stem on the path to the stem at the
+        broken ml-segment, which was not placed from the fixed stem. The
+        virtual stem (placed from the fixed stem with the stat of the broken
+        segment) is enumerated for all stats of the first half, the real stem
+        for all stats of the second half, both in the coordinate system of the
+        pivot stem. Pairs of nearby positions are found with a spatial hash
+        and only these pairs are evaluated. The deviation does not change if both
+        stems are moved together, so this gives the same result as `closes`.
+
+        :returns: A set of tuples of indices (like the rows returned
+                  by StatCombinations.draw) or None, if too many pairs
+                  of positions are close enough.
+        """
+        fixed_root, fixed_steps = self._chain(self._fixed_stem[0])
+        orig_root, orig_steps = self._chain(self._orig_stem[0])
+        pivot = self._pivot(fixed_steps, orig_steps)
+        # The first half: All positions of the virtual stem and the pivot stem.
+        fixed_rows, fixed_columns, fixed_stem = self._enumerate(fixed_steps, self._static_stems[fixed_root])
+        broken_column, broken_stats = self._broken
+        if broken_column is not None:
+            fixed_rows, fixed_stem, broken_stats = _cross((fixed_rows, fixed_stem),
+                                                          (np.arange(len(broken_stats))[:,np.newaxis],
+                                                           broken_stats))
+            fixed_columns = fixed_columns + [broken_column]
+        virtual = _virtual_stem(fixed_stem, self._fixed_stem[1], broken_stats)
+        pivot_rows, pivot_columns, pivot_stem = self._enumerate(orig_steps[:pivot], self._static_stems[orig_root])
+        rows1, virtual, pivot_stem = _cross((fixed_rows, virtual), (pivot_rows, pivot_stem))
+        columns1 = fixed_columns + pivot_columns
+        virtual = _in_frame(pivot_stem, virtual)
+        # The second half: All positions of the real stem, placed from one of the pivot stems.
+        reference = tuple(a[:1] for a in pivot_stem)
+        rows2, columns2, orig_stem = self._enumerate(orig_steps[pivot:], reference)
+        orig = _in_frame(reference, _orig_stem(orig_stem, self._orig_stem[1]))
+
+        # The position deviation alone must not exceed the maximal deviation.
+        spatial_hash = _SpatialHash(orig[0], self._max_deviation())
+        counts = spatial_hash.counts(virtual[0])
+        if np.sum(counts) > self.MAX_CANDIDATE_PAIRS:
+            log.info("Not using the meet-in-the-middle search: %d candidate pairs", np.sum(counts))
+            return None
+        closing = set()
+        # Chunks with up to MAX_ENUMERATION_SIZE candidate pairs
+        bounds = np.searchsorted(np.cumsum(counts),
+                                 np.arange(self.MAX_ENUMERATION_SIZE, np.sum(counts),
+                                           self.MAX_ENUMERATION_SIZE))
+        for chunk in np.split(np.arange(len(counts)), np.unique(bounds)):
+            i1, i2 = spatial_hash.pairs(virtual[0][chunk])
+            i1 = chunk[i1]
+            deviation = _deviation(tuple(a[i1] for a in virtual), tuple(a[i2] for a in orig))
+            rows = np.empty((len(i1), len(columns1)+len(columns2)), dtype=int)
+            rows[:, columns1] = rows1[i1]
+            rows[:, columns2] = rows2[i2]
+            lengths = [ p[1][:,3] if p[0] is None else p[1][rows[:,p[0]],3]
+                        for p in self._loop_params ]
+            closes = self._precheck(lengths) & self._may_close(deviation)
+            closing.update(map(tuple, rows[closes].tolist()))
+        log.info("Meet-in-the-middle search found %d closing combinations "
+                 "from %d and %d partial combinations", len(closing), len(rows1), len(rows2))
+        return closing
+
+    def _chain(self, stem):
+        """
+        The steps needed to place stem, starting at a static stem, in build order.
+
+        :returns: A tuple (static stem, steps)
+        """
+        placed_by = { step[2]: step for step in self._steps }
+        steps = []
+        while stem in placed_by:
+            steps.append(placed_by[stem])
+            stem = placed_by[stem][0]
+        return stem, steps[::-1]
+
+    def _enumerate(self, steps, start):
+        """
+        Place stems along steps for all combinations of stats.
+
+        :param steps: Steps as returned by `_chain` (or a part of them).
+        :param start: The mids and twists of the stem the steps start from.
+        :returns: A tuple rows, columns, (mids, twists) for the last stem.
+                  rows[i, j] is the index of the stat for the column columns[j],
+                  used for the mids[i] and twists[i].
+        """
+        rows = np.zeros((1, 0), dtype=int)
+        columns = []
+        placed = start
+        for s1, (column, params), s2, s1b, s1e, reverse, stem_stat in steps:
+            if column is not None:
+                rows, placed, params = _cross((rows, placed), (np.arange(len(params))[:,np.newaxis], params))
+                columns.append(column)
+            placed = _place_stems(placed[0], placed[1], s1b, s1e, params, stem_stat, reverse)
+        return rows, columns, placed
+
+    def _sizes(self, steps):
+        """
+        The number of stat combinations after every step.
+        """
+        sizes = [1]
+        for step in steps:
+            column = step[1][0]
+            sizes.append(sizes[-1]*(1 if column is None else len(self._params[column])))
+        return sizes
+
+    def _pivot(self, fixed_steps, orig_steps):
+        """
+        The number of steps towards the real stem at the broken ml-segment
+        which belong to the first half of the search.
+        """
+        fixed_size = self._sizes(fixed_steps)[-1]
+        if self._broken[0] is not None:
+            fixed_size *= len(self._broken[1])
+        sizes = self._sizes(orig_steps)
+        return min(range(len(orig_steps)+1),
+                   key=lambda i: fixed_size*sizes[i] + sizes[-1]//sizes[i])
+
+    def _enumeration_size_or_none(self, num_columns):
+        """
+        The number of partial combinations enumerated by closing_combinations,
+        or None if it cannot be used.
+        """
+        if self.cutoff is None or self.fjc.prefactor<=0 or self.fjc.adjustment<=0:
+            return None
+        _, fixed_steps = self._chain(self._fixed_stem[0])
+        _, orig_steps = self._chain(self._orig_stem[0])
+        columns = [ step[1][0] for step in fixed_steps+orig_steps if step[1][0] is not None ]
+        if self._broken[0] is not None:
+            columns.append(self._broken[0])
+        if sorted(columns) != list(range(num_columns)):
+            return None
+        fixed_size = self._sizes(fixed_steps)[-1]
+        if self._broken[0] is not None:
+            fixed_size *= len(self._broken[1])
+        sizes = self._sizes(orig_steps)
+        pivot = self._pivot(fixed_steps, orig_steps)
+        size1, size2 = fixed_size*sizes[pivot], sizes[-1]//sizes[pivot]
+        if max(size1, size2) > self.MAX_ENUMERATION_SIZE:
+            return None
+        return size1 + size2
+
+    def _precheck(self, lengths):
+        """
+        The precheck of FragmentBasedJunctionClosureEnergy (and MaxEnergyValue),
+        which rules out loops with one segment longer than all others together.
+
+        :param lengths: The r1 values of all segments of the loop.
+        """
+        lengths = np.column_stack(np.broadcast_arrays(*lengths))
+        diff = 2*np.max(lengths, axis=1)-np.sum(lengths, axis=1)
+        diff = np.where(diff>0, diff, 0)
+        tolerance = TOLERANCE*np.sum(np.abs(lengths), axis=1)
+        if self.cutoff is None:
+            return diff<=tolerance
+        return diff<self.cutoff+tolerance
+
+    def _max_deviation(self):
+        """
+        The largest deviation with an energy of 0, padded by TOLERANCE.
+        """
+        if self.cutoff is None:
+            max_deviation = 0.
+        else:
+            max_deviation = (self.cutoff/self.fjc.prefactor)**(1/self.fjc.adjustment)
+        return max_deviation + TOLERANCE*max(max_deviation, 1.)
+
+    def _may_close(self, deviation):
+        """
+        True for the deviations, for which the junction energy may be 0.
+        """
+        if self.fjc.prefactor<=0 or self.fjc.adjustment<=0:
+            energy = (deviation**self.fjc.adjustment)*self.fjc.prefactor
+            if self.cutoff is not None:
+                return energy<self.cutoff
+            return energy==0
+        return deviation<self._max_deviation()
+
+
+def _only_energy(energy):
+    """
+    Unwrap CombinedEnergies with a single contribution.
+    """
+    while isinstance(energy, fbe.CombinedEnergy) and len(energy.energies)==1:
+        energy = energy.energies[0]
+    return energy
+
+def _angle_params(stat):
+    return [stat.u, stat.v, stat.t, stat.r1, stat.u1, stat.v1]
+
+def _place_stems(prev_mids, prev_twists, s1b, s1e, angle_params, stem_stat, reverse):
+    """
+    The vectorized fess.builder.models.place_new_stem (and SpatialModel._place_stem)
+
+    :param prev_mids, prev_twists: Arrays of shape (N,2,3)
+    :param angle_params: An array of shape (N, 6) with the columns u, v, t, r1, u1, v1
+    :param stem_stat: The StemStat of the new stem.
+    :param reverse: Whether the new stem was added at its 1-end.
+    :returns: The mids and twists of the new stems
+    """
+    u, v, t, r1, u1, v1 = angle_params.T
+    basis = _orthonormal_bases(prev_mids[:,s1e]-prev_mids[:,s1b], prev_twists[:,s1e])
+    start_location = _apply_transposed(basis, _spherical_polar_to_cartesian(r1, u1, v1))
+    stem_orientation = _apply_transposed(basis, _spherical_polar_to_cartesian(stem_stat.phys_length, u, v))
+    twist1 = _apply_transposed(basis, _twist_in_stem_basis(u, v, t))
+    mid1 = prev_mids[:,s1e] + start_location
+    mid2 = mid1 + stem_orientation
+    angle = stem_stat.twist_angle
+    twist2 = _apply_transposed(_orthonormal_bases(stem_orientation, twist1),
+                               np.array([0., np.cos(angle), np.sin(angle)]))
+    mids, twists = np.stack((mid1, mid2), axis=1), np.stack((twist1, twist2), axis=1)
+    if reverse:
+        return mids[:,::-1], twists[:,::-1]
+    return mids, twists
+
+def _virtual_stem(fixed_stem, sides, virtual_stat):
+    """
+    The start, direction and twist of the virtual stem placed from the fixed stem
+    (like cytvec.get_broken_ml_deviation)
+
+    :param fixed_stem: A tuple mids, twists
+    :param sides: cg.get_sides(fixed_stem, broken_ml)
+    :param virtual_stat: An array of shape (N, 6) with the columns u, v, t, r1, u1, v1
+    """
+    fixed_mids, fixed_twists = fixed_stem
+    fixed_vec = fixed_mids[:,1]-fixed_mids[:,0]
+    if sides[0]==0:
+        fixed_vec = -fixed_vec
+    basis = _orthonormal_bases(fixed_vec, fixed_twists[:,sides[0]])
+    u, v, t, r1, u1, v1 = virtual_stat.T
+    vbulge_vec = _apply_transposed(basis, _spherical_polar_to_cartesian(r1, u1, v1))
+    vstem_vec = _apply_transposed(basis, _spherical_polar_to_cartesian(1., u, v))*5
+    vstem_twist = _apply_transposed(basis, _twist_in_stem_basis(u, v, t))
+    return _broadcast(fixed_mids[:,sides[0]] + vbulge_vec, vstem_vec, vstem_twist)
+
+def _orig_stem(orig_stem, sides):
+    """
+    The start, direction and twist of the real stem at the broken ml-segment.
+    """
+    orig_mids, orig_twists = orig_stem
+    return (orig_mids[:,sides[0]], orig_mids[:,sides[1]]-orig_mids[:,sides[0]],
+            orig_twists[:,sides[0]])
+
+def _deviation(virtual, orig):
+    """
+    The vectorized FragmentBasedJunctionClosureEnergy._stat_deviation
+    """
+    pos_dev = np.sqrt(np.sum((orig[0]-virtual[0])**2, axis=-1))
+    ang_dev = _vec_angles(virtual[1], orig[1])
+    twist_dev = _vec_angles(orig[2], virtual[2])
+    return np.maximum(pos_dev, np.maximum(np.degrees(ang_dev)/4, np.degrees(twist_dev)/4))
+
+def _broadcast(*arrays):
+    return tuple(np.array(a) for a in np.broadcast_arrays(*arrays))
+
+def _cross(first, second):
+    """
+    All combinations of the rows of two groups of arrays.
+
+    :param first, second: Tuples (rows, arrays). rows is an integer array with one row
+                          per combination, arrays is an array or a tuple of arrays
+                          with one entry per combination (or a single one for all).
+    :returns: The combined rows, followed by the arrays of both groups
+    """
+    n1, n2 = len(first[0]), len(second[0])
+    rows = np.column_stack((np.repeat(first[0], n2, axis=0), np.tile(second[0], (n1, 1))))
+    def expand(arrays, repeat):
+        if isinstance(arrays, tuple):
+            return tuple(expand(a, repeat) for a in arrays)
+        arrays = np.broadcast_to(arrays, (n1 if repeat else n2,)+arrays.shape[1:])
+        if repeat:
+            return np.repeat(arrays, n2, axis=0)
+        return np.tile(arrays, (n1,)+(1,)*(arrays.ndim-1))
+    return rows, expand(first[1], True), expand(second[1], False)
+
+def _in_frame(stem, coords):
+    """
+    Express a position and two directions in the coordinate system of a stem.
+
+    :param stem: A tuple mids, twists
+    :param coords: A tuple of a position and two directions
+    """
+    mids, twists = stem
+    stem_vec = mids[:,1]-mids[:,0]
+    # Gram-Schmidt, because the twist is only perpendicular up to rounding errors
+    twist = twists[:,0]-stem_vec*(np.sum(twists[:,0]*stem_vec, axis=-1)
+                                  /np.sum(stem_vec*stem_vec, axis=-1))[...,np.newaxis]
+    basis = _orthonormal_bases(stem_vec, twist)
+    to_frame = lambda vecs: np.einsum("...ij,...j->...i", basis, vecs)
+    position, direction1, direction2 = coords
+    return to_frame(position-mids[:,0]), to_frame(direction1), to_frame(direction2)
+
+class _SpatialHash(object):
+    """
+    Finds the points closer than a distance to query points by sorting
+    all points into cubic cells with the distance as edge length.
+    """
+    #: The offsets of all neighboring cells (including the cell itself)
+    OFFSETS = np.array(list(it.product([-1, 0, 1], repeat=3)))
+
+    def __init__(self, points, distance):
+        """
+        :param points: An array of shape (N,3)
+        """
+        self.points = points
+        self.distance = distance
+        cells = self._cells(points)
+        self._low = cells.min(axis=0)
+        self._high = cells.max(axis=0)
+        keys = self._keys(cells)
+        self._order = np.argsort(keys, kind="mergesort")
+        self._keys_sorted = keys[self._order]
+
+    def _cells(self, points):
+        return np.floor(points/self.distance).astype(np.int64)
+
+    def _keys(self, cells):
+        span = self._high-self._low+1
+        cells = cells-self._low
+        return (cells[:,0]*span[1]+cells[:,1])*span[2]+cells[:,2]
+
+    def _ranges(self, query):
+        """
+        For every neighboring cell of every query point the range of
+        points (in sorted order) in this cell.
+        """
+        cells = self._cells(query)
+        for offset in self.OFFSETS:
+            neighbors = cells+offset
+            inside = np.all((neighbors>=self._low) & (neighbors<=self._high), axis=1)
+            keys = self._keys(np.where(inside[:,np.newaxis], neighbors, self._low))
+            lo = np.searchsorted(self._keys_sorted, keys, side="left")
+            counts = np.where(inside, np.searchsorted(self._keys_sorted, keys, side="right")-lo, 0)
+            yield lo, counts
+
+    def counts(self, query):
+        """
+        :returns: For every query point the number of points in neighboring cells,
+                  an upper bound for the number of points closer than the distance.
+        """
+        return sum(counts for _, counts in self._ranges(query))
+
+    def pairs(self, query):
+        """
+        :param query: An array of shape (M,3)
+        :returns: Two index arrays i1, i2 with all pairs query[i1], points[i2]
+                  closer than the distance.
+        """
+        all_i1 = []
+        all_i2 = []
+        for lo, counts in self._ranges(query):
+            i1 = np.repeat(np.arange(len(query)), counts)
+            # For each pair, its position in the range of points in the cell
+            within = np.arange(len(i1)) - np.repeat(np.cumsum(counts)-counts, counts)
+            i2 = self._order[np.repeat(lo, counts)+within]
+            close = np.sum((query[i1]-self.points[i2])**2, axis=-1) < self.distance**2
+            all_i1.append(i1[close])
+            all_i2.append(i2[close])
+        return np.concatenate(all_i1), np.concatenate(all_i2)
+
+def _orthonormal_bases(vecs1, vecs2):
+    """
+    Row-wise ftuv.create_orthonormal_basis. The basis vectors are the rows.
+    """
+    vecs1 = vecs1/np.sqrt(np.sum(vecs1*vecs1, axis=-1))[...,np.newaxis]
+    vecs2 = vecs2/np.sqrt(np.sum(vecs2*vecs2, axis=-1))[...,np.newaxis]
+    return np.stack((vecs1, vecs2, np.cross(vecs1, vecs2)), axis=-2)
+
+def _apply_transposed(bases, vecs):
+    """
+    np.dot(basis.T, vec) for all pairs of bases and vectors.
+    """
+    return np.einsum("...ji,...j->...i", bases, vecs)
+
+def _spherical_polar_to_cartesian(r, u, v):
+    return np.stack(np.broadcast_arrays(r*np.sin(u)*np.cos(v),
+                                        r*np.sin(u)*np.sin(v),
+                                        r*np.cos(u)), axis=-1)
+
+def _twist_in_stem_basis(u, v, t):
+    """
+    The twist vector calculated by ftug.twist2_orient_from_stem1_1,
+    before the basis of the first stem is applied.
+    """
+    # rot_mat.T dot (0, cos(t), sin(t)) with
+    # rot_mat = rotation_matrix("y", u-pi/2) dot rotation_matrix("z", v)
+    sa, ca = np.sin(u-np.pi/2), np.cos(u-np.pi/2)
+    sv, cv = np.sin(v), np.cos(v)
+    st, ct = np.sin(t), np.cos(t)
+    return np.stack((cv*sa*st - sv*ct,
+                     sv*sa*st + cv*ct,
+                     ca*st), axis=-1)
+
+def _vec_angles(vecs1, vecs2):
+    """
+    Row-wise ftuv.vec_angle
+    """
+    vecs1 = vecs1/np.sqrt(np.sum(vecs1*vecs1, axis=-1))[...,np.newaxis]
+    vecs2 = vecs2/np.sqrt(np.sum(vecs2*vecs2, axis=-1))[...,np.newaxis]
+    return np.arccos(np.clip(np.sum(vecs1*vecs2, axis=-1), -1., 1.))
@@ -0,0 +1,275 @@
+"""
+One-dimensional gaussian kernel density estimates, which can be evaluated
+in constant time.
+
+A BinnedKDE can be updated in constant time per value.
+The values are accumulated on a regular grid (linear binning).
+The density is obtained by convolving the grid with a gaussian kernel,
+so neither updating nor evaluating it depends on the number of values.
+
+A TabulatedKDE tabulates an existing scipy.stats.gaussian_kde.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+import math
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class GridDensity(object):
+    """
+    A probability density tabulated on a regular grid.
+
+    Can be called like scipy.stats.gaussian_kde
+    """
+    def __init__(self, origin, delta, densities, weights, weights_origin, bandwidth):
+        """
+        :param origin: The position of densities[0]
+        :param delta: The distance between two grid points
+        :param densities: The tabulated density values
+        :param weights: The normalized, binned values. Used for points outside the grid.
+        :param weights_origin: The position of weights[0]
+        :param bandwidth: The standard deviation of the gaussian kernel
+        """
+        self._grid = origin + np.arange(len(densities))*delta
+        self._densities = densities
+        self._weight_positions = weights_origin + np.arange(len(weights))*delta
+        self._weights = weights
+        self.bandwidth = bandwidth
+        #: Below this value, the error caused by truncating the kernel is too large.
+        self._min_density = 10**4 * math.exp(-0.5*BinnedKDE.KERNEL_CUTOFF**2)/(math.sqrt(2*math.pi)*bandwidth)
+
+    def __call__(self, x):
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        out = np.interp(x, self._grid, self._densities, left=0., right=0.)
+        outside = out < self._min_density
+        if np.any(outside):
+            # Here the truncation of the kernel matters. Sum the kernels of all grid points.
+            diff = (x[outside][:,np.newaxis] - self._weight_positions)/self.bandwidth
+            out[outside] = np.dot(np.exp(-0.5*diff**2), self._weights)/(math.sqrt(2*math.pi)*self.bandwidth)
+        return out
+
+
+class TabulatedKDE(object):
+    """
+    A one-dimensional scipy.stats.gaussian_kde, tabulated on a regular grid.
+
+    The logarithm of the density is interpolated linearly between grid points.
+    Outside of the grid, the original KDE is evaluated.
+    Can be called like scipy.stats.gaussian_kde
+    """
+    #: The grid extends this many bandwidths beyond the smallest and largest value.
+    GRID_CUTOFF = 8
+    #: The grid is refined, starting with this number of intervals.
+    INITIAL_INTERVALS = 64
+    #: If the tolerance is not reached with this many intervals, the KDE is not tabulated.
+    MAX_INTERVALS = 2**16
+
+    def __init__(self, kde, grid, log_densities, scale=1.):
+        """
+        Use TabulatedKDE.tabulate to create instances.
+
+        :param kde: The 1D scipy.stats.gaussian_kde
+        :param grid: The regular grid in units of the kde
+        :param log_densities: The logarithm of the kde at the grid points
+        :param scale: The distribution is the kde scaled by this factor
+        """
+        self.kde = kde
+        self._grid = grid
+        self._log_densities = log_densities
+        self.scale = scale
+
+    @classmethod
+    def tabulate(cls, kde, tolerance):
+        """
+        :param kde: A scipy.stats.gaussian_kde
+        :param tolerance: The maximal absolute error of the logarithm of the density
+                          (i.e. the relative error of the density) between two grid points.
+        :returns: A TabulatedKDE or kde, if it cannot be tabulated with this tolerance.
+        """
+        if kde.d != 1:
+            return kde
+        bandwidth = math.sqrt(kde.covariance[0,0])
+        start = np.min(kde.dataset) - cls.GRID_CUTOFF*bandwidth
+        stop = np.max(kde.dataset) + cls.GRID_CUTOFF*bandwidth
+        n = cls.INITIAL_INTERVALS
+        grid = np.linspace(start, stop, n+1)
+        with np.errstate(divide="ignore"):
+            log_densities = np.log(kde(grid))
+            while n <= cls.MAX_INTERVALS:
+                # Compare the interpolation at the midpoints to the exact values.
+                mid = (grid[:-1] + grid[1:])/2
+                exact = np.log(kde(mid))
+                error = np.max(np.abs(exact - (log_densities[:-1] + log_densities[1:])/2))
+                # The midpoints are part of the refined grid.
+                refined = np.empty(2*n+1)
+                refined[::2] = log_densities
+                refined[1::2] = exact
+                grid = np.linspace(start, stop, 2*n+1)
+                log_densities = refined
+                n *= 2
+                if error <= tolerance:
+                    log.debug("Tabulated KDE of %d values on %d grid points", kde.n, len(grid))
+                    return cls(kde, grid, log_densities)
+        log.warning("Could not tabulate KDE of %d values with a tolerance of %s. "
+                    "Using the exact KDE.", kde.n, tolerance)
+        return kde
+
+    def scaled(self, factor):
+        """
+        The distribution of factor*x, if x is distributed according to this distribution.
+
+        :param factor: A positive number
+        :returns: A new TabulatedKDE sharing the kde with this one.
+        """
+        return type(self)(self.kde, self._grid*factor, self._log_densities - math.log(factor),
+                          self.scale*factor)
+
+    def __call__(self, x):
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        out = np.exp(np.interp(x, self._grid, self._log_densities))
+        outside = (x < self._grid[0]) | (x > self._grid[-1])
+        if np.any(outside):
+            out[outside] = self.kde(x[outside]/self.scale)/self.scale
+        return out
+
+
+class BinnedKDE(object):
+    """
+    A gaussian kernel density estimate of a growing set of values.
+
+    Like scipy.stats.gaussian_kde, the bandwidth is chosen with Scott's rule.
+    """
+    #: The initial grid spacing is the bandwidth divided by this number.
+    POINTS_PER_BANDWIDTH = 10
+    #: The gaussian kernel is truncated after this many bandwidths.
+    KERNEL_CUTOFF = 8
+    #: If the grid would need more points, the spacing is doubled.
+    MAX_POINTS = 2**14
+    #: The grid is set up, once that many values were added or the density is needed.
+    #: The grid spacing depends on the bandwidth at that time.
+    INITIAL_VALUES = 1000
+
+    def __init__(self, values=()):
+        #: The position of self._counts[0]
+        self._origin = None
+        #: The distance between grid points or None, if the grid was not yet set up.
+        self._delta = None
+        self._counts = np.zeros(0)
+        #: Values added before the grid could be set up
+        self._pending = []
+        # Running mean and variance (Welford's algorithm)
+        self._n = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self.add_values(values)
+
+    def __len__(self):
+        return self._n
+
+    def add_values(self, values):
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        value = float(value)
+        if not np.isfinite(value):
+            log.warning("Ignoring value %s for the kernel density estimate", value)
+            return
+        self._n += 1
+        diff = value - self._mean
+        self._mean += diff/self._n
+        self._m2 += diff*(value - self._mean)
+        if self._delta is None:
+            self._pending.append(value)
+            if len(self._pending) >= self.INITIAL_VALUES:
+                self._setup_grid()
+        else:
+            self._add_to_grid(value)
+
+    def density(self):
+        """
+        :returns: A GridDensity or None, if less than 2 different values were added.
+        """
+        bandwidth = self._bandwidth()
+        if bandwidth is None:
+            return None
+        if self._delta is None:
+            self._setup_grid()
+        delta = self._delta
+        k = int(math.ceil(self.KERNEL_CUTOFF*bandwidth/delta))
+        offsets = np.arange(-k, k+1)*delta
+        kernel = np.exp(-0.5*(offsets/bandwidth)**2)/(math.sqrt(2*math.pi)*bandwidth*self._n)
+        densities = np.convolve(self._counts, kernel)
+        return GridDensity(self._origin - k*delta, delta, densities,
+                           self._counts/self._n, self._origin, bandwidth)
+
+    def _bandwidth(self):
+        if self._n < 2:
+            return None
+        variance = self._m2/(self._n - 1)
+        if not variance > 0:
+            return None
+        return math.sqrt(variance)*self._n**(-1./5)
+
+    def _setup_grid(self):
+        bandwidth = self._bandwidth()
+        if bandwidth is None:
+            return
+        self._delta = bandwidth/self.POINTS_PER_BANDWIDTH
+        self._origin = min(self._pending)
+        self._counts = np.zeros(2)
+        pending = self._pending
+        self._pending = []
+        for value in pending:
+            self._add_to_grid(value)
+
+    def _add_to_grid(self, value):
+        while True:
+            pos = (value - self._origin)/self._delta
+            i = int(math.floor(pos))
+            if 0 <= i and i + 1 < len(self._counts):
+                break
+            self._extend_grid(i)
+        frac = pos - i
+        self._counts[i] += 1 - frac
+        self._counts[i+1] += frac
+
+    def _extend_grid(self, i):
+        """
+        Make the grid large enough to contain the grid points i and i+1,
+        or coarsen it, if it would get too large.
+        """
+        size = len(self._counts)
+        before = max(0, -i)
+        after = max(0, i + 2 - size)
+        # Leave some room, so the grid does not have to grow with every value.
+        if before:
+            before += size//2
+        if after:
+            after += size//2
+        if size + before + after > self.MAX_POINTS:
+            self._coarsen_grid()
+            return
+        self._counts = np.concatenate([np.zeros(before), self._counts, np.zeros(after)])
+        self._origin -= before*self._delta
+
+    def _coarsen_grid(self):
+        """
+        Double the grid spacing, keeping the origin.
+        """
+        counts = self._counts
+        if len(counts) % 2 == 0:
+            counts = np.append(counts, 0.)
+        coarse = counts[::2].copy()
+        coarse[:-1] += 0.5*counts[1::2]
+        coarse[1:] += 0.5*counts[1::2]
+        self._counts = coarse
+        self._delta *= 2
+        log.info("Coarsened grid of the kernel density estimate to spacing %s", self._delta)
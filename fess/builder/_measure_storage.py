@@ -0,0 +1,225 @@
+"""
+A compact storage for the measures accepted during sampling.
+
+Rejected sampling steps repeat the last accepted measure, so the values
+are stored run-length encoded in typed numpy arrays.
+Optionally, older runs are written to a file, which is read back
+via a memory map, so only a bounded number of runs is kept in memory.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class MeasureStorage(object):
+    """
+    A list-like, append-only container of measures.
+
+    All measures have to be scalars or arrays of the same shape.
+    Indexing with an integer returns a float or an array,
+    indexing with a slice returns a list.
+    """
+    #: The initial number of runs, memory is allocated for.
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, values=(), spill_file=None, max_runs=2**16):
+        """
+        :param values: An iterable of initial measures.
+        :param spill_file: None or a filename. If given, at most max_runs runs
+                           are kept in memory and older runs are moved to this file.
+                           An existing file will be overwritten.
+        :param max_runs: Only used together with spill_file.
+        """
+        #: The shape of a single measure, or None before the first measure was added.
+        self._shape = None
+        #: The values of the runs in memory
+        self._values = None
+        #: For every run in memory, the number of measures in memory up to
+        #: and including this run.
+        self._ends = np.zeros(0, dtype=int)
+        #: The number of runs in memory
+        self._n_runs = 0
+        #: The number of runs and measures in the spill file.
+        self._spilled_runs = 0
+        self._spilled = 0
+        self._spill_file = None
+        self._spill_map = None
+        self.max_runs = max_runs
+        if spill_file is not None:
+            self.spill_to(spill_file)
+        for value in values:
+            self.append(value)
+
+    def spill_to(self, filename, max_runs=None):
+        """
+        From now on, move older runs to the given file.
+
+        :param filename: The spill file. An existing file will be overwritten.
+        :param max_runs: The maximal number of runs kept in memory.
+        """
+        if self._spill_file is not None:
+            raise ValueError("Measures are already spilled to {}".format(self._spill_file))
+        if max_runs is not None:
+            self.max_runs = max_runs
+        if self.max_runs < 2:
+            raise ValueError("At least 2 runs have to be kept in memory.")
+        # Create or truncate the file
+        with open(filename, "wb"):
+            pass
+        self._spill_file = filename
+        if self._n_runs > self.max_runs:
+            self._spill(self._n_runs - self.max_runs//2)
+
+    def __len__(self):
+        return self._spilled + self._n_in_memory
+
+    def __bool__(self):
+        return len(self) > 0
+
+    __nonzero__ = __bool__
+
+    @property
+    def _n_in_memory(self):
+        if self._n_runs == 0:
+            return 0
+        return int(self._ends[self._n_runs-1])
+
+    def append(self, value):
+        value = np.asarray(value, dtype=float)
+        if self._shape is None:
+            self._shape = value.shape
+            self._values = np.empty((self.INITIAL_CAPACITY,)+self._shape)
+            self._ends = np.zeros(self.INITIAL_CAPACITY, dtype=int)
+        elif value.shape != self._shape:
+            raise ValueError("All measures need to have the shape {}, "
+                             "found {}".format(self._shape, value.shape))
+        if self._n_runs > 0 and np.array_equal(self._values[self._n_runs-1], value):
+            self._ends[self._n_runs-1] += 1
+            return
+        if self._spill_file is not None and self._n_runs >= self.max_runs:
+            self._spill(self._n_runs - self.max_runs//2)
+        elif self._n_runs == len(self._ends):
+            self._grow()
+        self._values[self._n_runs] = value
+        self._ends[self._n_runs] = self._n_in_memory + 1
+        self._n_runs += 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return list(self._iter_range(start, stop))
+        length = len(self)
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise IndexError("MeasureStorage index out of range")
+        ends, values, offset = self._runs_containing(key)
+        run = np.searchsorted(ends, key - offset, side="right")
+        return self._to_measure(values[run])
+
+    def __iter__(self):
+        return self._iter_range(0, len(self))
+
+    def __array__(self, dtype=None):
+        ends, values, _ = self._runs_containing(0)
+        arr = np.repeat(values, np.diff(ends, prepend=0), axis=0)
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_spill_map"] = None
+        return state
+
+    def __repr__(self):
+        return "<MeasureStorage with {} measures in {} runs>".format(len(self),
+                                                                     self._spilled_runs+self._n_runs)
+
+    def _to_measure(self, value):
+        if self._shape == ():
+            return float(value)
+        return np.array(value)
+
+    def _iter_range(self, start, stop):
+        """
+        Yield the measures with indices start to stop-1, without expanding runs in advance.
+        """
+        if start >= stop:
+            return
+        ends, values, offset = self._runs_containing(start)
+        run = np.searchsorted(ends, start - offset, side="right")
+        i = start
+        while i < stop:
+            repeat = min(ends[run] + offset, stop) - i
+            for _ in range(repeat):
+                yield self._to_measure(values[run])
+            i += repeat
+            run += 1
+
+    def _runs_containing(self, index):
+        """
+        The runs starting with the run that contains the given index.
+
+        The spill file is only read, if the index is not in memory.
+
+        :returns: A tuple ends, values, offset. The measure with index i
+                  is in the first run with ends[run] + offset > i.
+        """
+        ends = self._ends[:self._n_runs]
+        values = self._values[:self._n_runs] if self._values is not None else np.zeros(0)
+        if index >= self._spilled or not self._spilled_runs:
+            return ends, values, self._spilled
+        spilled_ends, spilled_values = self._spilled_runs_data()
+        ends = np.concatenate([spilled_ends, ends + self._spilled])
+        values = np.concatenate([spilled_values, values])
+        return ends, values, 0
+
+    def _spilled_runs_data(self):
+        """
+        :returns: The run ends and values of all spilled runs.
+                  The values are a view into a memory map of the spill file.
+        """
+        if self._spill_map is None or len(self._spill_map) != self._spilled_runs:
+            row_size = 1 + int(np.prod(self._shape))
+            self._spill_map = np.memmap(self._spill_file, dtype=np.float64, mode="r",
+                                        shape=(self._spilled_runs, row_size))
+        ends = np.cumsum(self._spill_map[:, 0].astype(int))
+        values = self._spill_map[:, 1:].reshape((self._spilled_runs,)+self._shape)
+        return ends, values
+
+    def _grow(self):
+        capacity = 2*len(self._ends)
+        values = np.empty((capacity,)+self._shape)
+        values[:self._n_runs] = self._values[:self._n_runs]
+        ends = np.zeros(capacity, dtype=int)
+        ends[:self._n_runs] = self._ends[:self._n_runs]
+        self._values = values
+        self._ends = ends
+
+    def _spill(self, n):
+        """
+        Append the oldest n runs in memory to the spill file.
+        """
+        rows = np.empty((n, 1+int(np.prod(self._shape))))
+        rows[:, 0] = np.diff(self._ends[:n], prepend=0)
+        rows[:, 1:] = self._values[:n].reshape((n, -1))
+        with open(self._spill_file, "ab") as f:
+            f.write(rows.tobytes())
+        spilled = int(self._ends[n-1])
+        remaining = self._n_runs - n
+        self._values[:remaining] = self._values[n:self._n_runs]
+        self._ends[:remaining] = self._ends[n:self._n_runs] - spilled
+        self._n_runs = remaining
+        self._spilled += spilled
+        self._spilled_runs += n
+        log.debug("Moved %d measures (%d runs) to %s", spilled, n, self._spill_file)
@@ -24,6 +24,7 @@ class MSTchangingMover(Mover):
         self._prev_mst = None
     def move(self, sm):
         self._prev_stats = {}
+        self._snapshot = None
         self._prev_mst = None
         # Get an element. If it is a ml-segment, break it.
         elem = self._get_elem(sm)
@@ -43,7 +44,7 @@ class MSTchangingMover(Mover):
                     # The element was already broken => call super
                     return super(MSTchangingMover, self).move(sm)
                 assert elem.startswith("m")
-                new_stat = self.stat_source.sample_for(sm.bg, elem)
+                new_stat = self.stat_source.sample_for(sm.bg, elem, topology=sm.topology)
                 sm.elem_defs[elem]=new_stat
                 sm.new_traverse_and_build(start = elem, include_start = True)
                 return "BREAK{};{}->{}".format(old_elem, elem, new_stat.pdb_name)
@@ -55,6 +56,8 @@ class MSTchangingMover(Mover):
             # Reset MST
             log.info("Reverting MST")
             sm.change_mst(self._prev_mst, self.stat_source)
+            # The snapshot is not valid for a different MST
+            self._snapshot = None
         else:
             log.info("MST does not need to be revert")
         self._prev_mst = None
@@ -129,6 +132,7 @@ class NElementMover(Mover):
         if self._n_moves>len(sm.bg.defines):
             raise ValueError("CG RNA has fewer elements than should be change per move.")
         self._prev_stats = {}
+        self._snapshot = sm.snapshot()
         movestring = []
         i=0
         while len(self._prev_stats)<self._n_moves:
@@ -181,7 +185,7 @@ class ConnectedElementMover(NElementMover):
 
     def _get_elem_and_stat(self, sm):
         elem = self._get_elem(sm)
-        new_stat = self.stat_source.sample_for(sm.bg, elem)
+        new_stat = self.stat_source.sample_for(sm.bg, elem, topology=sm.topology)
         return elem, new_stat
 
 
@@ -200,6 +204,7 @@ class WholeMLMover(Mover):
     def move(self, sm):
         movestring = []
         self._prev_stats = {}
+        self._snapshot = sm.snapshot()
         while self._has_incomplete_ml(sm):
             elem, new_stat = self._get_elem_and_stat(sm)
             movestring.append(self._move(sm, elem, new_stat))
@@ -225,5 +230,5 @@ class WholeMLMover(Mover):
             return super(WholeMLMover,self)._get_elem_and_stat(sm)
         else:
             elem = random.choice(list(self._get_missing_ml_nodes(sm)))
-            new_stat = self.stat_source.sample_for(sm.bg, elem)
+            new_stat = self.stat_source.sample_for(sm.bg, elem, topology=sm.topology)
             return elem, new_stat
@@ -0,0 +1,207 @@
+"""
+Statistics and adaptation of the temperature ladder of replica exchange.
+
+The ladder is described by the prefactors of the energies of every temperature.
+LadderStatistics tracks, how often exchanges between neighboring temperatures
+are accepted and how the replicas travel between the lowest and the highest
+temperature (the fraction of replicas moving "up" at every temperature, as used
+by Katzgraber et al. 2006, J. Stat. Mech. P03018).
+
+AdaptiveLadder changes the prefactors during burn-in, such that exchanges
+between all neighboring temperatures are accepted equally often.
+The prefactors of the lowest and highest temperature stay fixed.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+#: The number of exchange rounds between two updates of the ladder.
+ADAPTATION_INTERVAL = 20
+
+#: Labels of replicas, depending on the end of the ladder they visited last.
+UP = 1
+DOWN = -1
+
+
+class LadderStatistics(object):
+    """
+    Exchange statistics for every pair of neighboring temperatures.
+
+    Temperatures are numbered from 0 (the temperature of the first replica)
+    to num_temperatures-1.
+    """
+    def __init__(self, num_temperatures):
+        self.num_temperatures = num_temperatures
+        #: The walker (structure or replica) at every temperature.
+        #: Accepted exchanges swap the walkers of two temperatures.
+        self.walker_at = list(range(num_temperatures))
+        #: UP, DOWN or 0 for every walker.
+        self._labels = [0]*num_temperatures
+        self._labels[0] = UP
+        self._labels[-1] = DOWN
+        #: Attempts and accepted exchanges between temperature i and i+1 since the last update
+        self.window_attempts = np.zeros(num_temperatures-1)
+        self.window_accepted = np.zeros(num_temperatures-1)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything except the position and the labels of the walkers.
+        """
+        self.attempts = np.zeros(self.num_temperatures-1)
+        self.accepted = np.zeros(self.num_temperatures-1)
+        #: How often a walker labeled UP or DOWN was found at every temperature.
+        self.up_counts = np.zeros(self.num_temperatures)
+        self.down_counts = np.zeros(self.num_temperatures)
+        #: The number of walkers that went from the lowest to the highest temperature and back.
+        self.round_trips = 0
+
+    def record(self, lower, accepted):
+        """
+        Record an exchange attempt between temperature lower and lower+1.
+        """
+        self.attempts[lower]+=1
+        self.window_attempts[lower]+=1
+        if accepted:
+            self.accepted[lower]+=1
+            self.window_accepted[lower]+=1
+            self.walker_at[lower], self.walker_at[lower+1] = self.walker_at[lower+1], self.walker_at[lower]
+
+    def end_round(self):
+        """
+        Update the labels and the up/down counts after all exchanges of a round.
+        """
+        bottom = self.walker_at[0]
+        if self._labels[bottom] == DOWN:
+            self.round_trips+=1
+        self._labels[bottom] = UP
+        self._labels[self.walker_at[-1]] = DOWN
+        for temperature, walker in enumerate(self.walker_at):
+            if self._labels[walker] == UP:
+                self.up_counts[temperature]+=1
+            elif self._labels[walker] == DOWN:
+                self.down_counts[temperature]+=1
+
+    def window_acceptance_rates(self):
+        """
+        The acceptance rates since the last call, with a pseudocount
+        to avoid rates of exactly 0 or 1.
+        """
+        rates = (self.window_accepted+0.5)/(self.window_attempts+1)
+        self.window_attempts[:] = 0
+        self.window_accepted[:] = 0
+        return rates
+
+    def fraction_up(self):
+        """
+        For every temperature, the fraction of labeled walkers, that last visited the lowest temperature.
+        """
+        with np.errstate(invalid="ignore"):
+            return self.up_counts/(self.up_counts+self.down_counts)
+
+    def to_file(self, filename, scales):
+        """
+        :param scales: The prefactor of every temperature relative to the first temperature
+        """
+        with np.errstate(invalid="ignore"):
+            rates = self.accepted/self.attempts
+        with open(filename, "w") as f:
+            print("Temperature\tPrefactor_scale\tFraction_up", file=f)
+            for temperature, (scale, up) in enumerate(zip(scales, self.fraction_up())):
+                print("{}\t{:.6f}\t{:.3f}".format(temperature+1, scale, up), file=f)
+            print("", file=f)
+            print("Temperatures\tAttempts\tAccepted\tAcceptance_rate", file=f)
+            for lower in range(self.num_temperatures-1):
+                print("{}-{}\t{:d}\t{:d}\t{:.3f}".format(lower+1, lower+2, int(self.attempts[lower]),
+                                                     int(self.accepted[lower]), rates[lower]), file=f)
+            print("", file=f)
+            print("Round_trips\t{}".format(self.round_trips), file=f)
+
+
+class AdaptiveLadder(object):
+    """
+    The prefactors of all temperatures, adapted during burn-in towards equal
+    acceptance rates between all neighboring temperatures.
+
+    The energies of all temperatures have to be the same up to a common factor
+    (the scale), which decreases with increasing temperature.
+    Every ADAPTATION_INTERVAL exchange rounds, the distance between temperature i
+    and i+1 on a logarithmic scale is multiplied with exp(gain*(rate_i-mean_rate)),
+    where the gain decreases with every update. Then all distances are rescaled,
+    so the scales of the first and last temperature do not change.
+    """
+    def __init__(self, parameters, burn_in_rounds):
+        """
+        :param parameters: For every temperature, a list of the temperature_parameters
+                           of all energies.
+        :param burn_in_rounds: The number of exchange rounds, during which the ladder
+                               is adapted. If it is 0, the ladder stays fixed.
+        """
+        base = [ params[0] for params in parameters[0] ]
+        scales = []
+        for temperature, temp_params in enumerate(parameters):
+            if burn_in_rounds and any(params[1]!=0 for params in temp_params):
+                raise ValueError("The temperature ladder cannot be adapted for energies "
+                                 "with a changing prefactor")
+            ratios = [ params[0]/b if b!=0 else float("nan") for params, b in zip(temp_params, base) ]
+            if burn_in_rounds and not np.allclose(ratios, ratios[0]):
+                raise ValueError("The temperature ladder can only be adapted, if the energies of all "
+                                 "replicas are the same up to a common factor. Temperature {} has the "
+                                 "prefactors {}, temperature 1 has {}".format(temperature+1,
+                                 [ params[0] for params in temp_params ], base))
+            scales.append(ratios[0] if ratios else float("nan"))
+        self.burn_in_rounds = burn_in_rounds
+        self._parameters = parameters
+        self._base = base
+        #: The logarithm of the scale of every temperature
+        self.log_scales = np.log(scales)
+        if burn_in_rounds and not np.all(np.diff(self.log_scales)<0):
+            raise ValueError("The temperature ladder can only be adapted, if the prefactors "
+                             "decrease from the first to the last replica. Found {}".format(scales))
+        self._num_updates = 0
+
+    @property
+    def scales(self):
+        return np.exp(self.log_scales)
+
+    def parameters(self, temperature):
+        """
+        The temperature_parameters of all energies at the given temperature.
+        """
+        if not self._num_updates:
+            return self._parameters[temperature]
+        scale = np.exp(self.log_scales[temperature])
+        return [ (b*scale, stepwidth, freq)
+                 for b, (pf, stepwidth, freq) in zip(self._base, self._parameters[temperature]) ]
+
+    def update(self, statistics, exchange_round):
+        """
+        Called after every exchange round.
+
+        :param statistics: The LadderStatistics
+        :returns: True, if the prefactors changed.
+        """
+        if exchange_round>=self.burn_in_rounds:
+            return False
+        changed = False
+        if (exchange_round+1)%ADAPTATION_INTERVAL==0 and len(self.log_scales)>2:
+            rates = statistics.window_acceptance_rates()
+            gain = 1./(1+0.1*self._num_updates)
+            distances = -np.diff(self.log_scales)
+            distances *= np.exp(gain*(rates-np.mean(rates)))
+            distances *= (self.log_scales[0]-self.log_scales[-1])/np.sum(distances)
+            self.log_scales[1:-1] = self.log_scales[0]-np.cumsum(distances)[:-1]
+            self._num_updates+=1
+            log.info("Acceptance rates %s. New prefactor scales %s", rates, self.scales)
+            changed = True
+        if exchange_round==self.burn_in_rounds-1:
+            # The final statistics describe the adapted ladder only.
+            statistics.reset()
+        return changed
@@ -0,0 +1,122 @@
+"""
+A compact binary message with the state of a SpatialModel.
+
+Parallel replicas send their structures to their neighbors for every
+replica exchange attempt. Instead of converting the structure to a cg-string
+and building a new SpatialModel from it, the message contains only the
+stem coordinates, the minimal spanning tree and, for every element, the
+index of its stat among all stats for the element's key. The receiver
+loads the message into an existing SpatialModel of the same RNA.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+import pickle
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+#: The index of elements without a stat in elem_defs.
+NO_STAT = -1
+
+
+class ReplicaStateCodec(object):
+    """
+    Converts the state of a SpatialModel to bytes and loads it into other
+    SpatialModels of the same RNA.
+
+    The message consists of the stem mids and twists (float64), one stat index
+    per element (int32) and one byte per element for the minimal spanning tree.
+    Stats which are not in the stat_source (e.g. continuous stats) are
+    pickled and appended to the message.
+    Sender and receiver need a ReplicaStateCodec for the same RNA and stats.
+    """
+    def __init__(self, bg, stat_source):
+        """
+        :param bg: The CoarseGrainRNA of any of the SpatialModels.
+        :param stat_source: The StatStorage the SpatialModels were sampled from.
+        """
+        self.stat_source = stat_source
+        self.elements = sorted(bg.defines)
+        #: The stems in the order of SpatialModel.stem_store
+        self.stems = sorted(d for d in bg.defines if d[0]=="s")
+        #: stat key -> (list of all stats, {id(stat): index})
+        self._libraries = {}
+
+    def _library(self, sm, elem):
+        key = (elem[0], sm.topology.stat_key(self.stat_source, elem))
+        try:
+            return self._libraries[key]
+        except KeyError:
+            pass
+        try:
+            stats = self.stat_source.all_stats_for(sm.bg, elem, key=key[1])
+        except LookupError:
+            stats = []
+        # Keep a reference to the list, so the ids stay valid.
+        library = (stats, { id(stat): i for i, stat in enumerate(stats) })
+        self._libraries[key] = library
+        return library
+
+    def encode(self, sm):
+        """
+        :param sm: A SpatialModel, which was built from its elem_defs.
+        :returns: The message as bytes
+        """
+        indices = np.full(len(self.elements), NO_STAT, dtype=np.int32)
+        extra_stats = []
+        for i, elem in enumerate(self.elements):
+            if elem not in sm.elem_defs:
+                continue
+            stat = sm.elem_defs[elem]
+            index = self._library(sm, elem)[1].get(id(stat))
+            if index is None:
+                # Encoded as -2, -3, ...
+                index = NO_STAT - 1 - len(extra_stats)
+                extra_stats.append(stat)
+            indices[i] = index
+        if sm.bg.mst is None:
+            sm.bg.traverse_graph()
+        mst = sm.bg.mst
+        in_mst = np.array([ elem in mst for elem in self.elements ], dtype=np.uint8)
+        message = [sm.stem_store.mids.tobytes(), sm.stem_store.twists.tobytes(),
+                   indices.tobytes(), in_mst.tobytes()]
+        if extra_stats:
+            message.append(pickle.dumps(extra_stats, protocol=2))
+        return b"".join(message)
+
+    def decode(self, message, sm):
+        """
+        Load a message created by `encode` into sm.
+
+        :param message: The bytes returned by encode
+        :param sm: A SpatialModel of the same RNA. It is changed in place.
+        """
+        num_stems = len(self.stems)
+        num_elems = len(self.elements)
+        mids = np.frombuffer(message, np.float64, 6*num_stems, 0).reshape((num_stems, 2, 3))
+        twists = np.frombuffer(message, np.float64, 6*num_stems, 48*num_stems).reshape((num_stems, 2, 3))
+        offset = 96*num_stems
+        indices = np.frombuffer(message, np.int32, num_elems, offset)
+        offset += 4*num_elems
+        in_mst = np.frombuffer(message, np.uint8, num_elems, offset)
+        offset += num_elems
+        if len(message) > offset:
+            extra_stats = pickle.loads(message[offset:])
+        else:
+            extra_stats = []
+        mst = set(elem for elem, in_tree in zip(self.elements, in_mst) if in_tree)
+        if sm.bg.mst != mst:
+            # The stat keys depend on the minimal spanning tree.
+            sm.set_mst(mst)
+        elem_defs = {}
+        for elem, index in zip(self.elements, indices.tolist()):
+            if index >= 0:
+                elem_defs[elem] = self._library(sm, elem)[0][index]
+            elif index < NO_STAT:
+                elem_defs[elem] = extra_stats[NO_STAT - 1 - index]
+        sm.load_state(elem_defs, mids, twists)
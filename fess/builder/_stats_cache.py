@@ -0,0 +1,396 @@
+"""
+A persistent binary cache of parsed stats files.
+
+Parsing a large stats file takes a considerable part of the startup time
+of short runs. The first time a stats file is read, the parsed stats are
+stored column-wise in a cache directory. All columns share a few pools
+(floats, integers and utf-8 encoded strings) stored as .npy files,
+which are described by a json layout. Stats of the same key are stored
+consecutively, so the cache can be loaded without creating any stat object.
+Stat objects are only created, when the stats for a key are requested.
+
+The pools are memory-mapped read-only. All processes using the same stats
+file (e.g. parallel replicas) share the pages of the pools, instead of
+each holding its own copy of all stat objects.
+
+The cache file is keyed by the path, modification time and size
+of the stats file, so changing the stats file invalidates the cache.
+The cache files of older versions of a stats file are removed, when the
+new cache file is written.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import hashlib
+import json
+import logging
+import numbers
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import forgi.threedee.model.stats as ftmstats
+
+log = logging.getLogger(__name__)
+
+#: Increase this, whenever the format of the cache files changes
+CACHE_VERSION = 2
+
+#: The arrays in a cache directory
+_POOLS = ["ints", "floats", "strings", "string_offsets"]
+
+_STAT_CLASSES = {
+    "StemStat": ftmstats.StemStat,
+    "AngleStat": ftmstats.AngleStat,
+    "LoopStat": ftmstats.LoopStat
+}
+
+
+def cache_filename(filename, cache_dir):
+    """
+    The name of the cache file for the given stats file.
+
+    :param filename: The path to the stats file.
+    :param cache_dir: The directory containing the cache files.
+    """
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    key = "{}\0{}\0{!r}\0{}".format(CACHE_VERSION, path, st.st_mtime, st.st_size)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}-{}".format(os.path.basename(path), digest))
+
+
+def load_cached(filename, cache_dir, parse):
+    """
+    Load the stats of the given stats file from the cache.
+
+    If no valid cache file exists, the stats file is parsed and the cache file is created.
+
+    :param filename: The path to the stats file.
+    :param cache_dir: The directory containing the cache files.
+                      It will be created, if it does not exist.
+    :param parse: A function parsing the stats file, if it is not cached.
+                  Called with the filename. Has to return a dictionary
+                  {stat_type: {key: list_of_stats}}
+    :returns: A dictionary {stat_type: mapping}, where every mapping maps keys to lists of stats.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    cache_file = cache_filename(filename, cache_dir)
+    if os.path.isdir(cache_file):
+        try:
+            stats = read_cache(cache_file)
+        except Exception as e:
+            log.warning("Ignoring the invalid stats cache %s: %s", cache_file, e)
+        else:
+            log.info("Loaded stats for %s from cache %s", filename, cache_file)
+            return stats
+    stats = parse(filename)
+    try:
+        write_cache(stats, cache_file, os.path.realpath(filename))
+    except (IOError, OSError, ValueError) as e:
+        log.warning("Could not write the stats cache %s: %s", cache_file, e)
+        return stats
+    log.info("Stored stats for %s in cache %s", filename, cache_file)
+    remove_stale_caches(filename, cache_file)
+    # Use the memory-mapped stats, so they are shared with other processes.
+    return read_cache(cache_file)
+
+
+def write_cache(stats, cache_file, source=None):
+    """
+    Store the stats in a cache file.
+
+    The cache is written to a temporary directory first, so processes reading
+    the cache concurrently never see an incomplete cache.
+
+    :param stats: A dictionary {stat_type: {key: list_of_stats}}
+    :param cache_file: The name of the cache directory
+    :param source: The real path of the stats file. Used by remove_stale_caches.
+    """
+    pools = _Pools()
+    layout = {"version": CACHE_VERSION, "stat_types": {}}
+    if source is not None:
+        layout["source"] = source
+    for stat_type, stats_by_key in stats.items():
+        keys = [ key for key, stat_list in stats_by_key.items() if stat_list ]
+        rows = [ stat for key in keys for stat in stats_by_key[key] ]
+        description = {"n": len(rows)}
+        layout["stat_types"][stat_type] = description
+        if not rows:
+            continue
+        classes = set(type(stat).__name__ for stat in rows)
+        if len(classes) != 1 or list(classes)[0] not in _STAT_CLASSES:
+            raise ValueError("Cannot cache stats of type {}".format(classes))
+        description["class"] = classes.pop()
+        # The stats for the i-th key are the rows key_offsets[i] to key_offsets[i+1]-1
+        description["key_offsets"] = pools.add_ints(np.cumsum([0] + [len(stats_by_key[key])
+                                                                     for key in keys]))
+        if isinstance(keys[0], tuple):
+            description["keys"] = [ pools.add_column(column) for column in zip(*keys) ]
+        else:
+            description["key"] = pools.add_column(keys)
+        attributes = list(rows[0].__dict__.keys())
+        if any(set(stat.__dict__) != set(attributes) for stat in rows):
+            raise ValueError("Cannot cache {}-stats with different attributes".format(stat_type))
+        description["attributes"] = [ [attribute, pools.add_column([stat.__dict__[attribute]
+                                                                    for stat in rows])]
+                                      for attribute in attributes ]
+    arrays = pools.arrays()
+    directory = os.path.dirname(cache_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_dir = tempfile.mkdtemp(dir=directory or ".", suffix=".tmp")
+    try:
+        for name in _POOLS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), arrays[name])
+        with open(os.path.join(tmp_dir, "layout.json"), "w") as f:
+            f.write(json.dumps(layout))
+        os.rename(tmp_dir, cache_file)
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        if os.path.isdir(cache_file):
+            # Another process has written the same cache in the meantime.
+            return
+        raise
+
+
+def remove_stale_caches(filename, cache_file):
+    """
+    Remove all cache files for the stats file filename except cache_file.
+
+    Cache files of other stats files with the same name are kept.
+
+    :param filename: The path to the stats file.
+    :param cache_file: The current cache file of the stats file.
+    """
+    path = os.path.realpath(filename)
+    cache_dir = os.path.dirname(cache_file)
+    prefix = "{}-".format(os.path.basename(path))
+    for name in os.listdir(cache_dir):
+        other = os.path.join(cache_dir, name)
+        if not name.startswith(prefix) or other == cache_file:
+            continue
+        try:
+            with open(os.path.join(other, "layout.json")) as f:
+                source = json.loads(f.read()).get("source")
+        except (IOError, OSError, ValueError):
+            continue
+        if source == path:
+            log.info("Removing the outdated stats cache %s", other)
+            shutil.rmtree(other, ignore_errors=True)
+
+
+def read_cache(cache_file):
+    """
+    :param cache_file: The name of the cache directory
+    :returns: A dictionary {stat_type: CachedStats}
+    """
+    with open(os.path.join(cache_file, "layout.json")) as f:
+        layout = json.loads(f.read())
+    if layout["version"] != CACHE_VERSION:
+        raise ValueError("Cache version {} instead of {}".format(layout["version"], CACHE_VERSION))
+    pools = _Pools(cache_file)
+    return { stat_type: CachedStats(pools, description)
+             for stat_type, description in layout["stat_types"].items() }
+
+
+class CachedStats(Mapping):
+    """
+    A read-only mapping from keys to lists of stats, backed by the columns of a cache file.
+
+    The stat objects for a key are created, when the key is first accessed.
+    """
+    def __init__(self, pools, description):
+        self._pools = pools
+        #: The position of the stats for every key
+        self._ranges = collections.OrderedDict()
+        #: The lists of stats, which have been created already
+        self._lists = {}
+        if description["n"] == 0:
+            return
+        self._class = _STAT_CLASSES[description["class"]]
+        self._attributes = description["attributes"]
+        offsets = pools.ints(description["key_offsets"]).tolist()
+        n_keys = len(offsets) - 1
+        if "keys" in description:
+            keys = list(zip(*[pools.values(column, 0, n_keys) for column in description["keys"]]))
+        else:
+            keys = pools.values(description["key"], 0, n_keys)
+        for i, key in enumerate(keys):
+            self._ranges[key] = (offsets[i], offsets[i+1])
+
+    def __getitem__(self, key):
+        try:
+            return self._lists[key]
+        except KeyError:
+            pass
+        start, stop = self._ranges[key]
+        names = [ name for name, _ in self._attributes ]
+        columns = [ self._pools.values(column, start, stop) for _, column in self._attributes ]
+        stats = []
+        for values in zip(*columns):
+            stat = self._class.__new__(self._class)
+            stat.__dict__.update(zip(names, values))
+            stats.append(stat)
+        self._lists[key] = stats
+        return stats
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # Other processes create their own stat objects.
+        state["_lists"] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self._ranges
+
+    def __iter__(self):
+        return iter(self._ranges)
+
+    def __len__(self):
+        return len(self._ranges)
+
+
+class _Pools(object):
+    """
+    The arrays holding the data of all columns.
+
+    A column is described by a json-serializable dictionary with the
+    type of the column and the positions of its data in the pools.
+    Supported are numbers, strings, lists of numbers or strings
+    and dictionaries from integers to coordinates (like vres).
+    """
+    def __init__(self, directory=None):
+        """
+        :param directory: None, to add columns, or a cache directory to read from.
+        """
+        self._directory = directory
+        if directory is None:
+            self._ints = []
+            self._floats = []
+            self._strings = []
+            self._n_ints = self._n_floats = 0
+        else:
+            self._attach()
+
+    def _attach(self):
+        arrays = { name: np.load(os.path.join(self._directory, name + ".npy"), mmap_mode="r")
+                   for name in _POOLS }
+        self._int_array = arrays["ints"]
+        self._float_array = arrays["floats"]
+        self._string_bytes = arrays["strings"]
+        self._string_offsets = arrays["string_offsets"]
+
+    def __getstate__(self):
+        if self._directory is None:
+            return self.__dict__
+        # Do not copy the memory maps, but attach to the same files.
+        return {"_directory": self._directory}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._directory is not None and "_int_array" not in state:
+            self._attach()
+
+    def arrays(self):
+        encoded = [ string.encode("utf-8") for string in self._strings ]
+        return {
+            "ints": np.concatenate([np.zeros(0, dtype=np.int64)] + self._ints),
+            "floats": np.concatenate([np.zeros(0)] + self._floats),
+            "strings": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            "string_offsets": np.cumsum([0] + [len(e) for e in encoded]).astype(np.int64)
+        }
+
+    def add_ints(self, values):
+        values = np.asarray(values, dtype=np.int64).ravel()
+        self._ints.append(values)
+        self._n_ints += len(values)
+        return [self._n_ints - len(values), len(values)]
+
+    def add_floats(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        self._floats.append(values)
+        self._n_floats += len(values)
+        return [self._n_floats - len(values), len(values)]
+
+    def add_column(self, values):
+        values = list(values)
+        first = next((value for value in values
+                      if not isinstance(value, (list, dict)) or len(value) > 0), None)
+        if first is None:
+            if any(values):
+                raise ValueError("Cannot cache values {}".format(values[:3]))
+            # Only empty lists or dicts.
+            if values and isinstance(values[0], dict):
+                return {"type": "dict", "offsets": self.add_ints([0]*(len(values)+1)),
+                        "keys": self.add_ints([]), "values": self.add_floats([])}
+            return {"type": "list", "offsets": self.add_ints([0]*(len(values)+1)),
+                    "items": {"type": "int", "data": self.add_ints([])}}
+        if isinstance(first, bool) or not isinstance(first, (numbers.Number, str, list, dict)):
+            raise ValueError("Cannot cache values of type {}".format(type(first)))
+        if isinstance(first, dict):
+            keys = [ k for value in values for k in sorted(value) ]
+            coords = [ value[k] for value in values for k in sorted(value) ]
+            return {"type": "dict",
+                    "offsets": self.add_ints(np.cumsum([0] + [len(value) for value in values])),
+                    "keys": self.add_ints(keys),
+                    "values": self.add_floats(coords)}
+        if isinstance(first, list):
+            return {"type": "list",
+                    "offsets": self.add_ints(np.cumsum([0] + [len(value) for value in values])),
+                    "items": self.add_column([ item for value in values for item in value ])}
+        if isinstance(first, str):
+            self._strings.extend(values)
+            return {"type": "str", "data": [len(self._strings) - len(values), len(values)]}
+        if all(isinstance(value, numbers.Integral) for value in values):
+            return {"type": "int", "data": self.add_ints(values)}
+        column = {"type": "float", "data": self.add_floats(values)}
+        if any(isinstance(value, numbers.Integral) for value in values):
+            # Keep the distinction between ints and floats in mixed columns.
+            column["is_int"] = self.add_ints([isinstance(value, numbers.Integral) for value in values])
+        return column
+
+    def ints(self, position):
+        start, length = position
+        return self._int_array[start:start+length]
+
+    def values(self, column, start, stop):
+        """
+        :returns: A list of the python values in the rows start to stop-1 of the column.
+        """
+        if column["type"] == "dict":
+            offsets = self.ints(column["offsets"])[start:stop+1].tolist()
+            keys = self.ints(column["keys"])
+            first, _ = column["values"]
+            coords = self._float_array[first+3*offsets[0]:first+3*offsets[-1]].reshape((-1, 3))
+            out = []
+            for i in range(stop - start):
+                begin, end = offsets[i], offsets[i+1]
+                out.append({ k: coords[j - offsets[0]].copy()
+                             for k, j in zip(keys[begin:end].tolist(), range(begin, end)) })
+            return out
+        if column["type"] == "list":
+            offsets = self.ints(column["offsets"])[start:stop+1].tolist()
+            items = self.values(column["items"], offsets[0], offsets[-1])
+            return [ items[offsets[i]-offsets[0]:offsets[i+1]-offsets[0]] for i in range(stop - start) ]
+        first, _ = column["data"]
+        if column["type"] == "str":
+            bounds = self._string_offsets[first+start:first+stop+1].tolist()
+            return [ self._string_bytes[bounds[i]:bounds[i+1]].tobytes().decode("utf-8")
+                     for i in range(stop - start) ]
+        if column["type"] == "int":
+            return self._int_array[first+start:first+stop].tolist()
+        values = self._float_array[first+start:first+stop].tolist()
+        if "is_int" in column:
+            is_int = self.ints(column["is_int"])[start:stop].tolist()
+            values = [ int(v) if i else v for v, i in zip(values, is_int) ]
+        return values
@@ -11,6 +11,8 @@ except ImportError:
 
 import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.threedee.utilities.vector as ftuv
+import forgi.threedee.utilities.my_math as ftum
+import forgi.threedee.classification.aminor as ftca
 import forgi.utilities.debug as fud
 import forgi.graph.bulge_graph as fgb
 from collections import namedtuple
@@ -22,6 +24,8 @@ import os.path
 
 from logging_exceptions import log_to_exception
 
+from ._geometry_cache import segment_distances, closest_points
+
 log=logging.getLogger(__name__)
 
 try:
@@ -84,3 +88,151 @@ def iter_probs(loop, cg, prob_fun, cutoff_dist, domain = None):
             warnings.warn("Probability at %s is %f>1 for %s %s with domain %s" %(point, p, cg.name, loop, domain))
         yield(p)
     yield 0 #Always yield at least one number, so max(_iter_probs(...)) does not raise an error
+
+
+def all_interactions(cg):
+    """
+    Like forgi.threedee.classification.aminor.all_interactions with the
+    default classifiers, but the geometries of all loop-stem pairs are
+    calculated at once.
+
+    :returns: A list of  tuples (loop, stem)
+    """
+    interactions = []
+    stems = list(cg.stem_iterator())
+    for loop_type in ["i", "h"]:
+        loops = [ loop for loop in cg.defines
+                  if loop[0]==loop_type and 'A' in "".join(cg.get_define_seq_str(loop)) ]
+        geos, labels = potential_interactions(cg, loops, stems)
+        clf = ftca._get_default_clf(loop_type)
+        interactions.extend(ftca._classify_potential_interactions(clf, geos, labels))
+    return interactions
+
+def potential_interactions(cg, loops, stems):
+    """
+    Find all loop-stem pairs closer than ftca.CUTOFFDIST and calculate their geometries.
+
+    :returns: A tuple `geos`, `labels` like ftca.potential_interactions
+    """
+    if not loops or not stems:
+        return np.zeros((0,3)), np.zeros((0,2))
+    loop_coords = np.array([cg.coords[loop] for loop in loops])
+    stem_coords = np.array([cg.coords[stem] for stem in stems])
+    dists = segment_distances(loop_coords[:,0], loop_coords[:,1],
+                              stem_coords[:,0], stem_coords[:,1])
+    candidates = dists < ftca.CUTOFFDIST
+    for i, loop in enumerate(loops):
+        for j, stem in enumerate(stems):
+            if candidates[i,j] and stem in cg.edges[loop]:
+                candidates[i,j] = False
+    loop_i, stem_j = np.nonzero(candidates)
+    if len(loop_i)==0:
+        return np.zeros((0,3)), np.zeros((0,2))
+    labels = np.array([ [loops[i], stems[j]] for i, j in zip(loop_i, stem_j) ])
+    geos = relative_orientations(cg, loop_coords[loop_i], [stems[j] for j in stem_j])
+    geos[:, 0] /= ftca.ANGLEWEIGHT
+    return geos, labels
+
+def relative_orientations(cg, loop_coords, stems):
+    """
+    A vectorized version of ftca.get_relative_orientation.
+
+    :param loop_coords: A Nx2x3 array with start and end of the loops (donors)
+    :param stems: A list of N stem names (receptors)
+    :returns: A Nx3 array. The columns are dist, angle1 and angle2
+    """
+    stem_coords = np.array([cg.coords[stem] for stem in stems])
+    twist_params = {}
+    for stem in stems:
+        if stem not in twist_params:
+            twist_params[stem] = _stem_twist_params(cg, stem)
+    u = np.array([twist_params[stem][0] for stem in stems])
+    v = np.array([twist_params[stem][1] for stem in stems])
+    ang_per_nt = np.array([twist_params[stem][2] for stem in stems])
+    stem_lengths = np.array([cg.stem_length(stem) for stem in stems])
+
+    point_on_stem, point_on_loop = closest_points(stem_coords[:,0], stem_coords[:,1],
+                                                  loop_coords[:,0], loop_coords[:,1])
+    conn_vec = point_on_loop - point_on_stem
+    dist = np.sqrt(np.sum(conn_vec*conn_vec, axis=-1))
+    stem_vec = stem_coords[:,1] - stem_coords[:,0]
+    angle1 = _vec_angles(stem_vec, conn_vec)
+    # The direction of the stem vector is irrelevant
+    angle1 = np.where(angle1 > np.pi/2, np.pi - angle1, angle1)
+
+    # Where along the helix the loop points to the minor groove.
+    stem_pos = point_on_stem - stem_coords[:,0]
+    pos = (np.sqrt(np.sum(stem_pos*stem_pos, axis=-1))/np.sqrt(np.sum(stem_vec*stem_vec, axis=-1))
+           * (stem_lengths - 1))
+    ang = (ang_per_nt*pos)[:,np.newaxis]
+    virt_twist = u*np.cos(ang) + v*np.sin(ang)
+    # The projection of the connection vector onto the plane normal to the stem
+    n = np.sum(conn_vec*stem_vec, axis=-1)
+    d = np.sum(stem_vec*stem_vec, axis=-1)
+    conn_proj = conn_vec - (n/d)[:,np.newaxis]*stem_vec
+    angle2 = _vec_angles(virt_twist, conn_proj)
+    angle2 *= _parallel_signs(np.cross(virt_twist, conn_proj), stem_vec)
+    angle2 = np.where(dist==0, float("nan"), angle2)
+    return np.array([dist, angle1, angle2]).T
+
+def _vec_angles(vecs1, vecs2):
+    """
+    Row-wise ftuv.vec_angle
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vecs1 = vecs1/np.sqrt(np.sum(vecs1*vecs1, axis=-1))[:,np.newaxis]
+        vecs2 = vecs2/np.sqrt(np.sum(vecs2*vecs2, axis=-1))[:,np.newaxis]
+    return np.arccos(np.clip(np.sum(vecs1*vecs2, axis=-1), -1., 1.))
+
+def _parallel_signs(vecs1, vecs2):
+    """
+    Row-wise ftuv.is_almost_parallel
+
+    :returns: An array with 1 for parallel, -1 for antiparallel and 0 for other rows.
+    """
+    CUTOFF = 10**-7
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors = vecs1/np.where(np.abs(vecs2) < CUTOFF, float("nan"), vecs2)
+    valid = ~np.isnan(factors)
+    first = factors[np.arange(len(factors)), np.argmax(valid, axis=1)][:,np.newaxis]
+    with np.errstate(invalid="ignore"):
+        same = np.all(~valid | ((np.sign(factors) == np.sign(first))
+                                & (np.abs(factors - first) < CUTOFF)), axis=1)
+    return np.where(np.any(valid, axis=1) & same, np.sign(first[:,0]), 0.)
+
+def _stem_twist_params(cg, stem):
+    """
+    The helix parameters used by ftug.virtual_res_3d_pos_core
+
+    :returns: A tuple u, v, ang_per_nt. The vector pointing to the minor groove
+              at the (floating point) nucleotide position pos is
+              u*cos(ang_per_nt*pos) + v*sin(ang_per_nt*pos)
+    """
+    coords = cg.coords[stem]
+    twists = cg.twists[stem]
+    stem_len = cg.stem_length(stem)
+    stem_vec = coords[1] - coords[0]
+    u = twists[0]
+    v = ftuv.normalize(np.cross(stem_vec, twists[0]))
+    if stem_len == 1:
+        return u, v, 0.
+    stem_basis = ftuv.create_orthonormal_basis(stem_vec, twists[0])
+    t2 = ftuv.change_basis(twists[1], stem_basis, ftuv.standard_basis)
+    ang = ftum.atan3(t2[2], t2[1])
+    # calculated from an ideal length 30 helix
+    average_ang_per_nt = 0.636738030735
+    expected_ang = (stem_len - 1) * average_ang_per_nt
+    expected_dev = expected_ang
+    while (expected_dev - (2 * np.pi) > 0):
+        expected_dev -= 2 * np.pi
+    if ang < expected_dev:
+        forward = 2 * np.pi + ang - expected_dev
+        backward = expected_dev - ang
+    else:
+        forward = ang - expected_dev
+        backward = 2 * np.pi + expected_dev - ang
+    if forward < backward:
+        total_ang = expected_ang + forward
+    else:
+        total_ang = expected_ang - backward
+    return u, v, total_ang / float(stem_len - 1)
@@ -7,6 +7,8 @@ class Configuration:
     sampling_output_dir = 'sampling_out'
 
     default_stats_file = "stats/all_nr3.36.stats" # Can be overridden by commandline arguments.
+    # Parsed stats files are cached here. Set this to None to disable the cache.
+    stats_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "ernwin", "stats")
 
     #The file where ideal bases are stored for base-replacement during reconstruction
     template_residue_fn = 'stats/residue_template.pdb'
@@ -15,6 +15,8 @@ import random
 import itertools as it
 import logging
 
+import numpy as np
+
 has_warned = set()
 
 log = logging.getLogger(__name__)
@@ -27,40 +29,133 @@ def stat_combinations(cg, elems, stat_source, unique = False):
     (with the possibility of duplicates). If the total number of
     combinations is small, this iterates through all combinations in a
     pseudorandom order (no duplicates).
-    If the number of combinations is large but not huge,
+    See StatCombinations, which draws the same combinations in batches.
     """
     choices = { elem : list(stat_source.iterate_stats_for(cg, elem))
                 for elem in elems }
     for value in _sample_unique_stat_combinations(choices):
         yield value
 
-def index_to_sample(index, choices):
-    sampled = {}
-    for elem, stats in choices.items():
-        c_nr = index%len(stats)
-        sampled[elem]=stats[c_nr]
-        index = int(index/len(stats))
-    return sampled
-
 def _sample_unique_stat_combinations(choices):
-    from bitarray import bitarray
-    product_size = 1
-    for stats in choices.values():
-        product_size *= len(stats)
-    if product_size>10**9:
-        if tuple(choices.keys()) not in has_warned:
-            log.warning("Too many stats-combination for unique sampling of %s: %s."
-                        "Sampling with replacement.", list(choices.keys()), product_size)
-            has_warned.add(tuple(choices.keys()))
-        while True:
-            i = random.randrange(product_size)
-            yield index_to_sample(i, choices)
-    else:
-        found = bitarray(product_size)
-        found.setall(False)
-        while not found.all():
-            i = random.randrange(product_size)
-            if found[i]:
-                continue
-            found[i]=True
-            yield index_to_sample(i, choices)
+    combinations = StatCombinations(choices)
+    while True:
+        batch = combinations.draw(1)
+        if not len(batch):
+            return
+        yield combinations.combination(batch[0])
+
+class StatCombinations(object):
+    """
+    Draws combinations of stats for elements in batches.
+
+    The combinations are drawn in the order of stat_combinations,
+    which yields them one at a time.
+
+    A combination is represented as a row of indices into the lists
+    of self.choices, so a batch can be evaluated with numpy.
+    """
+    def __init__(self, choices):
+        """
+        :param choices: A dictionary {elem: list of stats}
+        """
+        self.elems = list(choices.keys())
+        self.choices = [ choices[elem] for elem in self.elems ]
+        self.product_size = 1
+        for stats in self.choices:
+            self.product_size *= len(stats)
+        if self.product_size>10**9:
+            if tuple(self.elems) not in has_warned:
+                log.warning("Too many stats-combination for unique sampling of %s: %s."
+                            "Sampling with replacement.", self.elems, self.product_size)
+                has_warned.add(tuple(self.elems))
+            self._found = None
+        else:
+            from bitarray import bitarray
+            self._found = bitarray(self.product_size)
+            self._found.setall(False)
+        self._num_found = 0
+        #: The state of the random module before the last batch was drawn
+        self._random_state = None
+        #: The flat indices of the last batch and the number of calls
+        #: to random.randrange needed to draw them.
+        self._batch = []
+        self._draws = []
+        #: The flat index of the last combination drawn
+        self._last = None
+
+    @classmethod
+    def for_elems(cls, cg, elems, stat_source):
+        return cls({ elem : list(stat_source.iterate_stats_for(cg, elem))
+                     for elem in elems })
+
+    def draw(self, n):
+        """
+        Draw the next n combinations.
+
+        :returns: An integer array of shape (k, len(self.elems)). k is smaller than n
+                  only if all combinations have been drawn.
+        """
+        self._random_state = random.getstate()
+        self._batch = []
+        self._draws = []
+        draws = 0
+        while len(self._batch)<n:
+            if self._found is not None and self._num_found==self.product_size:
+                break
+            i = random.randrange(self.product_size)
+            draws += 1
+            if self._found is not None:
+                if self._found[i]:
+                    continue
+                self._found[i] = True
+                self._num_found += 1
+            self._batch.append(i)
+            self._draws.append(draws)
+            self._last = i
+        indices = np.empty((len(self._batch), len(self.elems)), dtype=int)
+        for row, i in enumerate(self._batch):
+            indices[row] = self._indices(i)
+        return indices
+
+    def _indices(self, i):
+        """
+        The indices into self.choices for the flat index i.
+        """
+        indices = []
+        for stats in self.choices:
+            indices.append(i%len(stats))
+            i = int(i/len(stats))
+        return indices
+
+    def rewind(self, k):
+        """
+        Keep only the first k combinations of the last batch.
+
+        The others can be drawn again and the random module is
+        reset to the state after drawing the first k combinations.
+        """
+        if self._found is not None:
+            for i in self._batch[k:]:
+                self._found[i] = False
+                self._num_found -= 1
+        random.setstate(self._random_state)
+        for _ in range(self._draws[k-1] if k>0 else 0):
+            random.randrange(self.product_size)
+        self._batch = self._batch[:k]
+        self._draws = self._draws[:k]
+        self._last = self._batch[-1] if self._batch else None
+
+    def last(self):
+        """
+        :returns: The last combination drawn as a dictionary or None
+        """
+        if self._last is None:
+            return None
+        return self.combination(self._indices(self._last))
+
+    def combination(self, indices):
+        """
+        :param indices: A row returned by self.draw
+        :returns: A dictionary {elem: stat}
+        """
+        return { elem : stats[i] for elem, stats, i in zip(self.elems, self.choices, indices) }
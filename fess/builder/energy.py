@@ -7,7 +7,7 @@ from six.moves import map
 from six.moves import range
 __metaclass__=object
 
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, namedtuple
 import random
 import warnings
 import os.path as op
@@ -33,6 +33,7 @@ import numpy as np
 import scipy.stats
 import scipy.optimize
 import scipy.ndimage
+import scipy.spatial
 import scipy.misc
 import pandas as pd
 
@@ -56,6 +57,8 @@ import forgi.threedee.classification.aminor as ftca
 from .energy_abcs import EnergyFunction, CoarseGrainEnergy, DEFAULT_ENERGY_PREFACTOR, InteractionEnergy
 import fess.builder.aminor as fba
 from fess.builder._commandline_helper import replica_substring
+from ._measure_storage import MeasureStorage
+from ._geometry_cache import geometry_for
 from ..utils import get_all_subclasses, get_version_string
 from fess import data_file
 
@@ -694,6 +697,281 @@ class StemVirtualResClashEnergy(EnergyFunction):
         energy += self.prefactor * self._virtual_residue_atom_clashes_kd(cg)
         return energy
 
+#: Cached information about the virtual residues of a single stem.
+#: version is unique for every stem geometry seen, fingerprint holds the
+#: coords and twists the entry was calculated for, points the offset
+#: virtual residue positions used for the 20 Angstrom prefilter, vres an
+#: integer array with the (i, a, resn) labels of these points, atoms a lazily filled dict
+#: {(i,a): array of virtual atom coordinates} and cells the cells of
+#: the spatial index containing the points.
+_StemClashInfo = namedtuple("_StemClashInfo", ["version", "fingerprint", "points", "vres", "atoms", "cells"])
+
+#: The offsets of a grid cell and its 26 neighbors
+_NEIGHBOR_CELLS = list(itertools.product((-1, 0, 1), repeat=3))
+
+class IncrementalStemVirtualResClashEnergy(StemVirtualResClashEnergy):
+    '''
+    Determine if the virtual residues clash, only re-checking moved stems.
+
+    The virtual residues of all stems are kept in a spatial index (a grid
+    with cells of the size of the prefilter distance), which is only updated
+    for stems whose coordinates or twists changed since the last call to
+    eval_energy. Only the pairs of a moved stem with the stems in the
+    neighboring cells are re-evaluated. The number of clashes is cached
+    for every clashing pair of stems.
+    After a rejected sampling step (rollback_step or reject_last_measure),
+    the cache is rolled back to the state of the last accepted step.
+    '''
+    _shortname = "ICLASH"
+    HELPTEXT = ("Clash constraint energy, which caches\n"
+                "clashes between steps and only re-\n"
+                "checks stems that moved.")
+
+    _MULT = 8
+    _CANDIDATE_DISTANCE = 20
+
+    def __init__(self, clash_penalty = None, atom_diameter = None):
+        """
+        :param clash_penalty: The energy attributed to each pair of clashing atoms
+        :param atom_radius: The distance between two atoms which counts as a clash
+        """
+        super(IncrementalStemVirtualResClashEnergy, self).__init__(clash_penalty, atom_diameter)
+        #: stem name -> _StemClashInfo
+        self._stem_cache = {}
+        #: (stem1, stem2) -> (version1, version2, num_clashes, atoms1, atoms2)
+        #: Only for pairs with clashes.
+        self._pair_cache = {}
+        #: grid cell -> set of stems with virtual residues in this cell
+        self._grid = defaultdict(set)
+        #: The stems taken into account during the last call to eval_energy.
+        self._stems = frozenset()
+        #: The entries overwritten since the last accepted step.
+        #: None, if there was no entry before.
+        self._undo_stems = {}
+        self._undo_pairs = {}
+        self._undo_stem_set = None
+        self._next_version = 0
+
+    def commit_step(self):
+        self._undo_stems = {}
+        self._undo_pairs = {}
+        self._undo_stem_set = None
+
+    def rollback_step(self):
+        for stem, old_info in self._undo_stems.items():
+            self._remove_from_grid(stem, self._stem_cache[stem])
+            if old_info is None:
+                del self._stem_cache[stem]
+            else:
+                self._stem_cache[stem] = old_info
+                self._add_to_grid(stem, old_info)
+        for key, old_val in self._undo_pairs.items():
+            if old_val is None:
+                self._pair_cache.pop(key, None)
+            else:
+                self._pair_cache[key] = old_val
+        if self._undo_stem_set is not None:
+            self._stems = self._undo_stem_set
+        self._undo_stems = {}
+        self._undo_pairs = {}
+        self._undo_stem_set = None
+
+    def accept_last_measure(self):
+        self.commit_step()
+        super(IncrementalStemVirtualResClashEnergy, self).accept_last_measure()
+
+    def reject_last_measure(self):
+        self.rollback_step()
+        super(IncrementalStemVirtualResClashEnergy, self).reject_last_measure()
+
+    def _add_to_grid(self, stem, info):
+        for cell in info.cells:
+            self._grid[cell].add(stem)
+
+    def _remove_from_grid(self, stem, info):
+        for cell in info.cells:
+            self._grid[cell].discard(stem)
+            if not self._grid[cell]:
+                del self._grid[cell]
+
+    def _update_stem(self, cg, stem):
+        """
+        Make sure the cache entry and the spatial index for the stem are up to date.
+
+        :returns: True, if the stem changed since the last call.
+        """
+        fingerprint = np.vstack([cg.coords[stem], cg.twists[stem]])
+        info = self._stem_cache.get(stem)
+        if info is not None and np.array_equal(info.fingerprint, fingerprint):
+            return False
+        points = []
+        vres = []
+        for i in range(cg.stem_length(stem)):
+            (p, v, v_l, v_r) = cg.v3dposs[stem][i]
+            points.append(p + self._MULT * v_l)
+            vres.append((i, 1, cg.stem_side_vres_to_resn(stem, 1, i)))
+            points.append(p + self._MULT * v_r)
+            vres.append((i, 0, cg.stem_side_vres_to_resn(stem, 0, i)))
+        points = np.array(points)
+        vres = np.array(vres, dtype=int)
+        # Points closer than _CANDIDATE_DISTANCE are in the same or in neighboring cells.
+        cells = frozenset(map(tuple, np.floor(points/self._CANDIDATE_DISTANCE).astype(int).tolist()))
+        if stem not in self._undo_stems:
+            self._undo_stems[stem] = info
+        if info is not None:
+            self._remove_from_grid(stem, info)
+        info = _StemClashInfo(self._next_version, fingerprint, points, vres, {}, cells)
+        self._next_version += 1
+        self._stem_cache[stem] = info
+        self._add_to_grid(stem, info)
+        return True
+
+    def _neighbors(self, stem):
+        """
+        The stems with virtual residues in the cells of stem or in neighboring cells.
+        """
+        cells = set((x+dx, y+dy, z+dz) for x, y, z in self._stem_cache[stem].cells
+                                        for dx, dy, dz in _NEIGHBOR_CELLS)
+        neighbors = set()
+        for cell in cells:
+            neighbors.update(self._grid.get(cell, ()))
+        neighbors.discard(stem)
+        return neighbors
+
+    def _close_stems(self, stem, others):
+        """
+        The stems in others with a virtual residue closer than _CANDIDATE_DISTANCE
+        to a virtual residue of stem.
+        """
+        if not others:
+            return []
+        points = np.concatenate([ self._stem_cache[other].points for other in others ])
+        labels = np.repeat(np.arange(len(others)),
+                           [ len(self._stem_cache[other].points) for other in others ])
+        dists = scipy.spatial.distance.cdist(self._stem_cache[stem].points, points)
+        close = np.unique(labels[(dists <= self._CANDIDATE_DISTANCE).any(axis=0)])
+        return [ others[i] for i in close ]
+
+    def _set_pair(self, key, entry):
+        if key not in self._undo_pairs:
+            self._undo_pairs[key] = self._pair_cache.get(key)
+        if entry is None:
+            self._pair_cache.pop(key, None)
+        else:
+            self._pair_cache[key] = entry
+
+    def _vres_atoms(self, cg, stem, info, i, a):
+        try:
+            return info.atoms[(i, a)]
+        except KeyError:
+            atoms = np.array(list(ftug.virtual_residue_atoms(cg, stem, i, a).values()))
+            info.atoms[(i, a)] = atoms
+            return atoms
+
+    def _pair_clashes(self, cg, s1, info1, s2, info2):
+        """
+        Count the clashing atoms between two stems.
+
+        :returns: A tuple (num_clashes, clashing atoms of s1, clashing atoms of s2)
+        """
+        if cg.edges[s1] & cg.edges[s2]:
+            # the stems are connected
+            return 0, [], []
+        dists = scipy.spatial.distance.cdist(info1.points, info2.points)
+        candidates = dists <= self._CANDIDATE_DISTANCE
+        #Adjacent residues cannot clash
+        candidates &= np.abs(info1.vres[:, np.newaxis, 2] - info2.vres[np.newaxis, :, 2]) != 1
+        if not candidates.any():
+            return 0, [], []
+        atoms1, labels1 = self._candidate_atoms(cg, s1, info1, np.nonzero(candidates.any(axis=1))[0])
+        atoms2, labels2 = self._candidate_atoms(cg, s2, info2, np.nonzero(candidates.any(axis=0))[0])
+        atom_dists = scipy.spatial.distance.cdist(atoms1, atoms2)
+        close1, close2 = np.nonzero(atom_dists <= self.adjustment)
+        # Only atoms of candidate pairs of virtual residues count,
+        # ordered by the pair of virtual residues.
+        is_candidate = candidates[labels1[close1], labels2[close2]]
+        close1, close2 = close1[is_candidate], close2[is_candidate]
+        order = np.lexsort((close2, close1, labels2[close2], labels1[close1]))
+        close1, close2 = close1[order], close2[order]
+        return len(close1), list(atoms1[close1]), list(atoms2[close2])
+
+    def _candidate_atoms(self, cg, stem, info, indices):
+        """
+        The virtual atoms of the virtual residues info.vres[indices].
+
+        :returns: A tuple (atoms, labels). labels[j] is the index into info.vres
+                  of the virtual residue of atoms[j].
+        """
+        atoms = []
+        labels = []
+        for index in indices:
+            i, a, _ = info.vres[index]
+            vra = self._vres_atoms(cg, stem, info, int(i), int(a))
+            atoms.append(vra)
+            labels.append(np.full(len(vra), index, dtype=int))
+        return np.concatenate(atoms), np.concatenate(labels)
+
+    def eval_energy(self, cg, background=False, nodes = None, **kwargs):
+        '''
+        Count how many clashes of virtual residues there are.
+
+        :param cg: The CoarseGrainRNA
+        :param background: Ignored. Clashes are independent of any other energies.
+        :param nodes: Only consider these elements (default: all elements)
+        '''
+        self.bad_bulges = []
+        self.bad_atoms = defaultdict(list)
+
+        if nodes is None:
+            nodes = list(cg.defines.keys())
+        stems = sorted(stem for stem in nodes if stem[0]=="s")
+        if len(stems)<2:
+            # Special case, if only one stem is present.
+            return 0.
+
+        moved = [ stem for stem in stems if self._update_stem(cg, stem) ]
+        stem_set = frozenset(stems)
+        if stem_set != self._stems:
+            # Pairs with stems, which were not considered before, are unknown.
+            if self._undo_stem_set is None:
+                self._undo_stem_set = self._stems
+            self._stems = stem_set
+            moved = stems
+        infos = self._stem_cache
+        checked = set()
+        for s1 in moved:
+            partners = []
+            for s2 in sorted(self._neighbors(s1) & stem_set):
+                key = tuple(sorted([s1, s2]))
+                if key not in checked:
+                    checked.add(key)
+                    partners.append(s2)
+            # Pairs without close virtual residues have no clashes.
+            for s2 in self._close_stems(s1, partners):
+                key = tuple(sorted([s1, s2]))
+                entry = self._pair_cache.get(key)
+                versions = (infos[key[0]].version, infos[key[1]].version)
+                if entry is not None and entry[:2] == versions:
+                    continue
+                entry = versions + self._pair_clashes(cg, key[0], infos[key[0]], key[1], infos[key[1]])
+                self._set_pair(key, entry if entry[2] > 0 else None)
+        clashes = 0
+        for key in sorted(self._pair_cache):
+            s1, s2 = key
+            if s1 not in stem_set or s2 not in stem_set:
+                continue
+            entry = self._pair_cache[key]
+            if entry[:2] != (infos[s1].version, infos[s2].version):
+                # A stem moved away from its clash partner.
+                self._set_pair(key, None)
+                continue
+            clashes += entry[2]
+            self.bad_bulges.append(key)
+            self.bad_atoms[s1].extend(entry[3])
+            self.bad_atoms[s2].extend(entry[4])
+        self.log.debug("%s clashes between %s stems", clashes, len(stems))
+        return self.prefactor * clashes
+
 class RoughJunctionClosureEnergy(EnergyFunction):
     _shortname = "JDIST"
     _JUNCTION_DEFAULT_PREFACTOR = 50000.
@@ -929,19 +1207,21 @@ class CheatingDistributionEnergy(CoarseGrainEnergy):
     sampled_stats_fn = "stats/cde_reference_dist_nr2.110.csv"
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
-        return cls(cg, prefactor, adjustment)
-    def __init__(self, ref_cg, prefactor = None, adjustment = None):
+        return cls(cg, prefactor, adjustment, kwargs.get("kde_tolerance"))
+    def __init__(self, ref_cg, prefactor = None, adjustment = None, kde_tolerance=None):
         super(CheatingDistributionEnergy, self).__init__(ref_cg.seq_length,
                                                          prefactor = prefactor,
-                                                         adjustment = adjustment)
+                                                         adjustment = adjustment,
+                                                         kde_tolerance = kde_tolerance)
         self.real_residues = ftug.bg_virtual_residues(ref_cg)
     def _get_values_from_file(self, filename, rna_length):
         vals = []
         for line in load_local_data(filename):
             vals.append(float(line))
         return vals
-    def _get_cg_measure(self, cg):
-        new_residues = ftug.bg_virtual_residues(cg)
+    def _get_cg_measure(self, cg, geometry=None):
+        geometry = geometry_for(cg, geometry)
+        new_residues = geometry.get("bg_virtual_residues", lambda: ftug.bg_virtual_residues(cg))
         return  ftms.rmsd(self.real_residues, new_residues)
     def _set_target_distribution(self):
         self.target_distribution = lambda x: self.adjustment*np.exp(-self.adjustment*x)
@@ -952,11 +1232,12 @@ class RadiusOfGyrationEnergy(CoarseGrainEnergy):
     real_stats_fn = op.expanduser('stats/rog_target_dist_1S72_0.csv')
     sampled_stats_fn = op.expanduser('stats/rog_reference_dist_1S72_0.csv')
 
-    def __init__(self, rna_length, adjustment=None, prefactor=None):
+    def __init__(self, rna_length, adjustment=None, prefactor=None, kde_tolerance=None):
         """
         :param rna_length: The length in nucleotides of the RNA
         """
-        super(RadiusOfGyrationEnergy, self).__init__(rna_length, prefactor=prefactor, adjustment = adjustment)
+        super(RadiusOfGyrationEnergy, self).__init__(rna_length, prefactor=prefactor, adjustment = adjustment,
+                                                     kde_tolerance=kde_tolerance)
 
     @classmethod
     def generate_target_distribution(cls, cgs, out_filename=None, use_subgraphs = False):
@@ -998,8 +1279,9 @@ class RadiusOfGyrationEnergy(CoarseGrainEnergy):
                 print("{:s} {:d} {:.10f}".format(name, nt_len, rog), file=f)
 
 
-    def _get_cg_measure(self, cg):
-        return cg.radius_of_gyration("fast")
+    def _get_cg_measure(self, cg, geometry=None):
+        geometry = geometry_for(cg, geometry)
+        return geometry.get("radius_of_gyration", lambda: cg.radius_of_gyration("fast"))
 
     def _get_values_from_file(self, filename, length):
         data = pd.read_csv(load_local_data(filename), delimiter=' ', comment="#", names=["pdb_id","nt_length","rog"])
@@ -1034,7 +1316,7 @@ class NormalDistributedRogEnergy(RadiusOfGyrationEnergy):
     real_stats_fn = None
     sampled_stats_fn = op.expanduser('stats/rog_reference_dist_nr2.110.csv')
 
-    def __init__(self, rna_length, adjustment, prefactor=None):
+    def __init__(self, rna_length, adjustment, prefactor=None, kde_tolerance=None):
         """
         A Subclass of the Radius of Gyration energy with a normal distributed target distribution.
 
@@ -1058,7 +1340,7 @@ class NormalDistributedRogEnergy(RadiusOfGyrationEnergy):
 
         :param rnalength: Used for initial reference distribution
         """
-        super(NormalDistributedRogEnergy, self).__init__(rna_length, adjustment, prefactor)
+        super(NormalDistributedRogEnergy, self).__init__(rna_length, adjustment, prefactor, kde_tolerance)
 
     def _set_target_distribution(self):
         self.target_distribution = lambda x: np.array([scipy.stats.norm(loc=0.77*self.adjustment, scale=0.23*self.adjustment).pdf(x)])
@@ -1110,8 +1392,10 @@ class AMinorEnergy(InteractionEnergy):
         self.reference_interactions=[background]*self.knowledge_weight
         self.target_interactions=target
 
-    def _get_cg_measure(self, cg):
-        interactions = ftca.all_interactions(cg)
+    def _get_cg_measure(self, cg, geometry=None):
+        geometry = geometry_for(cg, geometry)
+        # The same for all loop types
+        interactions = geometry.get("aminor_interactions", lambda: fba.all_interactions(cg))
         interactions = set(pair[0] for pair in interactions)
         interaction_counts=0
         for d in self.qualifying_loops(cg, cg.defines):
@@ -1179,17 +1463,14 @@ class UnspecificInteractionEnergy(InteractionEnergy):
             return CombinedEnergy([])
 
 
-    def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+    def _get_cg_measure(self, cg, geometry=None):
+        geometry = geometry_for(cg, geometry)
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        matrix, index = geometry.segment_distance_matrix(loops)
+        close = matrix < self.cutoff
+        np.fill_diagonal(close, False)
+        # Number of loops interacting with at least one other loop
+        interactions = np.count_nonzero(np.any(close, axis=1))
         return interactions/self.num_loops
 
 class LoopLoopInteractionEnergy(InteractionEnergy):
@@ -1214,17 +1495,14 @@ class LoopLoopInteractionEnergy(InteractionEnergy):
             return CombinedEnergy([])
 
 
-    def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+    def _get_cg_measure(self, cg, geometry=None):
+        geometry = geometry_for(cg, geometry)
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        matrix, index = geometry.segment_distance_matrix(loops)
+        close = matrix < self.cutoff
+        np.fill_diagonal(close, False)
+        # Number of loops interacting with at least one other loop
+        interactions = np.count_nonzero(np.any(close, axis=1))
         return interactions/self.num_loops
 
     def reset_distributions(self, rna_length):
@@ -1259,7 +1537,54 @@ def read_gnom_out(filename, in_angstrom=False):
                 " If your file is in Angstrom, use the '--gnom-unit A' commandline option.")
     return df
 
+#: The maximal number of distances computed at once by pair_distance_counts
+PDD_BLOCKSIZE = 2**20
+
+def pair_distance_counts(points, stepsize, others=None):
+    """
+    Count pair distances in bins of width stepsize.
+
+    The distances are calculated in blocks of at most PDD_BLOCKSIZE.
+
+    :param points: An Nx3 array
+    :param others: An Mx3 array or None. If given, count the distances between
+                   points and others. Else count the distances of all pairs of points.
+    :returns: An integer array. counts[i] is the number of distances d with d//stepsize == i
+    """
+    counts = np.zeros(0, dtype=int)
+    partners = points if others is None else others
+    if len(partners)==0:
+        return counts
+    rows = max(1, PDD_BLOCKSIZE//len(partners))
+    for start in range(0, len(points), rows):
+        block = points[start:start+rows]
+        if others is None:
+            # Only pairs i<j
+            diffs = block[:,np.newaxis,:]-points[np.newaxis,start:,:]
+            mask = np.arange(len(points)-start)[np.newaxis,:]>np.arange(len(block))[:,np.newaxis]
+        else:
+            diffs = block[:,np.newaxis,:]-others[np.newaxis,:,:]
+            mask = Ellipsis
+        lengths = np.sqrt(np.sum(diffs*diffs, axis=-1))[mask]
+        bins = np.floor_divide(lengths, stepsize).astype(int)
+        counts = _add_counts(counts, np.bincount(bins.ravel()))
+    return counts
+
+def _add_counts(counts, other, sign=1):
+    """
+    Add sign*other to the histogram counts, in place if counts is long enough.
+
+    :returns: The updated histogram
+    """
+    if len(other)>len(counts):
+        counts = np.concatenate([counts, np.zeros(len(other)-len(counts), dtype=counts.dtype)])
+    counts[:len(other)] += sign*other
+    return counts
+
 class _PDD_Mixin(object):
+    #: The points and histogram of the last call to get_pdd_incremental
+    _pdd_cache = None
+
     def check_level(self, level):
         if level not in ["A", "R", "T"]:
             raise ValueError("Level has to be either 'A', 'T' or 'R', "
@@ -1362,6 +1687,14 @@ class _PDD_Mixin(object):
 
     @classmethod
     def get_pdd(cls, cg, level, stepsize, only_seqids=None):
+        points = cls._get_pdd_points(cg, level, only_seqids)
+        return cls._pdd_from_counts(pair_distance_counts(points, stepsize), stepsize)
+
+    @staticmethod
+    def _get_pdd_points(cg, level, only_seqids=None):
+        """
+        :returns: An Nx3 array of all points contributing to the PDD
+        """
         use_asserts = ftuv.USE_ASSERTS
         ftuv.USE_ASSERTS = False
         try:
@@ -1382,7 +1715,43 @@ class _PDD_Mixin(object):
                     raise ValueError("wrongLevel")
         finally:
             ftuv.USE_ASSERTS = use_asserts
-        return ftuv.pair_distance_distribution(points, stepsize)
+        return np.array(points, dtype=float).reshape((-1, 3))
+
+    @staticmethod
+    def _pdd_from_counts(counts, stepsize):
+        """
+        :returns: A tuple distances, counts like ftuv.pair_distance_distribution
+        """
+        counts = np.trim_zeros(counts, "b")
+        return np.arange(len(counts))*stepsize, counts
+
+    def get_pdd_incremental(self, cg, geometry=None):
+        """
+        Like get_pdd for the energy's level, stepwidth and only_seqids.
+
+        The histogram of the previous call is updated with the distances
+        of all points that changed since the previous call.
+
+        :param geometry: A GeometryCache for cg or None
+        """
+        geometry = geometry_for(cg, geometry)
+        only_seqids = None if self.only_seqids is None else tuple(self.only_seqids)
+        points = geometry.get(("pdd_points", self._level, only_seqids),
+                              lambda: self._get_pdd_points(cg, self._level, self.only_seqids))
+        counts = None
+        if self._pdd_cache is not None and self._pdd_cache[0].shape == points.shape:
+            old_points, old_counts = self._pdd_cache
+            moved = np.any(old_points != points, axis=1)
+            if np.count_nonzero(moved) <= len(points)//4:
+                counts = old_counts.copy()
+                for pts, sign in [(old_points, -1), (points, 1)]:
+                    counts = _add_counts(counts, pair_distance_counts(pts[moved], self._stepwidth,
+                                                                      pts[~moved]), sign)
+                    counts = _add_counts(counts, pair_distance_counts(pts[moved], self._stepwidth), sign)
+        if counts is None:
+            counts = pair_distance_counts(points, self._stepwidth)
+        self._pdd_cache = (points, counts)
+        return self._pdd_from_counts(counts, self._stepwidth)
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, level, cg, pdd_target, **kwargs):
@@ -1418,8 +1787,12 @@ class _PDD_Mixin(object):
                 raise ValueError("Unequally spaced target PDD. Please provide a step-size using the --pdd-stepsize option")
         else:
             stepsize=kwargs["pdd_stepsize"]
+        if issubclass(cls, CoarseGrainEnergy):
+            kwargs = {"kde_tolerance": kwargs.get("kde_tolerance")}
+        else:
+            kwargs = {}
         energy= cls(length=cg.seq_length, target_pdd=target_pdd,
-                   prefactor=prefactor, adjustment=adjustment, level=level, stepwidth=stepsize)
+                   prefactor=prefactor, adjustment=adjustment, level=level, stepwidth=stepsize, **kwargs)
         if pdd_target=="__cg__":
             energy.only_seqids = list(cg.seq.iter_resids(None,None,False))
             logger.debug("Finished setting up energy from reference cg")
@@ -1448,7 +1821,7 @@ class PDDEnergy(_PDD_Mixin, EnergyFunction):
         if use_accepted_measure:
             m = self.accepted_measures[-1]
         else:
-            m = self.get_pdd(cg, self._level, self._stepwidth,self.only_seqids)[1]
+            m = self.get_pdd_incremental(cg, kwargs.get("geometry"))[1]
             m=self.pad(m)
             m=m/np.sum(m)
         self._last_measure=m
@@ -1495,7 +1868,7 @@ class LastNPDDsEnergy(PDDEnergy):
             self.log.debug("Using accepted pdd %s", m[-1])
 
         else:
-            m1 = self.get_pdd(cg, self._level, self._stepwidth, self.only_seqids)[1]*1.0
+            m1 = self.get_pdd_incremental(cg, kwargs.get("geometry"))[1]*1.0
             self.log.debug("Got pdd %s", m1)
             m1=self.pad(m1)
             m = self.accepted_measures[-self.N+1:]
@@ -1530,19 +1903,28 @@ class LastNPDDsEnergy(PDDEnergy):
         #    plt.show()
         return self.prefactor*np.exp(integral*self.adjustment)
 
+    def _step_complete(self):
+        super(LastNPDDsEnergy, self)._step_complete()
+        # The energy depends on the last N accepted measures.
+        self.revision+=1
+
 
 class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
     sampled_stats_fn = None
     HELPTEXT="EPD"
     _shortname = "EPD"
+    # The measures are vectors
+    binned_background = False
     def generate_target_distribution(self, *args, **kwargs):
         raise NotImplementedError("Not needed. Use experiments")
 
-    def __init__(self, length, target_pdd, prefactor, adjustment, level="R", stepwidth=None):
+    def __init__(self, length, target_pdd, prefactor, adjustment, level="R", stepwidth=None,
+                 kde_tolerance=None):
         """
         :param length: The RNA's sequence length
         :param target_pdd: A pandas dataframe with 2 columns: distance, count
         :param level: Either "A" for virtual atoms or "R" for virtual residues.
+        :param kde_tolerance: See CoarseGrainEnergy
         """
         self.target_pdd = target_pdd
         self.log = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
@@ -1555,7 +1937,8 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
         e = np.maximum(target_pdd["error"], 10**-8)
         self.error = e
         self.target_values = np.array(target)
-        super(Ensemble_PDD_Energy, self).__init__(length, prefactor=prefactor, adjustment=adjustment)
+        super(Ensemble_PDD_Energy, self).__init__(length, prefactor=prefactor, adjustment=adjustment,
+                                                  kde_tolerance=kde_tolerance)
         self.log.debug("Now (re-) setting distributions")
         self.reset_distributions(length)
 
@@ -1563,7 +1946,7 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
         # At the start of sampling, set the reference PDD
         # compareable to but broader than the target PDD
         # The target-PDD never changes
-        self.accepted_measures = [self.target_values]
+        self.accepted_measures = MeasureStorage([self.target_values])
         self.log.debug("Target values = %s", self.target_values)
         err = np.linspace(0, max(1,2*int(self.adjustment)), 11)[1:]
         for i in err:
@@ -1616,18 +1999,19 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
                 plt.show()
 
     @classmethod
-    def _get_distribution_from_values(cls, values):
+    def _get_distribution_from_values(cls, values, tolerance=None):
         '''
         Return a probability distribution from the given values.
 
         :param values: A list of values to fit a distribution to.
+        :param tolerance: See CoarseGrainEnergy._get_distribution_from_values
         :return: A probability distribution fit to the values.
         '''
         values = np.asarray(values)
         log.debug("Getting distribution from len(%s [0]) = %s", values, len(values[0]))
         log.debug("values[:,1] = %s", values[:,1])
 
-        kdes = [ super(Ensemble_PDD_Energy, cls)._get_distribution_from_values(values[:,i])
+        kdes = [ super(Ensemble_PDD_Energy, cls)._get_distribution_from_values(values[:,i], tolerance)
                     for i in range(len(values[0]))
                 ]
         log.debug("Ensemble_PDD used %s KDEs: %s", len(kdes), kdes)
@@ -1657,8 +2041,8 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
     def _get_values_from_file(cls, filename, nt_length):
         raise NotImplementedError()
 
-    def _get_cg_measure(self, cg):
-        m = self.get_pdd(cg, self._level, self._stepwidth, self.only_seqids)[1]
+    def _get_cg_measure(self, cg, geometry=None):
+        m = self.get_pdd_incremental(cg, geometry)[1]
         m = self.pad(m)
         m = m/np.sum(m)
         return m
@@ -1701,25 +2085,25 @@ class DoNotContribute(Exception):
     pass
 
 
-def _minimal_h_h_distance(cg, elem1, elem2_iterator):
+def _minimal_h_h_distance(cg, elem1, elem2_iterator, geometry=None):
     """
     Used by ShortestLoopDistancePerLoop-Energy.
 
     :param cg: The CoarseGrain RNA
     :param elem1: A STRING. A name of a hairpin loop. e.g. "h1"
     :param elem2_iterator: An ITERATOR/ LIST. Element names to compare elem1 with.
+    :param geometry: A GeometryCache for cg or None
     """
-    min_dist = float("inf")
-    for elem2 in elem2_iterator:
-        if elem2==elem1: continue
-        (i1,i2) = ftuv.line_segment_distance(cg.coords[elem1][0],
-                                            cg.coords[elem1][1],
-                                            cg.coords[elem2][0],
-                                            cg.coords[elem2][1])
-        dist = ftuv.vec_distance(i1, i2)
-        if dist < min_dist:
-            min_dist = dist
-    return min_dist
+    geometry = geometry_for(cg, geometry)
+    elems = list(elem2_iterator)
+    if elem1 not in elems:
+        elems.append(elem1)
+    others = [ elem2 for elem2 in elems if elem2!=elem1 ]
+    if not others:
+        return float("inf")
+    # All SLD energies of a CombinedEnergy request the same matrix
+    matrix, index = geometry.segment_distance_matrix(elems)
+    return float(np.min(matrix[index[elem1], [index[elem2] for elem2 in others]]))
 
 
 class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
@@ -1740,7 +2124,8 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
         for hloop in cg.hloop_iterator():
             if hloop not in cg.interacting_elements:
                 energies+= [cls(cg.seq_length, loop_name = hloop,
-                            prefactor = prefactor, adjustment = adjustment)]
+                            prefactor = prefactor, adjustment = adjustment,
+                            kde_tolerance = kwargs.get("kde_tolerance"))]
         return CombinedEnergy(energies)
 
     @classmethod
@@ -1800,7 +2185,7 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
                 print("{:s} {:d} {:.10f}".format(pdbid, nt_len, distance), file=f)
 
 
-    def __init__(self, rna_length, loop_name, prefactor=None, adjustment = None):
+    def __init__(self, rna_length, loop_name, prefactor=None, adjustment = None, kde_tolerance=None):
 
         #: Add equally distributed points to the target and reference distribution estimation (linspacepoints  lsp)
         #: Weight of the uniformal distribution that will be averaged to the KDE
@@ -1810,7 +2195,7 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
         #: End of the range for the uniformal distribution
         self._lsp_max = 300
 
-        super(ShortestLoopDistancePerLoop, self).__init__(rna_length, prefactor, adjustment)
+        super(ShortestLoopDistancePerLoop, self).__init__(rna_length, prefactor, adjustment, kde_tolerance)
         self.loop_name = loop_name
 
     @property
@@ -1823,8 +2208,8 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
         data = self._values_within_nt_range(data, length, "dist", "nt_length" )
         return data
 
-    def _get_distribution_from_values(self, values):
-        f = super(ShortestLoopDistancePerLoop, self)._get_distribution_from_values(values)
+    def _get_distribution_from_values(self, values, tolerance=None):
+        f = super(ShortestLoopDistancePerLoop, self)._get_distribution_from_values(values, tolerance)
         self.log.debug("Getting distributions")
         def kde_with_uniform(measure):
             x1 = f(measure)
@@ -1837,10 +2222,11 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
             return (1-self._lsp_weight)*x1+self._lsp_weight*x2
         return kde_with_uniform
 
-    def _get_cg_measure(self, cg):
+    def _get_cg_measure(self, cg, geometry=None):
         min_dist = _minimal_h_h_distance(cg, self.loop_name,
                                         [hloop for hloop in cg.hloop_iterator()
-                                         if hloop not in cg.interacting_elements ])
+                                         if hloop not in cg.interacting_elements ],
+                                         geometry)
         return min_dist
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         '''
@@ -1859,6 +2245,21 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
             return energy
 
 
+def _structure_fingerprint(cg, sampled_stats):
+    """
+    Everything the energy of a structure depends on.
+    Used to make sure cached energies belong to the structure.
+    """
+    if sampled_stats is None:
+        stats = None
+    else:
+        stats = [ (elem, id(stat)) for elem, stat in sampled_stats.items() ]
+    return id(cg), cg.coords.get_array(), cg.twists.get_array(), stats
+
+def _same_fingerprint(fp1, fp2):
+    return (fp1[0] == fp2[0] and fp1[3] == fp2[3] and
+            np.array_equal(fp1[1], fp2[1]) and np.array_equal(fp1[2], fp2[2]))
+
 class CombinedFunction(object):
     def __init__(self, funcs):
         self._funcs = funcs
@@ -1890,6 +2291,11 @@ class CombinedEnergy(object):
             super(CombinedEnergy, self).__setattr__("energies", [])
         super(CombinedEnergy, self).__setattr__("constituing_energies", [])
         super(CombinedEnergy, self).__setattr__("normalize", normalize)
+        #: A tuple (structure fingerprint, [contributions], [revisions of the energies])
+        #: describing the last call to eval_energy or None.
+        super(CombinedEnergy, self).__setattr__("_last_evaluation", None)
+        #: Like _last_evaluation, but for the last accepted structure.
+        super(CombinedEnergy, self).__setattr__("_accepted_evaluation", None)
 
     def __setattr__(self, name, val):
         if name not in self.__dict__:
@@ -1939,6 +2345,30 @@ class CombinedEnergy(object):
                 return True
         return False
 
+    @property
+    def revision(self):
+        """
+        Changes whenever one of the member energies changes.
+        """
+        return sum(e.revision for e in self.energies)
+
+    def accept_last_measure(self):
+        for e in self.energies:
+            e.accept_last_measure()
+        self._accepted_evaluation = self._last_evaluation
+
+    def reject_last_measure(self):
+        for e in self.energies:
+            e.reject_last_measure()
+
+    def commit_step(self):
+        for e in self.energies:
+            e.commit_step()
+
+    def rollback_step(self):
+        for e in self.energies:
+            e.rollback_step()
+
     def iterate_energies(self):
         """
         Iterate over all member enegies
@@ -1997,8 +2427,13 @@ class CombinedEnergy(object):
         total_energy = 0.
         self.constituing_energies=[]
         num_contribs=0
+        contributions = []
+        revisions = []
+        # Share geometric properties of cg between all contributions
+        kwargs["geometry"] = geometry_for(cg, kwargs.get("geometry"))
 
         for energy in self.energies:
+            revisions.append(energy.revision)
             contrib = energy.eval_energy(cg, background=background, nodes=nodes,
                                          use_accepted_measure=use_accepted_measure,
                                          plot_debug = plot_debug, **kwargs)
@@ -2007,6 +2442,7 @@ class CombinedEnergy(object):
                 raise TypeError
                 contrib, = contrib
             self.constituing_energies.append((energy.shortname, contrib))
+            contributions.append(contrib)
             total_energy += contrib
             num_contribs +=1
 
@@ -2016,6 +2452,11 @@ class CombinedEnergy(object):
                     print("bad_bulges:", energy.bad_bulges)
             log.debug("Combined energy instance at {}: {} ({}) contributing {}".format(id(self), energy.__class__.__name__, energy.shortname, contrib))
 
+        if background and nodes is None and not use_accepted_measure:
+            fingerprint = _structure_fingerprint(cg, kwargs.get("sampled_stats"))
+            self._last_evaluation = (fingerprint, contributions, revisions)
+        else:
+            self._last_evaluation = None
 
         if num_contribs>0:
             if self.normalize:
@@ -2029,6 +2470,42 @@ class CombinedEnergy(object):
         log.debug("{} [{}] at {}: total energy is {}".format(str(self), self.shortname, id(self), total_energy))
         return total_energy
 
+    def eval_accepted_energy(self, cg, sampled_stats=None):
+        """
+        Evaluate the energy of the last accepted structure, e.g. after a rejected step.
+
+        Contributions are taken from the values cached when the structure was evaluated.
+        Only energies which changed since then (e.g. because their reference
+        distribution was resampled) are evaluated again.
+        If cg is not the accepted structure, the full energy is evaluated.
+
+        :param cg: The coarse grained RNA
+        :param sampled_stats: A dict {elem: stat}, as passed to eval_energy
+        :returns: The total energy
+        """
+        accepted = self._accepted_evaluation
+        if accepted is None or not _same_fingerprint(accepted[0], _structure_fingerprint(cg, sampled_stats)):
+            log.debug("Accepted energy not cached. Evaluating all contributions.")
+            energy = self.eval_energy(cg, sampled_stats=sampled_stats)
+            self._accepted_evaluation = self._last_evaluation
+            return energy
+        fingerprint, contributions, revisions = accepted
+        contributions = list(contributions)
+        revisions = list(revisions)
+        self.constituing_energies=[]
+        for i, energy in enumerate(self.energies):
+            if energy.revision != revisions[i]:
+                log.debug("Re-evaluating %s, because it changed.", energy.shortname)
+                revisions[i] = energy.revision
+                contributions[i] = energy.eval_energy(cg, sampled_stats=sampled_stats)
+            self.constituing_energies.append((energy.shortname, contributions[i]))
+        self._accepted_evaluation = (fingerprint, contributions, revisions)
+        self._last_evaluation = self._accepted_evaluation
+        total_energy = sum(contributions, 0.)
+        if self.normalize and contributions:
+            total_energy = total_energy/len(contributions)
+        return total_energy
+
     def __str__(self):
         out_str = 'CombinedEnergy('
         for en in self.energies:
@@ -2091,6 +2568,17 @@ def update_parser(parser):
                                      "given via --pdd-file has distances in nm. "
                                      "Set this option to A, if"
                                      "your GNOM output file uses Angstrom instead.")
+    energy_options.add_argument('--spill-measures', action="store_true",
+                                help="Keep only the most recent measures of the "
+                                     "reference ratio method in memory. Older "
+                                     "measures are written to files in the "
+                                     "output directory. Use this to limit the "
+                                     "memory usage of very long simulations.")
+    energy_options.add_argument('--kde-tolerance', type=float,
+                                help="The kernel density estimates of the reference "
+                                     "ratio method are tabulated on a grid with "
+                                     "this relative error (default: {}). "
+                                     "Use 0 to always evaluate them exactly.".format(CoarseGrainEnergy.kde_tolerance))
 def from_args(args, cg, stat_source, replica=None, reference_cg=None):
     energy_string = replica_substring(args.energy, replica)
     energies = EnergyFunction.from_string(energy_string,
@@ -2099,5 +2587,6 @@ def from_args(args, cg, stat_source, replica=None, reference_cg=None):
                                           pdd_target=args.pdd_file,
                                           pdd_stepsize=args.pdd_stepsize,
                                           reference_cg=reference_cg,
-                                          gnom_unit=args.gnom_unit)
+                                          gnom_unit=args.gnom_unit,
+                                          kde_tolerance=args.kde_tolerance)
     return CombinedEnergy(energies)
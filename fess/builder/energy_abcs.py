@@ -18,6 +18,8 @@ from commandline_parsable import parsable_base
 from logging_exceptions import log_to_exception
 
 from ..utils import get_version_string
+from ._kde import BinnedKDE, TabulatedKDE
+from ._measure_storage import MeasureStorage
 from six.moves import map
 import six
 
@@ -61,7 +63,7 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
         #: The reference distribution.
         #: In the case of EnergyFunctions that are not CoarseGrainEnergy instances,
         #: this is only used to dump the measures to a file.
-        self.accepted_measures = []
+        self.accepted_measures = MeasureStorage()
 
         #: The energy function can be adjusted with a prefactor (weight)
         #: and an adjustment (offset from the target value)
@@ -72,6 +74,10 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
         #: (Used for reference ratio method and simulated annealing)
         self.step=0
 
+        #: Increased whenever the energy function itself changes (e.g. the reference
+        #: distribution is resampled), so the same structure might get a different energy.
+        self.revision=0
+
         #: Name and shortname of the energy
         # We need to check the class, not the instance, because implementation of name as a property
         # in subclasses may raise an error on incompletely initialized instanzes.
@@ -82,6 +88,32 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
     def last_accepted_measure(self):
         return self.accepted_measures[-1]
 
+    @property
+    def temperature_parameters(self):
+        """
+        The prefactor together with its update schedule.
+
+        Replica exchange with temperature swapping exchanges these between replicas.
+        """
+        return self.prefactor, self._pf_stepwidth, self._pf_update_freq
+
+    @temperature_parameters.setter
+    def temperature_parameters(self, parameters):
+        self.prefactor, self._pf_stepwidth, self._pf_update_freq = parameters
+        self.revision+=1
+
+    def spill_measures(self, base_directory, max_runs=None):
+        """
+        Keep only the most recent accepted measures in memory and
+        move older ones to a file in base_directory.
+
+        :param max_runs: The maximal number of distinct consecutive measures kept in memory.
+        """
+        if not isinstance(self.accepted_measures, MeasureStorage):
+            self.accepted_measures = MeasureStorage(self.accepted_measures)
+        output_file = os.path.join(base_directory, self.name+"_"+str(hex(id(self)))+".measures.spill")
+        self.accepted_measures.spill_to(output_file, max_runs)
+
     def accept_last_measure(self):
         """
         The last measure should contribute to the new reference distribution.
@@ -106,6 +138,25 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
             self.accepted_measures.append(self.accepted_measures[-1])
         self._step_complete()
 
+    def commit_step(self):
+        """
+        Called for the constraint energies of the SpatialModel after an accepted sampling step.
+
+        Unlike accept_last_measure, this does not count as a step of the
+        energy (e.g. for the prefactor schedule). Energies that cache state
+        between evaluations override this.
+        """
+        pass
+
+    def rollback_step(self):
+        """
+        Called for the constraint energies of the SpatialModel after a rejected sampling step.
+
+        Energies that cache state between evaluations override this to
+        restore the state of the last accepted step. See commit_step.
+        """
+        pass
+
     @abstractproperty #!Note: Can be overwritten by a simple class-level variable, does not have to be a property.
     def _shortname(self):
         """
@@ -153,7 +204,7 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
         to a file.
         '''
         out = " ".join(map("{:.4f}".format,self.accepted_measures))+"\n"
-        output_file = op.join(base_directory, self.name+"_"+str(hex(id(self)))+".measures")
+        output_file = os.path.join(base_directory, self.name+"_"+str(hex(id(self)))+".measures")
         with open(output_file, 'w') as f:
             f.write(out)
 
@@ -188,14 +239,17 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
 
         Called by accept/reject last measure.
         If required, update "temperature" in simulated annealing simulations.
+        Subclasses have to increase self.revision, if they change the energy function.
         """
         log.debug("step complete called on %s instance at %s.",type(self).__name__, hex(id(self)))
         self.step+=1
         if self.step % self._pf_update_freq <1 and self.step>0:
             self._update_pf()
+            self.revision+=1
         log.debug("step: %s  %% _adj_update_freq: %s = %s", self.step, self._adj_update_freq, self.step % self._adj_update_freq)
         if self.step % self._adj_update_freq < 1 and self.step>0:
             self._update_adj()
+            self.revision+=1
     def _update_pf(self):
         self.prefactor += self._pf_stepwidth
     def _update_adj(self):
@@ -248,9 +302,11 @@ class InteractionEnergy(EnergyFunction):
         raise NotImplementedError
 
     @abstractmethod
-    def _get_cg_measure(self, cg):
+    def _get_cg_measure(self, cg, geometry=None):
         """
         Return the fraction of loops that interact, i.e. the interaction-count/self.num_loops
+
+        :param geometry: A GeometryCache for cg or None
         """
         raise NotImplementedError
 
@@ -262,7 +318,7 @@ class InteractionEnergy(EnergyFunction):
         if use_accepted_measure:
             m = self.accepted_measures[-1]
         else:
-            m = self._get_cg_measure(cg)
+            m = self._get_cg_measure(cg, kwargs.get("geometry"))
         self._last_measure = m
 
         reference_perc = sum(self.reference_interactions)/len(self.reference_interactions)
@@ -302,6 +358,14 @@ class CoarseGrainEnergy(EnergyFunction):
     """
     #: Change this to anything but "kde" to use a beta distribution (UNTESTED).
     dist_type = "kde"
+    #: Resample the reference distribution from a BinnedKDE, which is updated
+    #: incrementally with the accepted measures. Only possible for scalar measures.
+    binned_background = True
+    #: The reference distribution from file and the target distribution are tabulated
+    #: on a grid, so the relative error of the density is at most kde_tolerance.
+    #: None means, the KDEs are always evaluated exactly.
+    #: The default for instances created without a kde_tolerance.
+    kde_tolerance = 10**-4
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
@@ -310,10 +374,23 @@ class CoarseGrainEnergy(EnergyFunction):
 
         :returns: An instance if this class or a CombinedEnergy which is empty or contains instances of this class.
         """
-        return cls(rna_length = cg.seq_length, prefactor=prefactor, adjustment=adjustment)
+        return cls(rna_length = cg.seq_length, prefactor=prefactor, adjustment=adjustment,
+                   kde_tolerance=kwargs.get("kde_tolerance"))
 
-    def __init__(self, rna_length, prefactor=None, adjustment=None):
+    def __init__(self, rna_length, prefactor=None, adjustment=None, kde_tolerance=None):
+        """
+        :param kde_tolerance: The relative error of the tabulated KDEs of this energy.
+                              0 to evaluate them exactly, None to use the class attribute.
+        """
         super(CoarseGrainEnergy, self).__init__(prefactor, adjustment)
+        if kde_tolerance is not None:
+            self.kde_tolerance = kde_tolerance or None
+
+        #: A BinnedKDE of the first self._background_kde_count entries of accepted_measures
+        self._background_kde = None
+        self._background_kde_count = 0
+        #: The tabulated target distribution for an adjustment of 1.
+        self._target_table = None
 
         self.reset_distributions(rna_length)
 
@@ -416,10 +493,12 @@ class CoarseGrainEnergy(EnergyFunction):
         """
         if self.sampled_stats_fn is not None:
             log.debug("Loading sapmled measures into accepted_measures")
-            self.accepted_measures = list(self._get_values_from_file(self.sampled_stats_fn, rna_length))
+            self.accepted_measures = MeasureStorage(self._get_values_from_file(self.sampled_stats_fn, rna_length))
+        self._background_kde = None
         #If sampled_stats_fn is None, we assume accepted_measures is given in the constructor
         if self.accepted_measures:
-            self.reference_distribution = self._get_distribution_from_values(self.accepted_measures)
+            self.reference_distribution = self._get_distribution_from_values(self.accepted_measures,
+                                                                             self.kde_tolerance)
         else:
             raise ValueError("Either sampled_stats_fn or accepted_measures has to be set "
                              "before calling CoarseGrainEnergy.__init__ or "
@@ -427,6 +506,7 @@ class CoarseGrainEnergy(EnergyFunction):
                              "for {}.".format(type(self).__name__))
         if self.real_stats_fn is not None:
             self.target_values =  self._get_values_from_file(self.real_stats_fn, rna_length)
+        self._target_table = None
         self._set_target_distribution()
 
     def _step_complete(self):
@@ -437,13 +517,17 @@ class CoarseGrainEnergy(EnergyFunction):
         super(CoarseGrainEnergy, self)._step_complete()
         if self.step % self.kde_resampling_frequency == 0:
             self._resample_background_kde()
+            self.revision+=1
 
     def _resample_background_kde(self):
         """
         Update the reference distribution based on the accepted values
         """
         log.debug("Resampling background KDE for %s. Now %d accepted measures", type(self).__name__, len(self.accepted_measures))
-        values = self.accepted_measures
+        if self.binned_background and self.dist_type == "kde":
+            values = self._update_background_kde()
+        else:
+            values = self.accepted_measures
         new_kde = self._get_distribution_from_values(values)
         if new_kde is not None:
             self.reference_distribution = new_kde
@@ -451,6 +535,19 @@ class CoarseGrainEnergy(EnergyFunction):
         else:
             log.warning("Distribution is None. Cannot change background_kde")
 
+    def _update_background_kde(self):
+        """
+        Add all new accepted measures to self._background_kde
+
+        :returns: The BinnedKDE
+        """
+        if self._background_kde is None or self._background_kde_count > len(self.accepted_measures):
+            self._background_kde = BinnedKDE()
+            self._background_kde_count = 0
+        self._background_kde.add_values(self.accepted_measures[self._background_kde_count:])
+        self._background_kde_count = len(self.accepted_measures)
+        return self._background_kde
+
     @classmethod
     @abstractmethod
     def _get_values_from_file(cls, filename, nt_length):
@@ -479,13 +576,18 @@ class CoarseGrainEnergy(EnergyFunction):
         return rdata[target_col]
 
     @classmethod
-    def _get_distribution_from_values(cls, values):
+    def _get_distribution_from_values(cls, values, tolerance=None):
         '''
         Return a probability distribution from the given values.
 
-        :param values: A list of values to fit a distribution to.
+        :param values: A list of values to fit a distribution to or a BinnedKDE.
+        :param tolerance: Tabulate the KDE with this relative error, or None to
+                          evaluate it exactly. Tabulating is only worth it for
+                          distributions that are evaluated often.
         :return: A probability distribution fit to the values.
         '''
+        if isinstance(values, BinnedKDE):
+            return values.density()
 
         log.debug("Getting distribution from values of shape {}".format(np.shape(values)))
         if cls.dist_type == "kde":
@@ -494,6 +596,8 @@ class CoarseGrainEnergy(EnergyFunction):
             except np.linalg.linalg.LinAlgError:
                 log.exception("Setting KDE for %s to None because of", values)
                 return None
+            if tolerance is not None:
+                k = TabulatedKDE.tabulate(k, tolerance)
         else:
             floc = -0.1
             fscale =  1.5 * max(values)
@@ -502,7 +606,10 @@ class CoarseGrainEnergy(EnergyFunction):
         return k
 
     @abstractmethod
-    def _get_cg_measure(self, cg):
+    def _get_cg_measure(self, cg, geometry=None):
+        """
+        :param geometry: A GeometryCache for cg or None
+        """
         raise NotImplementedError
 
     def eval_energy(self, cg, background=True, nodes=None, use_accepted_measure=False, plot_debug=False, **kwargs):
@@ -517,7 +624,7 @@ class CoarseGrainEnergy(EnergyFunction):
         if use_accepted_measure:
             m = self.accepted_measures[-1]
         else:
-            m = self._get_cg_measure(cg)
+            m = self._get_cg_measure(cg, kwargs.get("geometry"))
 
         if plot_debug: #For debuging
             self.plot_distributions(val=m)
@@ -567,5 +674,14 @@ class CoarseGrainEnergy(EnergyFunction):
 
     def _set_target_distribution(self):
         log.info("Adjusting target distribution (base class)")
+        if self.dist_type == "kde" and self.kde_tolerance is not None and self.adjustment > 0:
+            # The KDE of the scaled values is the scaled KDE of the values,
+            # so the target values only have to be tabulated once.
+            if self._target_table is None:
+                self._target_table = self._get_distribution_from_values(self.target_values,
+                                                                        self.kde_tolerance)
+            if isinstance(self._target_table, TabulatedKDE):
+                self.target_distribution = self._target_table.scaled(self.adjustment)
+                return
         scaled_vals = np.asarray(self.target_values)*self.adjustment
-        self.target_distribution = self._get_distribution_from_values(scaled_vals)
+        self.target_distribution = self._get_distribution_from_values(scaled_vals, self.kde_tolerance)
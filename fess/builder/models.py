@@ -9,7 +9,7 @@ import os.path as op
 import numpy as np
 import math
 import sys
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import warnings
 import glob
 import copy
@@ -38,23 +38,59 @@ from six.moves import range
 log = logging.getLogger(__name__)
 
 
-class StemModel:
+class StemStore(object):
+    '''
+    Contiguous storage for the mids and twists of several stems.
+
+    The coordinates of stem i are stored in mids[i] and twists[i], both of shape (2,3).
+    '''
+    __slots__ = ["mids", "twists"]
+
+    def __init__(self, num_stems):
+        self.mids = np.zeros((num_stems, 2, 3))
+        self.twists = np.zeros((num_stems, 2, 3))
+
+class StemModel(object):
     '''
     A way of encapsulating the coarse grain 3D stem.
+
+    The mids and twists are (2,3) numpy arrays, which are views into a StemStore.
+    If no store is given, the StemModel uses its own store.
     '''
+    __slots__ = ["name", "_store", "_index"]
 
-    def __init__(self, name=None, mids=None, twists=None):
+    def __init__(self, name=None, mids=None, twists=None, store=None, index=0):
         self.name = name
-
-        if mids == None:
-            self.mids = (np.array([0., 0., 0.]), np.array([0., 0., 1.0]))
-        else:
+        if store is None:
+            store = StemStore(1)
+            index = 0
+            if mids is None:
+                mids = (np.array([0., 0., 0.]), np.array([0., 0., 1.0]))
+            if twists is None:
+                twists = (np.array([0., 1., 0.]), np.array([1., 0., 0.0]))
+        self._store = store
+        self._index = index
+        if mids is not None:
             self.mids = mids
-        if twists == None:
-            self.twists = (np.array([0., 1., 0.]), np.array([1., 0., 0.0]))
-        else:
+        if twists is not None:
             self.twists = twists
 
+    @property
+    def mids(self):
+        return self._store.mids[self._index]
+
+    @mids.setter
+    def mids(self, mids):
+        self._store.mids[self._index] = mids
+
+    @property
+    def twists(self):
+        return self._store.twists[self._index]
+
+    @twists.setter
+    def twists(self, twists):
+        self._store.twists[self._index] = twists
+
     def __str__(self):
         return str(self.mids) + '\n' + str(self.twists)
 
@@ -71,7 +107,7 @@ class StemModel:
         Reverse this stem's orientation so that the order of the mids
         is backwards. I.e. mids[1] = mids[0]...
         '''
-        return StemModel(self.name, (self.mids[1], self.mids[0]), (self.twists[1], self.twists[0]))
+        return StemModel(self.name, self.mids[::-1], self.twists[::-1])
 
     def vec(self, from_side_to_side = (0, 1)):
         from_side, to_side = from_side_to_side
@@ -81,18 +117,17 @@ class StemModel:
         '''
         Rotate the stem and its twists according to the definition
         of rot_mat.
-    assert np.array_equal(bm.mids[0], self.bg.coords[connected][1])
 
         @param rot_mat: A rotation matrix.
         '''
-        self.mids = (np.dot(rot_mat, self.mids[0] - offset) + offset, np.dot(rot_mat, self.mids[1] - offset) + offset)
-        self.twists = (np.dot(rot_mat, self.twists[0]), np.dot(rot_mat, self.twists[1]))
+        self.mids = np.dot(self.mids - offset, np.transpose(rot_mat)) + offset
+        self.twists = np.dot(self.twists, np.transpose(rot_mat))
 
     def translate(self, translation):
         '''
         Translate the stem.
         '''
-        self.mids = (self.mids[0] + translation, self.mids[1] + translation)
+        self.mids = self.mids + translation
 
     def length(self):
         '''
@@ -100,16 +135,16 @@ class StemModel:
         '''
         return ftuv.magnitude(self.mids[1] - self.mids[0])
 
-class BulgeModel:
+class BulgeModel(object):
     '''
     A way of encapsulating a coarse grain 3D loop.
     '''
+    __slots__ = ["mids"]
 
     def __init__(self, mids=None):
-        if mids == None:
-            self.mids = (np.array([0., 0., 0.]), np.array([0., 0., 1.0]))
-        else:
-            self.mids = mids
+        if mids is None:
+            mids = (np.array([0., 0., 0.]), np.array([0., 0., 1.0]))
+        self.mids = np.array(mids, dtype=float)
 
     def __str__(self):
         return str(self.mids)
@@ -243,10 +278,98 @@ def place_new_stem(prev_stem, stem_params, bulge_params, s1b_s1e, stem_name=''):
     #assert np.allclose(np.dot(stem_orientation, twist2), 0)
     return stem
 
+def rigid_transform(old_stem, new_stem):
+    '''
+    Calculate the rigid-body transformation that maps old_stem onto new_stem.
+
+    Both stems need to have the same length and twist angle.
+
+    @param old_stem: A StemModel
+    @param new_stem: A StemModel
+    @return: A tuple (rot_mat, translation), such that a point x of old_stem
+             is mapped to np.dot(rot_mat, x) + translation
+    '''
+    old_basis = ftuv.create_orthonormal_basis(old_stem.vec(), old_stem.twists[0])
+    new_basis = ftuv.create_orthonormal_basis(new_stem.vec(), new_stem.twists[0])
+    rot_mat = np.dot(new_basis.T, old_basis)
+    translation = new_stem.mids[0] - np.dot(rot_mat, old_stem.mids[0])
+    return rot_mat, translation
+
+#: The per-stem virtual residue dictionaries of a CoarseGrainRNA
+_STEM_VRES = ["vposs", "vvecs", "v3dposs", "vbases", "vinvs"]
+
+#: The state saved by SpatialModel.snapshot. stem_rows ({index in the StemStore: (mids, twists)})
+#: and vres ({stem: {name in _STEM_VRES: dict or None}}) are only filled when
+#: a stem is changed for the first time after the snapshot was taken.
+SpatialModelSnapshot = namedtuple("SpatialModelSnapshot", ["elements", "twist_elements", "coords",
+                                                           "twists", "stem_rows", "stems", "bulges",
+                                                           "vres", "bases", "stem_invs", "placed_with",
+                                                           "stem_versions", "moved_elements",
+                                                           "unfinished_stems"])
+
 def create_empty_energy():
     log.debug("Creating empty Energy for junction_constraint_energy-fdefaultdict")
     return fbe.CombinedEnergy()
 
+class TopologyIndex(object):
+    """
+    Properties of a SpatialModel, which only depend on its secondary structure
+    and minimal spanning tree and thus stay the same during sampling.
+
+    Use SpatialModel.topology to get an up-to-date instance.
+    """
+    def __init__(self, bg):
+        self.bg = bg
+        #: (key_function, elem) -> stat key
+        self._stat_keys = {}
+        #: (stat_source, elem, min_entries) -> WeightedStats
+        self._weighted_stats = {}
+        #: The frozen elements used for self._movable_elements
+        self._frozen = None
+        self._movable_elements = None
+
+    def movable_elements(self, frozen_elements):
+        """
+        :param frozen_elements: A set of elements that are not allowed to change.
+        :returns: A sorted list of all other elements.
+                  Sorted, so using the same seed yields reproducible results.
+        """
+        if self._movable_elements is None or self._frozen != frozen_elements:
+            self._frozen = set(frozen_elements)
+            self._movable_elements = sorted(set(self.bg.defines.keys()) - self._frozen)
+        return self._movable_elements
+
+    def stat_key(self, stat_source, elem):
+        """
+        :returns: stat_source.key_from_bg_and_elem(self.bg, elem)
+        """
+        key_function = stat_source.key_from_bg_and_elem
+        try:
+            return self._stat_keys[key_function, elem]
+        except KeyError:
+            key = key_function(self.bg, elem)
+            self._stat_keys[key_function, elem] = key
+            return key
+
+    def weighted_stats(self, stat_source, elem, min_entries=100):
+        """
+        :returns: The fess.builder.stat_container.WeightedStats of the candidate stats for elem.
+        """
+        try:
+            return self._weighted_stats[stat_source, elem, min_entries]
+        except KeyError:
+            weighted = stat_source.weighted_stats_for(self.bg, elem, min_entries,
+                                                      key=self.stat_key(stat_source, elem))
+            self._weighted_stats[stat_source, elem, min_entries] = weighted
+            return weighted
+
+    def __getstate__(self):
+        # Do not copy the stats, they can easily be recreated.
+        return {"bg": self.bg}
+
+    def __setstate__(self, state):
+        self.__init__(state["bg"])
+
 class SpatialModel:
     '''
     A way of building RNA structures given angle statistics as well
@@ -278,7 +401,30 @@ class SpatialModel:
 
         self.elem_defs=dict()
 
+        #: The coarse grained elements whose coordinates were changed by the
+        #: last call to new_traverse_and_build.
+        self.moved_elements = set()
+        #: A tuple (build_order, {stem: [indices of build steps depending on stem]})
+        self._dependency_tree = None
+        #: Stems without up-to-date virtual residues.
+        self._unfinished_stems = set()
+        #: stem -> (loop stat, stem stat, version of the previous stem)
+        #: at the time the stem was last placed.
+        self._placed_with = {}
+        #: stem -> A number that changes whenever the stem's coordinates change
+        self._stem_versions = {}
+        self._next_stem_version = 0
+        #: The SpatialModelSnapshot returned by the last call to self.snapshot, if
+        #: it has not been restored yet. Stems are saved there before they change.
+        self._snapshot = None
+
         self.bg = bg
+        #: A TopologyIndex or None, if it has to be recalculated.
+        self._topology = None
+        stem_names = sorted(d for d in bg.defines if d[0]=="s")
+        self._stem_indices = { stem: i for i, stem in enumerate(stem_names) }
+        #: The mids and twists of all stems. self.stems contains views into this store.
+        self.stem_store = StemStore(len(stem_names))
         # We plan to modify the structure, so discard the cahin.
         # This avoids a bug with virtual residues of loops.
         self.bg.chains=None
@@ -290,6 +436,15 @@ class SpatialModel:
             # The structure is probably new and doesnt have coordinates yet
             pass
 
+    @property
+    def topology(self):
+        """
+        A TopologyIndex, which is valid until the minimal spanning tree is changed.
+        """
+        if self._topology is None or self._topology.bg is not self.bg:
+            self._topology = TopologyIndex(self.bg)
+        return self._topology
+
     def sample_stats(self, stat_source):
 
         for d in self.bg.defines:
@@ -323,16 +478,34 @@ class SpatialModel:
         '''
         Create StemModels from the stem definitions in the graph file.
         '''
-        stems = dict()
+        self.stems = dict()
 
         for d in self.bg.defines.keys():
             if d[0] == 's':
-                stems[d] = StemModel(d, self.bg.coords[d], self.bg.twists[d])
+                self._set_stem(d, StemModel(d, self.bg.coords[d], self.bg.twists[d]))
 
                 if self.build_chain:
-                    reconstruct_stem(self, d, self.chain, stem_library=cbc.Configuration.stem_library, stem=stems[d])
+                    reconstruct_stem(self, d, self.chain, stem_library=cbc.Configuration.stem_library, stem=self.stems[d])
 
-        self.stems = stems
+    def _set_stem(self, stem_name, stem):
+        '''
+        Copy the coordinates of the StemModel stem into self.stem_store
+        and make self.stems[stem_name] a view into the store.
+        '''
+        try:
+            index = self._stem_indices[stem_name]
+        except KeyError:
+            self.stems[stem_name] = stem
+            return
+        if self._snapshot is not None and index not in self._snapshot.stem_rows:
+            self._snapshot.stem_rows[index] = (np.copy(self.stem_store.mids[index]),
+                                               np.copy(self.stem_store.twists[index]))
+        target = self.stems.get(stem_name)
+        if target is None or target._store is not self.stem_store:
+            target = StemModel(stem_name, store=self.stem_store, index=index)
+            self.stems[stem_name] = target
+        target.mids = stem.mids
+        target.twists = stem.twists
 
 
     def add_loop(self, name, prev_stem_node, params=None, loop_defs=None):
@@ -372,11 +545,18 @@ class SpatialModel:
         return (edge, define, StemModel(edge))
 
 
-    def save_sampled_elems(self):
+    def save_sampled_elems(self, elems=None):
         '''
         Save the information about all of the sampled elements.
+
+        :param elems: Only save the information for these elements.
+                      By default, all elements in self.elem_defs are saved.
         '''
-        for d, ed in self.elem_defs.items():
+        mst = self.bg.get_mst()
+        if elems is None:
+            elems = self.elem_defs
+        for d in elems:
+            ed = self.elem_defs[d]
             try:
                 self.bg.sampled[d] = [ed.pdb_name] + [len(ed.define)] + ed.define
                 self.bg.vbase[d] = ed.vbase
@@ -389,7 +569,7 @@ class SpatialModel:
                         pass
                     self.bg.vposs[d]=ed.vres
                     log.debug("Set %s to %s ", d, ed.vres)
-                if d not in self.bg.get_mst():
+                if d not in mst:
                     self.bg.infos["vstat_{}".format(d)]=[str(ed)]
             except:
                 log.debug("Error setting {}".format(d))
@@ -402,12 +582,20 @@ class SpatialModel:
         Assumes new_mst is a valid minimal spanning tree.
         """
         old_only = self.bg.mst - new_mst
-        self.bg.mst = new_mst
+        self.set_mst(new_mst)
+        self.load_sampled_elems(stat_source=None)
+        #self.new_traverse_and_build(start='start', include_start = True)
 
+    def set_mst(self, mst):
+        """
+        Set bg.mst to mst without changing self.elem_defs or any coordinates.
+
+        Assumes mst is a valid minimal spanning tree.
+        """
+        self.bg.mst = mst
+        self._topology = None
         self.bg.build_order = None #No longer valid
         self.bg.ang_types = None
-        self.load_sampled_elems(stat_source=None)
-        #self.new_traverse_and_build(start='start', include_start = True)
 
     def set_multiloop_break_segment(self, d):
         """
@@ -426,6 +614,8 @@ class SpatialModel:
         missing_nodes = junction_nodes - self.bg.mst
         if d in missing_nodes:
             return None #The specified cg element is already a breaking point.
+        # The angle types and thus the stat keys change.
+        self._topology = None
         if len(missing_nodes)==1: #The easy case. Just exchange the two ml segments
             log.info("One ml-segment missing: %s", missing_nodes)
             log.info("mst: %s", self.bg.mst)
@@ -638,8 +828,12 @@ class SpatialModel:
                 not np.allclose(self.bg.twists[stem][1], sm.twists[1])):
                 log.debug("Changing stem twist %s : %s to %s", stem, self.bg.twists[stem], (sm.twists[0], sm.twists[1]))
 
-        self.bg.coords[stem] = np.array([sm.mids[0], sm.mids[1]])
-        self.bg.twists[stem] = np.array([sm.twists[0], sm.twists[1]])
+        # Changing the coordinates deletes the virtual residues of the stem.
+        self._own_virtual_residues([stem])
+        self.bg.coords[stem] = sm.mids
+        self.bg.twists[stem] = sm.twists
+        self._stem_versions[stem] = self._next_stem_version
+        self._next_stem_version += 1
 
     def _loops_to_coords(self):
         '''
@@ -708,7 +902,11 @@ class SpatialModel:
 
         #self.prev_visit_order = prev_visited
 
-    def _finish_building(self):
+    def _finish_building(self, moved_stems=None):
+        """
+        :param moved_stems: If given, only recalculate the virtual residues
+                            of these stems (and of stems without virtual residues).
+        """
         log.debug("Finish building")
         log.debug("(1) vposs now %s", self.bg.vposs)
         self.fill_in_bulges_and_loops()
@@ -717,9 +915,58 @@ class SpatialModel:
         log.debug("(3) vposs now %s", self.bg.vposs)
         self.save_sampled_elems()
         log.debug("(4) vposs now %s", self.bg.vposs)
-        self.bg.add_all_virtual_residues()
+        if moved_stems is None:
+            self._own_virtual_residues(self.bg.stem_iterator())
+            self.bg.add_all_virtual_residues()
+        else:
+            for stem in self.bg.stem_iterator():
+                if stem in moved_stems or stem not in self.bg.v3dposs:
+                    self._own_virtual_residues([stem])
+                    ftug.add_virtual_residues(self.bg, stem)
         log.debug("(5) vposs now %s", self.bg.vposs)
 
+    def _set_moved_elements(self, stems):
+        """
+        Set self.moved_elements to the given stems and all loops attached to them.
+        """
+        moved = set(stems)
+        for stem in stems:
+            moved |= self.bg.edges[stem]
+        self.moved_elements = moved
+
+    def _build_dependencies(self, build_order):
+        """
+        :returns: A dict {stem: [indices of the build steps placing a stem relative to stem]}
+        """
+        if self._dependency_tree is None or self._dependency_tree[0] is not build_order:
+            children = defaultdict(list)
+            for i, (s1, l, s2) in enumerate(build_order):
+                children[s1].append(i)
+            self._dependency_tree = (build_order, children)
+            # The stems might have been placed relative to different stems.
+            self._placed_with = {}
+        return self._dependency_tree[1]
+
+    def _dependent_build_steps(self, build_order, first_steps):
+        """
+        Use a tree of build dependencies to find all build steps
+        that have to be repeated, if the given steps are repeated.
+
+        :param build_order: The build order, as returned by bg.traverse_graph()
+        :param first_steps: A list of indices into the build_order
+        :returns: A sorted list of indices into the build_order, which contains
+                  first_steps and all steps placing stems that were placed
+                  relative to the stems built by first_steps.
+        """
+        children = self._build_dependencies(build_order)
+        steps = []
+        to_visit = list(first_steps)
+        while to_visit:
+            step = to_visit.pop()
+            steps.append(step)
+            to_visit.extend(children[build_order[step][2]])
+        return sorted(steps)
+
     def add_to_skip(self):
         '''
         Build a minimum spanning tree of the bulge graph.
@@ -750,9 +997,16 @@ class SpatialModel:
                                end=None, include_start=False, finish_building = True):
         '''
         Build a 3D structure from the graph in self.bg and the stats from self.elem_defs.
-        :param start: Optional; Start building the given element. If it is a stem, build AFTER this stem.
-                      TODO: instead of linear build_order use a tree. Only build leaves dependend on the changed node
 
+        If neither `max_steps` nor `end` is given, only the build steps that
+        depend on `start` (the subtree below `start` in the tree of build
+        dependencies over the minimum spanning tree) are repeated.
+        Otherwise the linear build_order is followed.
+
+        After building, self.moved_elements holds the coarse grained elements
+        whose coordinates were changed.
+
+        :param start: Optional; Start building the given element. If it is a stem, build AFTER this stem.
         :param max_staps: Optional; Build at most that many stems.
         :param end: Optional; End building once the given node is built.
                     If `end` and `max_steps` are given, the criterion that kicks in earlier counts.
@@ -795,26 +1049,52 @@ class SpatialModel:
                         return i
             raise ValueError("{} not found in {}.".format(stemid,build_order))
 
+        self._build_dependencies(build_order)
         nodes = []
+        #: stem -> (rot_mat, translation) if the stem was moved rigidly, None if it was re-placed
+        moved_by = {}
+        #: id(transform) -> list of stems to be moved by this transform
+        pending = {}
+        use_tree = (max_steps == float('inf') and end is None)
         if start == "start" or (start == "s0" and include_start):
             # add the first stem in relation to a non-existent stem
             first_stem = "s0"
-            log.debug("new_traverse_and_build: Setting self.stems[{}] (=first  stem)".format(first_stem))
-            self.stems[first_stem] = self.add_stem(first_stem, self.elem_defs[first_stem], StemModel(),
-                                                   ftms.AngleStat(), (0,1))
-            self.stem_to_coords(first_stem)
+            stats = (None, self.elem_defs[first_stem], None)
+            if not self._is_placed_with(first_stem, stats):
+                log.debug("new_traverse_and_build: Setting self.stems[{}] (=first  stem)".format(first_stem))
+                stem = self.add_stem(first_stem, self.elem_defs[first_stem], StemModel(),
+                                     ftms.AngleStat(), (0,1))
+                self._replace_stem(first_stem, stem, stats, moved_by)
             nodes.append(first_stem)
-            build_step = 0
+            build_steps = list(range(min(max_steps, len(build_order))))
         elif start=="end" or start[0] in "fth":
-            self._finish_building()
+            if start=="end":
+                self.moved_elements = set()
+            else:
+                self.moved_elements = set([start])
+            self._finish_building(self._pop_unfinished_stems())
             return []
         else:
             build_step = buildorder_of(start, include_start)
-            if build_step >= len(build_order):
+            if use_tree:
+                if start[0]=="s" and not include_start:
+                    first_steps = [ i for i, (s1, l, s2) in enumerate(build_order) if s1 == start ]
+                    prev_stem = start
+                else:
+                    first_steps = [build_step]
+                    prev_stem = build_order[build_step][0]
+                build_steps = self._dependent_build_steps(build_order, first_steps)
+            else:
+                if build_step >= len(build_order):
+                    build_steps = []
+                else:
+                    prev_stem = build_order[build_step][0]
+                    build_steps = list(range(build_step, min(build_step+max_steps, len(build_order))))
+            if not build_steps:
+                self.moved_elements = set()
                 if finish_building:
-                    self._finish_building()
+                    self._finish_building(self._pop_unfinished_stems())
                 return []
-            prev_stem = build_order[build_step][0]
             try:
                 log.debug("new_traverse_and_build: Checking self.stems[{}] (=prev_stem)".format(prev_stem))
                 self.stems[prev_stem]
@@ -823,49 +1103,323 @@ class SpatialModel:
                                  "of the structure before {0} have never been built. "
                                  "(The start-option is only for RE-building)".format(start))
 
-        max_build_steps = min(build_step+max_steps, len(build_order))
-        while build_step < max_build_steps:
+        for build_step in build_steps:
             (s1, l, s2) = build_order[build_step]
             nodes += [l, s2]
-            build_step +=1
-
-            prev_stem = self.stems[s1]
-            angle_params = self.elem_defs[l]
-            stem_params = self.elem_defs[s2]
-            ang_type = self.bg.connection_type(l, [s1,s2])
-            connection_ends = self.bg.connection_ends(ang_type)
-
-            # get the direction of the first stem (which is used as a
-            # coordinate system)
-            if connection_ends[0] == 0:
-                (s1b, s1e) = (1, 0)
-            elif connection_ends[0] == 1:
-                (s1b, s1e) = (0, 1)
-
-            log.debug("new_traverse_and_build: Setting self.stems[{}] (connected to {} via {})".format(s2, s1, l))
-            #log.debug("angle_params {}, stem_params {}, ang_type {}, connection_ends {}".format(angle_params, stem_params, ang_type, connection_ends))
-            #log.debug("prev. stem MIDS: {}, TWISTS: {}".format(prev_stem.mids, prev_stem.twists))
-
-            stem = self.add_stem(s2, stem_params, prev_stem,
-                                 angle_params, (s1b, s1e))
-
-            # check which way the newly connected stem was added
-            # if its 1-end was added, the its coordinates need to
-            # be reversed to reflect the fact it was added backwards
-            if connection_ends[1] == 1:
-                self.stems[s2] = stem.reverse()
+            stats = (self.elem_defs[l], self.elem_defs[s2], self._stem_versions.get(s1))
+
+            if self._is_placed_with(s2, stats) and moved_by.get(s1, False) is not None:
+                # The placement relative to s1 did not change.
+                # s2 either stays where it is or moves together with s1.
+                if s1 in moved_by:
+                    transform = moved_by[s1]
+                    moved_by[s2] = transform
+                    pending.setdefault(id(transform), []).append((s1, s2))
             else:
-                self.stems[s2] = stem
-
-            self.stem_to_coords(s2)
+                # s2 has to be placed relative to the new position of s1.
+                self._apply_rigid_transforms(pending, moved_by)
+                stem = self._place_stem(s1, l, s2)
+                stats = stats[:2] + (self._stem_versions[s1],)
+                self._replace_stem(s2, stem, stats, moved_by)
 
             #Optional end-criterion given as a node label.
             if end is not None and end in nodes:
                 break
+        self._apply_rigid_transforms(pending, moved_by)
+        self._set_moved_elements(moved_by.keys())
         if finish_building:
-            self._finish_building()
+            self._finish_building(self._pop_unfinished_stems())
         return nodes
 
+    def _place_stem(self, s1, l, s2):
+        """
+        Place the stem s2 relative to s1, using the stats in self.elem_defs.
+
+        :returns: The new StemModel for s2
+        """
+        prev_stem = self.stems[s1]
+        angle_params = self.elem_defs[l]
+        stem_params = self.elem_defs[s2]
+        ang_type = self.bg.connection_type(l, [s1,s2])
+        connection_ends = self.bg.connection_ends(ang_type)
+
+        # get the direction of the first stem (which is used as a
+        # coordinate system)
+        if connection_ends[0] == 0:
+            (s1b, s1e) = (1, 0)
+        elif connection_ends[0] == 1:
+            (s1b, s1e) = (0, 1)
+
+        log.debug("new_traverse_and_build: Setting self.stems[{}] (connected to {} via {})".format(s2, s1, l))
+        #log.debug("angle_params {}, stem_params {}, ang_type {}, connection_ends {}".format(angle_params, stem_params, ang_type, connection_ends))
+        #log.debug("prev. stem MIDS: {}, TWISTS: {}".format(prev_stem.mids, prev_stem.twists))
+
+        stem = self.add_stem(s2, stem_params, prev_stem,
+                             angle_params, (s1b, s1e))
+
+        # check which way the newly connected stem was added
+        # if its 1-end was added, the its coordinates need to
+        # be reversed to reflect the fact it was added backwards
+        if connection_ends[1] == 1:
+            return stem.reverse()
+        else:
+            return stem
+
+    def _stem_matches_coords(self, stem):
+        """
+        Whether or not self.stems[stem] corresponds to the coordinates stored in self.bg
+        """
+        return (np.array_equal(self.bg.coords[stem], self.stems[stem].mids) and
+                np.array_equal(self.bg.twists[stem], self.stems[stem].twists))
+
+    def _is_placed_with(self, stem, stats):
+        """
+        Whether or not the stem was last placed using the given stats
+        relative to the current version of the previous stem and not changed since.
+
+        :param stats: A tuple (loop stat, stem stat, version of the previous stem)
+        """
+        if self.build_chain or stem not in self.stems:
+            return False
+        try:
+            placed = self._placed_with[stem]
+        except KeyError:
+            return False
+        return (placed[0] is stats[0] and placed[1] is stats[1] and placed[2] == stats[2]
+                and self._stem_matches_coords(stem))
+
+    def _replace_stem(self, stem_name, stem, stats, moved_by):
+        """
+        Store a newly placed stem and record how it moved.
+
+        If the stem has the same geometry as before, stems placed relative to
+        it can later be moved with the same rigid-body transformation.
+        """
+        moved_by[stem_name] = None
+        if (stem_name in self.stems and stem_name in self._placed_with and not self.build_chain
+              and self._placed_with[stem_name][1] is stats[1] and self._stem_matches_coords(stem_name)):
+            moved_by[stem_name] = rigid_transform(self.stems[stem_name], stem)
+        self._set_stem(stem_name, stem)
+        self.stem_to_coords(stem_name)
+        self._placed_with[stem_name] = stats
+        self._unfinished_stems.add(stem_name)
+
+    def _apply_rigid_transforms(self, pending, moved_by):
+        """
+        Move stems (and their virtual residues) by a rigid-body transformation.
+
+        All stems sharing a transformation are moved with a single
+        vectorized operation.
+
+        :param pending: A dict {id(transform): [(previous stem, stem), ...]}.
+                        Will be emptied.
+        :param moved_by: A dict {stem_name: (rot_mat, translation)}
+        """
+        for pairs in pending.values():
+            stems = [ s2 for s1, s2 in pairs ]
+            rot_mat, translation = moved_by[stems[0]]
+            for stem in stems:
+                self._set_stem(stem, self.stems[stem])
+            indices = [ self._stem_indices[stem] for stem in stems ]
+            store = self.stem_store
+            store.mids[indices] = np.dot(store.mids[indices], rot_mat.T) + translation
+            store.twists[indices] = np.dot(store.twists[indices], rot_mat.T)
+            # Virtual residues have to be read before the coordinates in self.bg change.
+            vres = self._transform_virtual_residues(stems, rot_mat, translation)
+            for stem in stems:
+                self.stem_to_coords(stem)
+            self._store_virtual_residues(vres)
+            # The stems are still placed relative to their previous stems.
+            for s1, s2 in pairs:
+                placed = self._placed_with[s2]
+                self._placed_with[s2] = placed[:2] + (self._stem_versions[s1],)
+        pending.clear()
+
+    def _transform_virtual_residues(self, stems, rot_mat, translation):
+        """
+        Calculate the transformed virtual residues of the given stems.
+
+        Stems without complete virtual residues are added to self._unfinished_stems
+        instead.
+
+        :returns: A list of tuples (stem, stem_basis_and_inverse, [(i, position, vectors)]),
+                  where vectors are the rows of vvecs/v_l/v_r, vbases and vinvs.
+        """
+        bg = self.bg
+        complete = []
+        for stem in stems:
+            length = bg.stem_length(stem)
+            if (stem in bg.bases and stem in bg.stem_invs and
+                  all(len(vres.get(stem, ())) == length for vres in (bg.v3dposs, bg.vbases, bg.vinvs))):
+                complete.append(stem)
+            else:
+                self._unfinished_stems.add(stem)
+        if not complete:
+            return []
+        keys = [ (stem, i) for stem in complete for i in range(bg.stem_length(stem)) ]
+        positions = np.array([ bg.v3dposs[stem][i][0] for stem, i in keys ])
+        vectors = np.array([ np.vstack([bg.v3dposs[stem][i][1:], bg.vbases[stem][i], bg.vinvs[stem][i]])
+                             for stem, i in keys ])
+        bases = np.array([ np.vstack([bg.bases[stem], bg.stem_invs[stem]]) for stem in complete ])
+        positions = np.dot(positions, rot_mat.T) + translation
+        vectors = np.dot(vectors, rot_mat.T)
+        bases = np.dot(bases, rot_mat.T)
+        vres = []
+        k = 0
+        for j, stem in enumerate(complete):
+            length = bg.stem_length(stem)
+            vres.append((stem, bases[j], list(zip(range(length), positions[k:k+length], vectors[k:k+length]))))
+            k += length
+        return vres
+
+    def _store_virtual_residues(self, vres):
+        """
+        Store virtual residues calculated by self._transform_virtual_residues in self.bg
+        """
+        bg = self.bg
+        self._own_virtual_residues(stem for stem, bases, residues in vres)
+        for stem, bases, residues in vres:
+            bg.bases[stem] = bases[:3]
+            bg.stem_invs[stem] = bases[3:]
+            for i, position, vectors in residues:
+                bg.v3dposs[stem][i] = (position, vectors[0], vectors[1], vectors[2])
+                bg.vposs[stem][i] = position
+                bg.vvecs[stem][i] = vectors[0]
+                bg.vbases[stem][i] = vectors[3:6]
+                bg.vinvs[stem][i] = vectors[6:9]
+
+    def _own_virtual_residues(self, stems):
+        """
+        Call this before the virtual residues of the given stems are changed or deleted.
+
+        The first time a stem is changed after self.snapshot(), its virtual
+        residue dicts are handed over to the snapshot and replaced by copies.
+        """
+        if self._snapshot is None:
+            return
+        bg = self.bg
+        saved = self._snapshot.vres
+        for stem in stems:
+            if stem in saved:
+                continue
+            saved[stem] = {}
+            for name in _STEM_VRES:
+                vres = getattr(bg, name)
+                saved[stem][name] = vres.get(stem)
+                if stem in vres:
+                    vres[stem] = dict(vres[stem])
+
+    def _pop_unfinished_stems(self):
+        """
+        Return and reset the stems which need new virtual residues.
+        """
+        stems = self._unfinished_stems
+        self._unfinished_stems = set()
+        return stems
+
+    def snapshot(self):
+        """
+        Save the current coordinates and virtual residues.
+
+        The returned object can be passed to self.restore_snapshot to go back to this
+        state without rebuilding the structure. It is only valid as long as the
+        minimal spanning tree does not change and no newer snapshot was taken.
+
+        Stems are saved lazily: The mids and twists of a stem are only copied
+        when it is placed again, its virtual residues when they are recalculated.
+        """
+        bg = self.bg
+        self._snapshot = SpatialModelSnapshot(
+                    elements = list(bg.coords),
+                    twist_elements = list(bg.twists),
+                    coords = bg.coords.get_array(),
+                    twists = bg.twists.get_array(),
+                    stem_rows = {},
+                    stems = dict(self.stems),
+                    bulges = dict(self.bulges),
+                    vres = {},
+                    bases = dict(bg.bases),
+                    stem_invs = dict(bg.stem_invs),
+                    placed_with = dict(self._placed_with),
+                    stem_versions = dict(self._stem_versions),
+                    moved_elements = set(self.moved_elements),
+                    unfinished_stems = set(self._unfinished_stems))
+        return self._snapshot
+
+    def restore_snapshot(self, snapshot):
+        """
+        Go back to the state saved by self.snapshot().
+
+        Only the coarse grained elements whose coordinates differ from the snapshot
+        are reassigned, so the virtual atom cache of all other elements stays valid.
+        The stats in self.elem_defs have to be reverted by the caller,
+        followed by self.save_sampled_elems for the reverted elements.
+
+        :param snapshot: A SpatialModelSnapshot, as returned by the last call to self.snapshot()
+        """
+        if snapshot is not self._snapshot:
+            raise ValueError("Only the snapshot returned by the last call to snapshot() "
+                             "can be restored, and only once.")
+        self._snapshot = None
+        bg = self.bg
+        for storage, saved, names in ((bg.coords, snapshot.coords, snapshot.elements),
+                                      (bg.twists, snapshot.twists, snapshot.twist_elements)):
+            current = storage.get_array()
+            changed = ~((current == saved) | (np.isnan(current) & np.isnan(saved)))
+            for i in np.flatnonzero(changed.reshape(-1, 6).any(axis=1)):
+                storage[names[i]] = saved[2*i:2*i+2]
+        for index, (mids, twists) in snapshot.stem_rows.items():
+            self.stem_store.mids[index] = mids
+            self.stem_store.twists[index] = twists
+        self.stems = dict(snapshot.stems)
+        self.bulges = dict(snapshot.bulges)
+        for stem, saved in snapshot.vres.items():
+            for name, stem_vres in saved.items():
+                vres = getattr(bg, name)
+                if stem_vres is not None:
+                    vres[stem] = stem_vres
+                elif stem in vres:
+                    del vres[stem]
+        bg.bases = snapshot.bases
+        bg.stem_invs = snapshot.stem_invs
+        self._placed_with = snapshot.placed_with
+        self._stem_versions = snapshot.stem_versions
+        self.moved_elements = snapshot.moved_elements
+        self._unfinished_stems = snapshot.unfinished_stems
+
+    def load_state(self, elem_defs, mids, twists):
+        """
+        Take over the structure of another SpatialModel of the same RNA
+        without building it from the stats.
+
+        Only stems whose coordinates change are moved, so the virtual residues
+        of all other stems stay valid. Call self.set_mst first, if the other
+        SpatialModel has a different minimal spanning tree.
+
+        :param elem_defs: The stats the other SpatialModel was built with.
+        :param mids, twists: The stem_store.mids and stem_store.twists of the other SpatialModel.
+        """
+        if not self.bg.build_order:
+            build_order = self.bg.traverse_graph()
+        else:
+            build_order = self.bg.build_order
+        self.elem_defs.clear()
+        self.elem_defs.update(elem_defs)
+        moved = []
+        for stem, i in self._stem_indices.items():
+            if (stem not in self.stems or not np.array_equal(self.stem_store.mids[i], mids[i])
+                  or not np.array_equal(self.stem_store.twists[i], twists[i])):
+                self._set_stem(stem, StemModel(stem, mids[i], twists[i]))
+                self.stem_to_coords(stem)
+                moved.append(stem)
+        # The stems are where new_traverse_and_build would place them with these stats.
+        self._build_dependencies(build_order)
+        self._placed_with = { "s0": (None, self.elem_defs["s0"], None) }
+        for s1, l, s2 in build_order:
+            self._placed_with[s2] = (self.elem_defs[l], self.elem_defs[s2], self._stem_versions[s1])
+        self._set_moved_elements(moved)
+        self._unfinished_stems.update(moved)
+        self._finish_building(self._pop_unfinished_stems())
 
     def ml_stat_deviation(self, ml, stat):
         """
@@ -1000,6 +1554,7 @@ def update_parser(parser):
     sm_options.add_argument('--constraint-energy-clash', type=str, default="CLASH",
                             help="Specify the constraint energies that require the complete\n"
                                  "spatial model for evaluation. Example: The clash energy. \n"
+                                 "(CLASH, or ICLASH which only re-checks moved stems)\n"
                                  "Use N for no energy")
     sm_options.add_argument('--constraint-energy-per-ml', type=str, default="AUTO",
                             help=textwrap.dedent("""\
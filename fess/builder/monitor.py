@@ -784,6 +784,9 @@ class SamplingStatistics:
         self.collector = None
         self.step = 0
         self._outfile = None
+        #: A second file, which receives a copy of every line of out.log, or None.
+        #: Used for the output per temperature, if replicas swap temperatures.
+        self.temperature_outfile = None
 
         collectors = []
         if options == "all":
@@ -907,6 +910,9 @@ class SamplingStatistics:
         else:
             print(line, file=self._outfile)
             self._outfile.flush()
+        if self.temperature_outfile is not None:
+            print(line, file=self.temperature_outfile)
+            self.temperature_outfile.flush()
 
     def print_header(self):
         """
@@ -934,7 +940,8 @@ class SamplingStatistics:
         line = ["{:6d}\t{:10.3f}".format(self.step, energy)]
         if self.options["constituing_energies"] == "no_clash":
             ignore_names = [fbe.RoughJunctionClosureEnergy().shortname,
-                            fbe.StemVirtualResClashEnergy().shortname]
+                            fbe.StemVirtualResClashEnergy().shortname,
+                            fbe.IncrementalStemVirtualResClashEnergy().shortname]
         else:
             ignore_names = []
         line.append("( "+" ".join("{} {:10.3f}".format(*x) for x in member_energies
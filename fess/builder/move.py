@@ -29,6 +29,7 @@ import forgi.threedee.model.stats as ftms
 
 from ..utils import get_all_subclasses
 from . import create
+from ._junction_closure import JunctionClosure
 from ._commandline_helper import replica_substring
 from . import relaxation_builder as fbrel
 
@@ -61,17 +62,15 @@ class Mover:
         self.stat_source = stat_source
         #: A list of tuples  (elemenmt_name, stat)
         self._prev_stats = None
+        #: The state of the SpatialModel before the last move. Used by revert.
+        self._snapshot = None
 
     def _get_elem(self, sm):
-        possible_elements = list(set(sm.bg.defines.keys()) - sm.frozen_elements)
-        # We need to sort here, so using the same seed yields reproducible results
-        # TODO: Think about caching the possible elements
-        possible_elements.sort()
-        return random.choice(possible_elements)
+        return random.choice(sm.topology.movable_elements(sm.frozen_elements))
 
     def _get_elem_and_stat(self, sm):
         elem = self._get_elem(sm)
-        new_stat = self.stat_source.sample_for(sm.bg, elem)
+        new_stat = self.stat_source.sample_for(sm.bg, elem, topology=sm.topology)
         return elem, new_stat
 
     def move(self, sm):
@@ -83,6 +82,7 @@ class Mover:
         log.info("%s move called", type(self).__name__)
         elem, new_stat = self._get_elem_and_stat(sm)
         self._prev_stats = {}
+        self._snapshot = sm.snapshot()
         movestring = self._move(sm, elem, new_stat)
         if elem in sm.bg.get_mst():
             start=elem
@@ -118,12 +118,19 @@ class Mover:
         log.debug("%s Reverting last step", type(self).__name__)
         if self._prev_stats is None:
             raise RuntimeError("No (more) step(s) to revert.")
+        reverted = list(self._prev_stats)
         for elem, stat in self._prev_stats.items():
             assert stat is not None
             log.debug("%s REVERT Assigning %s to %s", type(self).__name__, stat.pdb_name, elem)
             sm.elem_defs[elem] = stat
         self._prev_stats = {}
-        sm.new_traverse_and_build(start='start', include_start = True)
+        if self._snapshot is not None:
+            # Going back to the saved coordinates is much faster than rebuilding.
+            sm.restore_snapshot(self._snapshot)
+            sm.save_sampled_elems(reverted)
+            self._snapshot = None
+        else:
+            sm.new_traverse_and_build(start='start', include_start = True)
 
 class MoveAndRelaxer(Mover):
     def _store_prev_stat(self, sm, elem):
@@ -154,6 +161,7 @@ class MoveAndRelaxer(Mover):
         log.info("%s move called", type(self).__name__)
         elem, new_stat = self._get_elem_and_stat(sm)
         self._prev_stats = {}
+        self._snapshot = sm.snapshot()
         movestring = self._move(sm, elem, new_stat)
         if elem in sm.bg.get_mst():
             start=elem
@@ -191,6 +199,10 @@ class EnergeticJunctionMover(Mover):
                 until the junction constraint energy (if any)
                 for this junction is fulfilled. Use n=-1 for
                 the whole junction"""), 35)
+    #: Stat combinations are checked for junction closure in batches,
+    #: which grow from MIN_BATCH_SIZE to MAX_BATCH_SIZE combinations.
+    MIN_BATCH_SIZE = 16
+    MAX_BATCH_SIZE = 1024
     def __init__(self, n, stat_source, **kwargs):
         n=int(n)
         if n!=-1 and n<1:
@@ -275,6 +287,7 @@ class EnergeticJunctionMover(Mover):
         Called directly by DimerizationBuilder.
         """
         self._prev_stats = {}
+        self._snapshot = sm.snapshot()
         for elem in elems:
             self._store_prev_stat(sm, elem)
 
@@ -350,17 +363,38 @@ class EnergeticJunctionMover(Mover):
         log.debug("For elems %s, loop index is %s, loop is %s", elems, i, whole_loop)
         loop = whole_loop[i:]
         log.info("Loop now %s", loop)
-        for sampled in create.stat_combinations(sm.bg, elems, self.stat_source):
-            counter+=1
-            if self._check_junction(sm, sampled, loop, whole_loop):
-                log.info("Succsessfuly combination found after %d tried", counter)
-                if self.max_tries is not None:
-                    self.max_tries = int(max(self.original_max_tries, self.max_tries*3/4, counter+(self.original_max_tries/2)))
-                    log.info("Setting self.max_tries to %d", self.max_tries)
-                return sampled
-            if counter%10000==0 and counter>0:
+        combinations = create.StatCombinations.for_elems(sm.bg, elems, self.stat_source)
+        closure = JunctionClosure.for_loop(sm, combinations.elems, loop, whole_loop,
+                                           combinations.choices)
+        # Without a JunctionClosure, every combination has to be built one by one.
+        batch_size = 1 if closure is None else self.MIN_BATCH_SIZE
+        while True:
+            if self.max_tries is not None:
+                batch_size = min(batch_size, self.max_tries+1-counter)
+            batch = combinations.draw(batch_size)
+            if not len(batch):
+                self._keep_last_combination(sm, combinations)
+                return None
+            if closure is None:
+                candidates = range(len(batch))
+            else:
+                candidates = np.flatnonzero(closure.closes(batch))
+            for j in candidates:
+                sampled = combinations.combination(batch[j])
+                # Build the candidate, which also verifies it.
+                if self._check_junction(sm, sampled, loop, whole_loop):
+                    # Continue with the random state after this combination
+                    combinations.rewind(j+1)
+                    counter += j+1
+                    log.info("Succsessfuly combination found after %d tried", counter)
+                    if self.max_tries is not None:
+                        self.max_tries = int(max(self.original_max_tries, self.max_tries*3/4, counter+(self.original_max_tries/2)))
+                        log.info("Setting self.max_tries to %d", self.max_tries)
+                    return sampled
+            if (counter+len(batch))//10000 > counter//10000:
                 log.info("Nothing found after %d tries for %s."
-                         "Still searching.", counter, elems)
+                         "Still searching.", counter+len(batch), elems)
+            counter += len(batch)
             if self.max_tries is not None and counter>self.max_tries:
                 # We give up without having exhausted the search space, but we will
                 # try twice as hard next time.
@@ -370,8 +404,24 @@ class EnergeticJunctionMover(Mover):
                 # step, if all other steps would be quick.
                 log.info("Giving up after %d tries this time, setting max_tries to %s.", counter, self.max_tries*2)
                 self.max_tries*=2
+                self._keep_last_combination(sm, combinations)
                 return None
-        return None
+            if closure is not None:
+                batch_size = min(2*batch_size, self.MAX_BATCH_SIZE)
+
+    @staticmethod
+    def _keep_last_combination(sm, combinations):
+        """
+        Assign the stats of the last combination that was drawn, as if every
+        combination had been tried with _check_junction.
+
+        Revert only restores elements which had a stat before, so the broken
+        ml-segment keeps this stat if it had none.
+        """
+        last = combinations.last()
+        if last is not None:
+            for elem, stat in last.items():
+                sm.elem_defs[elem] = stat
 
 
 class RotationMover(Mover):
@@ -0,0 +1,233 @@
+"""
+Opt-in profiling of sampling runs (--profile).
+
+Every sampling process creates a profiler with `from_args` and runs its
+sampling loop inside `Profiler.profile`. Without --profile, this is a no-op.
+The results are written to the sampling output directory as
+profile_<name>.<suffix>, where name is usually the name of the output
+directory of the sampler (e.g. simulation_01 or temperature_02).
+
+Available profilers:
+
+*   cprofile: A deterministic profile from the cProfile module (profile_*.prof),
+    which can be viewed with pstats, snakeviz or similar tools.
+*   sampling: Samples the Python stack every --profile-interval seconds of CPU time.
+    The stacks are written in the collapsed format of flamegraph.pl
+    (profile_*.folded), which is understood by most flamegraph viewers.
+*   timer: Measures the time spent in the phases of every sampling step
+    (profile_*.txt). Objects report their phases to the PhaseTimer in their
+    `phase_timer` attribute.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import cProfile
+import logging
+import os
+import signal
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter  # Python2
+
+from fess.builder import config
+
+log = logging.getLogger(__name__)
+
+
+class NullPhaseTimer(object):
+    """
+    The phase_timer of objects while the timer profiler is not used.
+    """
+    def switch(self, phase):
+        pass
+
+#: The default phase_timer of MCMCSampler and the replica exchange classes.
+NO_TIMER = NullPhaseTimer()
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the wall-clock time spent in named phases.
+    """
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._phase = None
+        self._start = None
+
+    def switch(self, phase):
+        """
+        End the current phase (if any) and start the phase with the given name.
+
+        :param phase: A string or None, to stop timing until the next switch.
+        """
+        now = perf_counter()
+        if self._phase is not None:
+            self.totals[self._phase] += now-self._start
+            self.counts[self._phase] += 1
+        self._phase = phase
+        self._start = now
+
+
+class Profiler(object):
+    """
+    A profiler that does nothing. Base class of all profilers.
+    """
+    suffix = None
+
+    def __init__(self, name, interval=None):
+        """
+        :param name: Used for the name of the output file.
+        :param interval: Only used by the sampling profiler.
+        """
+        self.name = name
+        self.interval = interval
+
+    @property
+    def filename(self):
+        return os.path.join(config.Configuration.sampling_output_dir,
+                            "profile_{}{}".format(self.name, self.suffix))
+
+    @contextmanager
+    def profile(self, *timed):
+        """
+        Profile the with-block and write the result to the sampling output directory.
+
+        :param timed: Objects with a phase_timer attribute (e.g. MCMCSampler),
+                      which report their phases to the timer profiler.
+        """
+        self.start(timed)
+        try:
+            yield
+        finally:
+            self.stop(timed)
+            self.write()
+
+    def start(self, timed):
+        pass
+
+    def stop(self, timed):
+        pass
+
+    def write(self):
+        pass
+
+
+class CProfiler(Profiler):
+    suffix = ".prof"
+
+    def start(self, timed):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self, timed):
+        self._profile.disable()
+
+    def write(self):
+        self._profile.dump_stats(self.filename)
+
+
+class StackSampler(Profiler):
+    """
+    A statistical profiler, which records the Python stack at a SIGPROF signal.
+
+    Only the CPU time of the process is counted, so time spent waiting
+    (e.g. for other replicas) does not show up.
+    It has to be used in the main thread of the process.
+    """
+    suffix = ".folded"
+
+    def start(self, timed):
+        self._stacks = Counter()
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+            frame = frame.f_back
+        self._stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, timed):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def write(self):
+        with open(self.filename, "w") as f:
+            for stack, count in self._stacks.most_common():
+                print("{} {}".format(stack, count), file=f)
+
+
+class PhaseProfiler(Profiler):
+    """
+    Times the phases reported to the phase_timer of the profiled objects.
+    """
+    suffix = ".txt"
+
+    def start(self, timed):
+        self.timer = PhaseTimer()
+        for obj in timed:
+            obj.phase_timer = self.timer
+        self._start = perf_counter()
+
+    def stop(self, timed):
+        self.timer.switch(None)
+        self._elapsed = perf_counter()-self._start
+        for obj in timed:
+            obj.phase_timer = NO_TIMER
+
+    def write(self):
+        rows = sorted(self.timer.totals.items(), key=lambda x: -x[1])
+        rows.append(("other", self._elapsed-sum(self.timer.totals.values())))
+        with open(self.filename, "w") as f:
+            print("Phase\tCalls\tTotal_s\tPer_call_ms\tFraction", file=f)
+            for phase, total in rows:
+                calls = self.timer.counts.get(phase, 0)
+                print("{}\t{}\t{:.3f}\t{}\t{:.3f}".format(phase, calls, total,
+                      "{:.3f}".format(1000*total/calls) if calls else "-",
+                      total/self._elapsed if self._elapsed else 0), file=f)
+            print("total\t-\t{:.3f}\t-\t1.000".format(self._elapsed), file=f)
+
+PROFILERS = {
+    "cprofile": CProfiler,
+    "sampling": StackSampler,
+    "timer": PhaseProfiler
+}
+
+####################################################################################
+# Handling of commandline arguments
+####################################################################################
+def update_parser(parser):
+    profile_options = parser.add_argument_group("Profiling",
+                                                description="Profile the sampling. Every sampling process "
+                                                "writes its own profile_* file to the output directory.")
+    profile_options.add_argument('--profile', choices=sorted(PROFILERS),
+                                 help="cprofile: Deterministic profile (profile_*.prof),\n"
+                                      "          readable with pstats.\n"
+                                      "sampling: Record the Python stack at regular intervals\n"
+                                      "          of CPU time (profile_*.folded, for flamegraphs).\n"
+                                      "timer:    Time spent in the phases of every sampling step\n"
+                                      "          (move, energy, statistics, exchange; profile_*.txt)")
+    profile_options.add_argument('--profile-interval', type=float, default=0.005,
+                                 help="Seconds of CPU time between two stack samples\n"
+                                      "for --profile sampling.")
+
+
+def from_args(args, name):
+    """
+    :param name: Used for the name of the output file.
+    :returns: A Profiler. It does nothing, if --profile was not given.
+    """
+    if args.profile is None:
+        return Profiler(name)
+    if args.profile == "sampling" and not hasattr(signal, "setitimer"):
+        raise ValueError("--profile sampling is not available on this platform")
+    return PROFILERS[args.profile](name, args.profile_interval)
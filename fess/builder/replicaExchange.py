@@ -3,11 +3,17 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
                       int, map, next, oct, open, pow, range, round,
                       str, super, zip)
 
+import ctypes
 import itertools
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Semaphore
+from multiprocessing.sharedctypes import RawArray, RawValue
 import fess.builder.models as fbm
+from fess.builder import config
 import forgi.threedee.model.coarse_grain as ftmc
-from fess.builder.sampling import NoopRevertWarning
+from fess.builder._replica_state import ReplicaStateCodec
+from fess.builder._replica_ladder import AdaptiveLadder, LadderStatistics
+from fess.builder.profiling import NO_TIMER
+import fess.builder.profiling as fbprof
 import logging
 from six.moves import range
 from six.moves import zip
@@ -16,13 +22,11 @@ import os
 import numpy as np
 import random
 import sys
-import cProfile
-import warnings
 import traceback
 
 class ConnectedPipeError(RuntimeError):
     """
-    Cannot query a process, because it errored.
+    Cannot exchange with another replica process, because it errored.
     """
 
 try:
@@ -31,6 +35,16 @@ except ImportError:
     # Python 2
     from contextlib2 import ExitStack, contextmanager
 
+def _reject_exchange(sampler):
+    """
+    Reject the exchange of the structure of sampler.
+
+    Unlike sampler.reject, this does not revert the last Monte Carlo move,
+    which was already accepted or rejected by sampler.step.
+    """
+    sampler.energy_function.reject_last_measure()
+    sampler.prev_energy = sampler.energy_function.eval_accepted_energy(sampler.sm.bg, sampled_stats=sampler.sm.elem_defs)
+
 def try_replica_exchange(sampler1, sampler2):
     sm1 = sampler1.sm
     sm2 = sampler2.sm
@@ -50,23 +64,143 @@ def try_replica_exchange(sampler1, sampler2):
         sampler2.accept(sm1e2)
         movestring = "RE {}<->{};A".format(hex(id(sampler1)), hex(id(sampler2)))
     else:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", NoopRevertWarning)
-            sampler1.reject()
-            sampler2.reject()
+        _reject_exchange(sampler1)
+        _reject_exchange(sampler2)
         movestring = "RE {}xxx{};R".format(hex(id(sampler1)), hex(id(sampler2)))
 
     for sampler in [sampler1, sampler2]:
         sampler.stats_collector.update_statistics(sampler.sm, sampler.prev_energy, sampler.prev_constituing, movestring)
+    return r<=p
+
+
+
+def temperature_parameters(energy_function):
+    """
+    The temperature of a replica: The prefactors of all energies in
+    the CombinedEnergy energy_function.
+    """
+    return [ e.temperature_parameters for e in energy_function.iterate_energies() ]
+
+def set_temperature_parameters(energy_function, parameters):
+    for energy, params in zip(energy_function.iterate_energies(), parameters):
+        energy.temperature_parameters = params
+
+def _set_ladder_parameters(sampler, parameters):
+    """
+    Change the prefactors of the sampler's energy during sampling.
+    """
+    set_temperature_parameters(sampler.energy_function, parameters)
+    sampler.prev_energy = sampler.energy_function.eval_accepted_energy(sampler.sm.bg, sampled_stats=sampler.sm.elem_defs)
+    sampler.prev_constituing = sampler.energy_function.constituing_energies
+
+def ladder_statistics_filename():
+    return os.path.join(config.Configuration.sampling_output_dir, "ladder.txt")
+
+def check_temperature_swap(args, sampler_list):
+    """
+    Raise a ValueError, if the replicas differ in more than the prefactors of
+    their energies, because only the prefactors are exchanged when swapping temperatures.
+    """
+    if fbm.some_replica_different(args):
+        raise ValueError("Temperatures cannot be swapped, if the replicas use "
+                         "different constraint energies.")
+    def energy_types(sampler):
+        return [ (type(e), e.adjustment) for e in sampler.energy_function.iterate_energies() ]
+    for sampler in sampler_list[1:]:
+        if energy_types(sampler)!=energy_types(sampler_list[0]):
+            raise ValueError("Temperatures can only be swapped, if the energies of all replicas "
+                             "differ only in their prefactors. Found {} and {}".format(
+                             sampler_list[0].energy_function.shortname,
+                             sampler.energy_function.shortname))
+
+def try_temperature_swap(sampler1, sampler2):
+    """
+    Like try_replica_exchange, but exchange the temperatures (the energy
+    prefactors) of the samplers instead of their structures.
+
+    The energy functions (including their reference distributions), movers and
+    statistics collectors stay with the structures.
+
+    :returns: True, if the temperatures were exchanged.
+    """
+    parameters1 = temperature_parameters(sampler1.energy_function)
+    parameters2 = temperature_parameters(sampler2.energy_function)
+    set_temperature_parameters(sampler1.energy_function, parameters2)
+    set_temperature_parameters(sampler2.energy_function, parameters1)
+    sm1e2 = sampler1.energy_function.eval_energy(sampler1.sm.bg, sampled_stats=sampler1.sm.elem_defs)
+    sm2e1 = sampler2.energy_function.eval_energy(sampler2.sm.bg, sampled_stats=sampler2.sm.elem_defs)
+    p = np.exp(sampler1.prev_energy + sampler2.prev_energy - sm1e2 - sm2e1)
+    if random.random()<=p:
+        sampler1.accept(sm1e2)
+        sampler2.accept(sm2e1)
+        return True
+    set_temperature_parameters(sampler1.energy_function, parameters1)
+    set_temperature_parameters(sampler2.energy_function, parameters2)
+    _reject_exchange(sampler1)
+    _reject_exchange(sampler2)
+    return False
+
+def _temperature_movestring(temperature, partner_temperature, swapped):
+    if partner_temperature is None:
+        return "RE:T{:02d};R".format(temperature+1)
+    if swapped:
+        return "RE:T{:02d}->T{:02d};A".format(temperature+1, partner_temperature+1)
+    return "RE:T{:02d}xxT{:02d};R".format(temperature+1, partner_temperature+1)
+
+def temperature_outfile_name(temperature):
+    """
+    The out.log, which receives the lines of the replica that currently has
+    the given temperature (starting at 0).
+    """
+    out_dir = os.path.join(config.Configuration.sampling_output_dir,
+                           "temperature_{:02d}".format(temperature+1))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    return os.path.join(out_dir, "out.log")
 
+@contextmanager
+def open_permutation_file(num_replicas):
+    """
+    Open the file recording the temperature of every replica after every exchange round.
+    """
+    with open(os.path.join(config.Configuration.sampling_output_dir, "replica_temperatures.txt"), "w") as f:
+        print("\t".join(["Step"]+["replica_{:02d}".format(i+1) for i in range(num_replicas)]), file=f)
+        yield f
 
+def print_temperatures(f, step, temperatures):
+    print("\t".join(["{:6d}".format(step)]+[ "{:d}".format(t+1) for t in temperatures ]), file=f)
+    f.flush()
 
 class ReplicaExchange(object):
-    def __init__(self, sampler_list):
+    def __init__(self, sampler_list, swap_temperatures=False, adapt_steps=0):
+        """
+        :param swap_temperatures: Exchange the temperatures of the replicas instead
+                                  of their structures. See try_temperature_swap.
+                                  The output directories of the samplers then belong
+                                  to the replicas and the lines of every temperature
+                                  are copied to `temperature_outfile_name`.
+        :param adapt_steps: Adapt the prefactors of the temperatures during the first
+                            adapt_steps steps. See AdaptiveLadder.
+        """
         self.sampler_list = sampler_list
+        self.swap_temperatures = swap_temperatures
+        #: The temperature of every sampler. Only changes, if swap_temperatures is True.
+        self.temperatures = list(range(len(sampler_list)))
+        self.ladder = AdaptiveLadder([ temperature_parameters(s.energy_function) for s in sampler_list ],
+                                     adapt_steps)
+        self.statistics = LadderStatistics(len(sampler_list))
+        #: Receives the time spent on exchanges. See fess.builder.profiling
+        self.phase_timer = NO_TIMER
 
     def run(self, steps):
         with ExitStack() as stack:
+            if self.swap_temperatures:
+                temperature_files = [ stack.enter_context(open(temperature_outfile_name(i), "w"))
+                                      for i in range(len(self.sampler_list)) ]
+                permutation_file = stack.enter_context(open_permutation_file(len(self.sampler_list)))
+                print_temperatures(permutation_file, 0, self.temperatures)
+                for sampler, temperature in zip(self.sampler_list, self.temperatures):
+                    sampler.stats_collector.temperature_outfile = temperature_files[temperature]
             # Open the outfiles of all nstats_colelctors.
             for sampler in self.sampler_list:
                 stack.enter_context(sampler.stats_collector.open_outfile())
@@ -75,66 +209,260 @@ class ReplicaExchange(object):
                     for j, sampler in enumerate(self.sampler_list):
                         log.info("Sampler {}: changing element".format(j))
                         sampler.step()
-                    for j, sampler1 in enumerate(self.sampler_list):
-                        if j+1<len(self.sampler_list):
-                            log.info("Trying Replica exchange")
-                            try_replica_exchange(sampler1, self.sampler_list[j+1])
+                    self.phase_timer.switch("exchange")
+                    if self.swap_temperatures:
+                        self.swap_temperatures_round(i, temperature_files)
+                        print_temperatures(permutation_file, i+1, self.temperatures)
+                    else:
+                        for j, sampler1 in enumerate(self.sampler_list):
+                            if j+1<len(self.sampler_list):
+                                log.info("Trying Replica exchange")
+                                exchanged = try_replica_exchange(sampler1, self.sampler_list[j+1])
+                                self.statistics.record(j, exchanged)
+                    self.statistics.end_round()
+                    if self.ladder.update(self.statistics, i):
+                        for sampler, temperature in zip(self.sampler_list, self.temperatures):
+                            _set_ladder_parameters(sampler, self.ladder.parameters(temperature))
+                    self.phase_timer.switch(None)
             finally:
+                self.statistics.to_file(ladder_statistics_filename(), self.ladder.scales)
                 for sampler in self.sampler_list:
                     sampler.stats_collector.collector.to_file()
+                    sampler.stats_collector.temperature_outfile = None
 
+    def swap_temperatures_round(self, exchange_round, temperature_files):
+        """
+        Try to swap the temperatures of neighboring replicas, alternating between
+        even pairs (0-1, 2-3, ...) and odd pairs (1-2, 3-4, ...) of temperatures.
+        """
+        num_replicas = len(self.sampler_list)
+        replica_at = [ self.temperatures.index(t) for t in range(num_replicas) ]
+        movestrings = [ _temperature_movestring(t, None, False) for t in self.temperatures ]
+        for lower in range(exchange_round%2, num_replicas-1, 2):
+            replica1, replica2 = replica_at[lower], replica_at[lower+1]
+            swapped = try_temperature_swap(self.sampler_list[replica1], self.sampler_list[replica2])
+            self.statistics.record(lower, swapped)
+            movestrings[replica1] = _temperature_movestring(lower, lower+1, swapped)
+            movestrings[replica2] = _temperature_movestring(lower+1, lower, swapped)
+            if swapped:
+                self.temperatures[replica1], self.temperatures[replica2] = lower+1, lower
+        for sampler, temperature, movestring in zip(self.sampler_list, self.temperatures, movestrings):
+            sampler.stats_collector.temperature_outfile = temperature_files[temperature]
+            sampler.stats_collector.update_statistics(sampler.sm, sampler.prev_energy, sampler.prev_constituing, movestring)
 
-class MultiPipeConnection(object):
-    def __init__(self, names, connections):
-        self._connections = { n:c for n,c in zip(names, connections)}
-
-    def send(self, name, object):
-        log.warning("PID {}: Sending {}".format(os.getpid(),name))
-        self._connections[name].send(object)
-    def recv(self, name):
-        log.warning("PID {}: Waiting to receive {}".format(os.getpid(),name))
-        while not self._connections[name].poll(30):
-            if self._connections["error"].poll():
-                e = self._connections["error"].recv()
-                log.error("Waiting in vain. Other process has errored: %s", e)
-                raise ConnectedPipeError("Other process errored. Cannot read {}".format(name))
-            log.warning("PID {}: Still waiting to receive {} from {}".format(os.getpid(),name, self._connections[name]))
-        r =  self._connections[name].recv()
-        log.warning("PID {}: Received {}.".format(os.getpid(), name))
-        return r
-
-    def close(self):
-        for n,c in self._connections.items():
-            try:
-                c.close()
-            except Exception:
-                log.exception("Cannot close pipe %s", n)
-
-def MultiPipe(names):
-    conns1, conns2 = [],[]
-    names = names+["error"]
-    for i in range(len(names)):
-        c1, c2 = Pipe()
-        conns1.append(c1)
-        conns2.append(c2)
-    return MultiPipeConnection(names, conns1), MultiPipeConnection(names, conns2)
+
+#: Seconds between checks of the coordinator, whether all replica processes are still alive.
+POLL_INTERVAL = 1
+
+class SharedReplicaLadder(object):
+    """
+    Shared memory and synchronization for parallel replica exchange.
+
+    Every replica process has a slot with the energy of its structure, the energy
+    of its exchange partner's structure in its own energy function and its state
+    encoded by a ReplicaStateCodec. Replicas only publish a new state, if their
+    structure changed since the last exchange round.
+
+    Every exchange round has two phases. First all replicas publish their energy
+    and state. Then every replica loads the state of its partner and publishes the
+    partner's energy. The coordinator (`coordinate`) waits for all replicas at the
+    end of every phase and decides on all exchanges at once. The pairs alternate
+    between even rounds (0-1, 2-3, ...) and odd rounds (1-2, 3-4, ...).
+
+    If swap_temperatures is True, replicas exchange temperatures instead of
+    structures. Then the slots hold the temperature parameters (energy prefactors)
+    instead of the states, the partners are replicas with neighboring temperatures
+    and the partner energy is the energy of a replica's own structure at the
+    partner's temperature.
+    """
+    def __init__(self, num_replicas, state_capacity, num_parameters=0, swap_temperatures=False):
+        """
+        :param num_replicas: The number of replica processes.
+        :param state_capacity: The maximal size of an encoded state in bytes.
+        :param num_parameters: The number of floats in the temperature parameters of a replica.
+        :param swap_temperatures: Exchange temperatures instead of structures.
+        """
+        self.num_replicas = num_replicas
+        self.state_capacity = state_capacity
+        self.num_parameters = num_parameters
+        self.swap_temperatures = swap_temperatures
+        #: The energy of every replica's structure
+        self.energies = RawArray(ctypes.c_double, num_replicas)
+        #: The energy of the partner's structure in every replica's energy function
+        self.partner_energies = RawArray(ctypes.c_double, num_replicas)
+        #: Whether the exchange of every replica was accepted
+        self.accepted = RawArray(ctypes.c_bool, num_replicas)
+        #: Incremented whenever a replica publishes a new state
+        self.versions = RawArray(ctypes.c_long, num_replicas)
+        #: The temperature of every replica. Only changes, if swap_temperatures is True.
+        self.temperatures = RawArray(ctypes.c_long, list(range(num_replicas)))
+        self._state_sizes = RawArray(ctypes.c_long, num_replicas)
+        self._states = RawArray(ctypes.c_ubyte, num_replicas*state_capacity)
+        self._parameters = RawArray(ctypes.c_double, num_replicas*num_parameters)
+        #: The temperature parameters of every temperature, if the ladder was adapted.
+        self._ladder_parameters = RawArray(ctypes.c_double, num_replicas*num_parameters)
+        #: Incremented whenever the coordinator publishes new ladder parameters.
+        self.ladder_revision = RawValue(ctypes.c_long, 0)
+        #: Set if any process errored. All other processes stop.
+        self.aborted = RawValue(ctypes.c_bool, False)
+        # Released by every replica at the end of every phase
+        self._arrived = Semaphore(0)
+        # Released by the coordinator for every replica after every phase
+        self._proceed = [ Semaphore(0) for i in range(num_replicas) ]
+
+    @staticmethod
+    def partner(replica, exchange_round, num_replicas):
+        """
+        The replica (or temperature), with which replica tries to exchange
+        in the given round, or None, if it does not take part in an exchange.
+        """
+        if (replica - exchange_round)%2==0:
+            partner = replica+1
+        else:
+            partner = replica-1
+        if 0<=partner<num_replicas:
+            return partner
+        return None
+
+    def replica_at(self, temperature):
+        """
+        The replica which currently has the given temperature.
+        """
+        return list(self.temperatures).index(temperature)
+
+    def publish_state(self, replica, state):
+        if len(state)>self.state_capacity:
+            raise ValueError("The state of replica {} has {} bytes, but only {} bytes "
+                             "are available".format(replica, len(state), self.state_capacity))
+        offset = replica*self.state_capacity
+        np.ctypeslib.as_array(self._states)[offset:offset+len(state)] = np.frombuffer(state, np.uint8)
+        self._state_sizes[replica] = len(state)
+        self.versions[replica]+=1
+
+    def read_state(self, replica):
+        offset = replica*self.state_capacity
+        return np.ctypeslib.as_array(self._states)[offset:offset+self._state_sizes[replica]].tobytes()
+
+    def publish_parameters(self, replica, parameters):
+        """
+        :param parameters: A list of tuples of floats, as returned by temperature_parameters
+        """
+        self._write_parameters(self._parameters, replica, parameters)
+
+    def read_parameters(self, replica):
+        return self._read_parameters(self._parameters, replica)
+
+    def publish_ladder(self, parameters):
+        """
+        Called by the coordinator, when the prefactors of the temperatures change.
+
+        :param parameters: The temperature parameters of every temperature.
+        """
+        for temperature, temp_params in enumerate(parameters):
+            self._write_parameters(self._ladder_parameters, temperature, temp_params)
+        self.ladder_revision.value+=1
+
+    def read_ladder(self, temperature):
+        return self._read_parameters(self._ladder_parameters, temperature)
+
+    def _write_parameters(self, array, index, parameters):
+        offset = index*self.num_parameters
+        np.ctypeslib.as_array(array)[offset:offset+self.num_parameters] = np.ravel(parameters)
+
+    def _read_parameters(self, array, index):
+        offset = index*self.num_parameters
+        values = np.ctypeslib.as_array(array)[offset:offset+self.num_parameters]
+        return [ tuple(params) for params in values.reshape((-1, 3)).tolist() ]
+
+    def end_phase(self, replica):
+        """
+        Called by the replica processes after publishing their data.
+        Blocks until the coordinator has processed the data of all replicas.
+        """
+        self._arrived.release()
+        self._proceed[replica].acquire()
+        if self.aborted.value:
+            raise ConnectedPipeError("Another replica process errored.")
+
+    def abort(self):
+        """
+        Called by a replica process, which errored.
+        """
+        self.aborted.value = True
+        self._arrived.release()
+
+    def coordinate(self, processes, num_rounds, after_round=None, statistics=None):
+        """
+        Run the exchange rounds in the coordinating process.
+
+        :param processes: The replica processes, used to detect processes that died.
+        :param num_rounds: The number of exchange rounds performed by the replicas.
+        :param after_round: A function called with the exchange round after all
+                            exchanges of the round were decided, or None.
+                            It may call publish_ladder.
+        :param statistics: A LadderStatistics instance recording all exchanges, or None.
+        :returns: False, if the exchanges were aborted because a replica errored.
+        """
+        for exchange_round in range(num_rounds):
+            if not self._wait_for_replicas(processes):
+                return False
+            self._release_replicas()
+            if not self._wait_for_replicas(processes):
+                return False
+            replica_at = [ self.replica_at(t) for t in range(self.num_replicas) ]
+            for lower in range(exchange_round%2, self.num_replicas-1, 2):
+                replica1, replica2 = replica_at[lower], replica_at[lower+1]
+                old_energy = self.energies[replica1] + self.energies[replica2]
+                exchanged_energy = self.partner_energies[replica1] + self.partner_energies[replica2]
+                p = np.exp(old_energy - exchanged_energy) #np.exp can return inf instead of raising an Overflow error
+                accepted = random.random()<=p
+                self.accepted[replica1] = accepted
+                self.accepted[replica2] = accepted
+                if accepted and self.swap_temperatures:
+                    self.temperatures[replica1] = lower+1
+                    self.temperatures[replica2] = lower
+                if statistics is not None:
+                    statistics.record(lower, accepted)
+            if statistics is not None:
+                statistics.end_round()
+            if after_round is not None:
+                after_round(exchange_round)
+            self._release_replicas()
+        return True
+
+    def _wait_for_replicas(self, processes):
+        for i in range(self.num_replicas):
+            while not self._arrived.acquire(timeout=POLL_INTERVAL):
+                if any(p.exitcode is not None for p in processes):
+                    # The process cannot arrive anymore, so we must not wait for it.
+                    log.error("A replica process exited before the end of the replica exchange.")
+                    self.aborted.value = True
+                    self._release_replicas()
+                    return False
+            if self.aborted.value:
+                self._release_replicas()
+                return False
+        return True
+
+    def _release_replicas(self):
+        for proceed in self._proceed:
+            proceed.release()
 
 class MultiprocessingReProcess(Process):
-    def __init__(self, pipe_lower, pipe_higher, sampler, prev_sm, next_sm, steps, idnr, args, stat_source):
+    def __init__(self, ladder, sampler, prev_sm, next_sm, steps, idnr, args, stat_source):
         """
-        :param pipe_lower:  The end of the pipe connecting to the neighboring process with the lower
-                            temperature
-        :param pipe_higher: The end of the pipe connecting to the neighboring sampler process with
-                            higher temperature.
+        :param ladder: The SharedReplicaLadder connecting all replica processes.
         :param prev_sm: We keep a copy of the neighboring process's sm to avoid the overhead of
-                        always sending a the sm between processes via the pipe.
+                        always sending a the sm between processes.
                         This can save overhead because we expect changes to the sm to be
                         rather infrequent.
         :paramnext_sm: See prev_sm, only for the other neighbor process.
+                       The states of the neighbors are loaded into prev_sm and next_sm
+                       in place, whenever they change.
+                       Both are not used, if the ladder swaps temperatures.
         """
         Process.__init__(self)
-        self.pipe_lower=pipe_lower
-        self.pipe_higher=pipe_higher
+        self.ladder = ladder
         self.sm_lower = prev_sm
         self.sm_higher = next_sm
         self.sampler = sampler
@@ -142,156 +470,230 @@ class MultiprocessingReProcess(Process):
         self.id = idnr
         self.args=args
         self.stat_source=stat_source
+        #: Converts the structures sent to the neighbors to compact binary messages.
+        self.state_codec = ReplicaStateCodec(sampler.sm.bg, stat_source)
+        #: The version of the neighbor's state in sm_lower and sm_higher.
+        #: Version 0 is the initial state passed to the constructor.
+        self._known_versions = {idnr-1:0, idnr+1:0}
+        #: The out.log files of all temperatures, if the ladder swaps temperatures.
+        self._temperature_files = None
+        #: The last ladder_revision of the ladder applied to the energy.
+        self._ladder_revision = 0
+        #: Receives the time spent on exchanges. See fess.builder.profiling
+        self.phase_timer = NO_TIMER
 
     def run_exchange(self):
-        log.warning("Sampler {} running with pid {}. Is lowest? {}".format(self.id, os.getpid(), self.pipe_lower is None))
-        with self.sampler.stats_collector.open_outfile():
+        log.info("Sampler %s running with pid %s", self.id, os.getpid())
+        if fbm.some_replica_different(self.args) and not self.ladder.swap_temperatures:
+            # The structures of the neighbors need the constraint energies of this replica.
+            if self.sm_lower is not None:
+                self.sm_lower = self.sm_for_this_replica(self.sm_lower)
+            if self.sm_higher is not None:
+                self.sm_higher = self.sm_for_this_replica(self.sm_higher)
+        with ExitStack() as stack:
+            if self.ladder.swap_temperatures:
+                # Created by start_parallel_replica_exchange. At every time, only one
+                # process writes to the file of a temperature.
+                self._temperature_files = [ stack.enter_context(open(temperature_outfile_name(i), "a"))
+                                            for i in range(self.ladder.num_replicas) ]
+                self.sampler.stats_collector.temperature_outfile = self._temperature_files[self.id]
+            stack.enter_context(self.sampler.stats_collector.open_outfile())
             try:
                 sm_changed = False
+                exchange_round = 0
                 for step in range(self.steps):
                     changed = self.sampler.step() #Return a boolean indicating if the step was accepted.
                     sm_changed= sm_changed or changed
                     if step%self.args.replica_exchange_every_n==0:
-                        log.error("%s Now trying replica exchange", self.id)
-                        replica_exchanged = False
-                        movestring ="RE:"
-                        if self.pipe_lower is not None:
-                            energy_curr_with_lower = self.recv_energy_with_different_sampler(sm_changed)
-                            energy_lower_with_lower = self.recv_step_result()
-                            energy_lower_with_curr = self.sampler.energy_function.eval_energy(self.sm_lower.bg, sampled_stats=self.sm_lower.elem_defs)
-
-                            old_energy = self.sampler.prev_energy + energy_lower_with_lower
-                            total_exchanged_e = energy_curr_with_lower + energy_lower_with_curr
-                            p = np.exp(old_energy - total_exchanged_e) #np.exp can return inf instead of raising an Overflow error
-                            r=random.random()
-                            if r<=p:
-                                #EXCHANGE
-                                self.sampler.sm, self.sm_lower = self.sm_lower, self.sampler.sm
-                                self.sampler.accept(energy_lower_with_curr)
-                                self.notify_lower_about_exchange(True)
-                                sm_changed = True
-                                replica_exchanged = True
-                                movestring += "lower<>"
-                            else:
-                                #NO EXCHANGE
-                                with warnings.catch_warnings():
-                                    warnings.simplefilter("ignore", NoopRevertWarning)
-                                    self.sampler.reject()
-                                self.notify_lower_about_exchange(False)
-                                movestring += "lowerXX"
-                        movestring+="this"
-                        if self.pipe_higher is not None:
-                            self.send_step_result(sm_changed)
-                            energy_higher_with_curr = self.send_energy_of_different_sm() #Stores sm_higher
-                            if self.recv_exchange_notification():
-                                self.sampler.sm, self.sm_higher = self.sm_higher, self.sampler.sm
-                                self.sampler.accept(energy_higher_with_curr)
-                                replica_exchanged = True
-                                movestring+="<>higher"
-                            else:
-                                with warnings.catch_warnings():
-                                    warnings.simplefilter("ignore", NoopRevertWarning)
-                                    self.sampler.reject()
-                                movestring+="XXhigher"
-                        if replica_exchanged:
-                            movestring+=";A"
+                        self.phase_timer.switch("exchange")
+                        if self.ladder.swap_temperatures:
+                            movestring = self.try_temperature_swap(exchange_round)
                         else:
-                            movestring+=";R"
-                        sm_changed = False
-                        log.error("PID {}: {}, {}".format(os.getpid(), self.sampler.prev_energy, type(self.sampler.prev_energy)))
+                            movestring, sm_changed = self.try_exchange(exchange_round, sm_changed)
+                        exchange_round+=1
+                        self.apply_ladder()
+                        self.phase_timer.switch("statistics")
                         self.sampler.stats_collector.update_statistics(self.sampler.sm, self.sampler.prev_energy, self.sampler.prev_constituing, movestring)
-            except BaseException as e:
-                with open(os.path.join(self.sampler.stats_collector.out_dir, 'exception.log'), "w") as f:
-                    print("Running on python {}, the following error occurred in sampler {} (process {}):".format(sys.version, self.id, os.getpid()), file=f)
-                    print("{}: {}".format(type(e).__name__, str(e)), file=f)
-                    print(str(traceback.format_exc()), file=f)
-                if self.pipe_lower is not None:
-                    self.pipe_lower.send("error", str(e))
-                if self.pipe_higher is not None:
-                    self.pipe_higher.send("error", str(e))
-
-                raise
+                        self.phase_timer.switch(None)
             finally:
-                if self.pipe_lower is not None:
-                    self.pipe_lower.close()
-                if self.pipe_higher is not None:
-                    self.pipe_higher.close()
                 self.sampler.stats_collector.collector.to_file()
+                self.sampler.stats_collector.temperature_outfile = None
 
     def run(self):
-        cProfile.runctx('self.run_exchange()', globals(), locals(), 'prof%d.prof' %self.id)
+        # Any error (including errors during the setup of the sampling)
+        # has to abort the ladder, otherwise the other replicas wait forever.
+        try:
+            profiler = fbprof.from_args(self.args, os.path.basename(self.sampler.stats_collector.out_dir))
+            with profiler.profile(self, self.sampler):
+                self.run_exchange()
+        except BaseException as e:
+            with open(os.path.join(self.sampler.stats_collector.out_dir, 'exception.log'), "w") as f:
+                print("Running on python {}, the following error occurred in sampler {} (process {}):".format(sys.version, self.id, os.getpid()), file=f)
+                print("{}: {}".format(type(e).__name__, str(e)), file=f)
+                print(str(traceback.format_exc()), file=f)
+            self.ladder.abort()
+            raise
 
-    def notify_lower_about_exchange(self, exchange_happened=True):
-        self.pipe_lower.send("exchange_result", exchange_happened)
+    def try_exchange(self, exchange_round, sm_changed):
+        """
+        Take part in one exchange round of the ladder.
 
-    def recv_exchange_notification(self):
-        return self.pipe_higher.recv("exchange_result")
+        :param sm_changed: Whether the structure changed since the last exchange round.
+        :returns: A tuple movestring, exchanged
+        """
+        if sm_changed:
+            self.ladder.publish_state(self.id, self.state_codec.encode(self.sampler.sm))
+        self.ladder.energies[self.id] = self.sampler.prev_energy
+        self.ladder.end_phase(self.id)
+        partner = self.ladder.partner(self.id, exchange_round, self.ladder.num_replicas)
+        if partner is None:
+            self.ladder.end_phase(self.id)
+            return "RE:this;R", False
+        partner_sm = self.partner_sm(partner)
+        energy = self.sampler.energy_function.eval_energy(partner_sm.bg, sampled_stats=partner_sm.elem_defs)
+        self.ladder.partner_energies[self.id] = energy
+        self.ladder.end_phase(self.id)
+        if partner<self.id:
+            movestring = "RE:lower{}this;{}"
+        else:
+            movestring = "RE:this{}higher;{}"
+        if self.ladder.accepted[self.id]:
+            # The old structure of this replica is now the structure of the partner.
+            if partner<self.id:
+                self.sampler.sm, self.sm_lower = self.sm_lower, self.sampler.sm
+            else:
+                self.sampler.sm, self.sm_higher = self.sm_higher, self.sampler.sm
+            self.sampler.accept(energy)
+            return movestring.format("<>", "A"), True
+        _reject_exchange(self.sampler)
+        return movestring.format("XX", "R"), False
 
-    def sm_from_cg_string(self, cg_string):
-        bg = ftmc.CoarseGrainRNA.from_bg_string(cg_string)
-        sm = fbm.from_args(self.args, bg, self.stat_source, self.id)
-        sm.load_sampled_elems(self.stat_source)
-        sm.new_traverse_and_build()
-        return sm
+    def try_temperature_swap(self, exchange_round):
+        """
+        Take part in one exchange round of a ladder, which swaps temperatures.
 
-    def recv_step_result(self):
-        cg_string, energy = self.pipe_lower.recv("step_result")
-        if cg_string is not None:
-            self.sm_lower = self.sm_from_cg_string(cg_string)
-        log.warning("PID {} recv_step_result: Energy {} received".format(os.getpid(), energy))
-        return energy
+        :returns: The movestring
+        """
+        parameters = temperature_parameters(self.sampler.energy_function)
+        self.ladder.publish_parameters(self.id, parameters)
+        self.ladder.energies[self.id] = self.sampler.prev_energy
+        self.ladder.end_phase(self.id)
+        temperature = self.ladder.temperatures[self.id]
+        partner_temperature = self.ladder.partner(temperature, exchange_round, self.ladder.num_replicas)
+        if partner_temperature is None:
+            self.ladder.end_phase(self.id)
+            return _temperature_movestring(temperature, None, False)
+        partner = self.ladder.replica_at(partner_temperature)
+        set_temperature_parameters(self.sampler.energy_function, self.ladder.read_parameters(partner))
+        energy = self.sampler.energy_function.eval_energy(self.sampler.sm.bg, sampled_stats=self.sampler.sm.elem_defs)
+        self.ladder.partner_energies[self.id] = energy
+        self.ladder.end_phase(self.id)
+        if self.ladder.accepted[self.id]:
+            self.sampler.accept(energy)
+            self.sampler.stats_collector.temperature_outfile = self._temperature_files[partner_temperature]
+            return _temperature_movestring(temperature, partner_temperature, True)
+        set_temperature_parameters(self.sampler.energy_function, parameters)
+        _reject_exchange(self.sampler)
+        return _temperature_movestring(temperature, partner_temperature, False)
 
-    def send_step_result(self, changed):
-        if not changed:
-            self.pipe_higher.send("step_result", (None, self.sampler.prev_energy))
+    def apply_ladder(self):
+        """
+        Use the prefactors published by the coordinator, if they changed.
+        """
+        revision = self.ladder.ladder_revision.value
+        if revision!=self._ladder_revision:
+            temperature = self.ladder.temperatures[self.id]
+            _set_ladder_parameters(self.sampler, self.ladder.read_ladder(temperature))
+            self._ladder_revision = revision
+
+    def partner_sm(self, partner):
+        """
+        The SpatialModel of the neighbor, updated to its last published state.
+        """
+        if partner<self.id:
+            sm = self.sm_lower
         else:
-            self.sampler.sm.save_sampled_elems()
-            self.pipe_higher.send("step_result", (self.sampler.sm.bg.to_cg_string(), self.sampler.prev_energy))
+            sm = self.sm_higher
+        version = self.ladder.versions[partner]
+        if self._known_versions[partner]!=version:
+            self.state_codec.decode(self.ladder.read_state(partner), sm)
+            self._known_versions[partner] = version
+        return sm
 
+    def sm_for_this_replica(self, sm):
+        """
+        A copy of the SpatialModel sm with the constraint energies of this replica.
+        """
+        bg = ftmc.CoarseGrainRNA.from_bg_string(sm.bg.to_cg_string())
+        new_sm = fbm.from_args(self.args, bg, self.stat_source, self.id)
+        self.state_codec.decode(self.state_codec.encode(sm), new_sm)
+        return new_sm
 
-    def recv_energy_with_different_sampler(self, changed = True):
-        #Inform lower neighbor process about the changes in the sm
-        if changed:
-            self.pipe_lower.send("exchanged_energy", self.sampler.sm.bg.to_cg_string())
-        else:
-            self.pipe_lower.send("exchanged_energy", None)
-        #Receive energy of our sm with other sampler Temperature
-        energy = self.pipe_lower.recv("exchanged_energy")
-        log.warning("PID {} recv_energy_with_different_sampler: Energy {} received".format(os.getpid(), energy))
-        return energy
-
-    def send_energy_of_different_sm(self):
-        #Receive changed sm from higher temperature neighbor
-        cg_string = self.pipe_higher.recv("exchanged_energy") # RECV <-A
-        if cg_string is not None:
-            self.sm_higher = self.sm_from_cg_string(cg_string)
-        #Calculate energy and send it back
-        e = self.sampler.energy_function.eval_energy(self.sm_higher.bg, sampled_stats=self.sm_higher.elem_defs)
-        self.pipe_higher.send("exchanged_energy", e)
-        return e
-
-def start_parallel_replica_exchange(sampler_list, args, stat_source):
-    prev_conn = None
+def _state_capacity(sm):
+    """
+    The number of bytes reserved for the encoded state of a replica.
+
+    Enough for the stem coordinates, the stat indices and a few kilobytes
+    for pickled stats, which are not part of the stat_source.
+    """
+    num_stems = len(list(sm.bg.stem_iterator()))
+    num_elems = len(sm.bg.defines)
+    return 96*num_stems + 5*num_elems + 1024*num_elems
+
+def start_parallel_replica_exchange(sampler_list, args, stat_source, swap_temperatures=False):
+    """
+    Run one process per replica and coordinate their exchanges from this process.
+
+    :param swap_temperatures: Exchange temperatures instead of structures.
+                              See ReplicaExchange.
+
+    The prefactors are adapted during the first args.replica_exchange_adapt steps.
+    """
+    parameters = [ temperature_parameters(s.energy_function) for s in sampler_list ]
+    adaptive_ladder = AdaptiveLadder(parameters, len(range(0, args.replica_exchange_adapt,
+                                                           args.replica_exchange_every_n)))
+    statistics = LadderStatistics(len(sampler_list))
+    num_parameters = 3*len(parameters[0])
+    if swap_temperatures:
+        ladder = SharedReplicaLadder(len(sampler_list), 0, num_parameters, swap_temperatures=True)
+    else:
+        ladder = SharedReplicaLadder(len(sampler_list), _state_capacity(sampler_list[0].sm), num_parameters)
     processes = []
     for i, sampler in enumerate(sampler_list):
-        if i<len(sampler_list)-1:
-            conn1, conn2 = MultiPipe(["step_result", "exchanged_energy", "exchange_result"])
-        else:
-            conn1=None
-        if i>0:
+        if i>0 and not swap_temperatures:
             prev_sm=sampler_list[i-1].sm
         else:
             prev_sm = None
-        if i+1<len(sampler_list):
+        if i+1<len(sampler_list) and not swap_temperatures:
             next_sm = sampler_list[i+1].sm
         else:
             next_sm = None
-        processes.append(MultiprocessingReProcess(prev_conn, conn1, sampler,
+        processes.append(MultiprocessingReProcess(ladder, sampler,
                                                   prev_sm, next_sm,
                                                   args.iterations, i,
                                                   args, stat_source))
-        prev_conn = conn2
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join() #Block until all subprocesses are done.
+    num_rounds = len(range(0, args.iterations, args.replica_exchange_every_n))
+    with ExitStack() as stack:
+        if swap_temperatures:
+            for i in range(len(sampler_list)):
+                # Truncate the files. The replica processes append to them.
+                open(temperature_outfile_name(i), "w").close()
+            permutation_file = stack.enter_context(open_permutation_file(len(sampler_list)))
+            print_temperatures(permutation_file, 0, ladder.temperatures)
+        def after_round(exchange_round):
+            if swap_temperatures:
+                print_temperatures(permutation_file, exchange_round*args.replica_exchange_every_n+1,
+                                   ladder.temperatures)
+            if adaptive_ladder.update(statistics, exchange_round):
+                ladder.publish_ladder([ adaptive_ladder.parameters(t) for t in range(len(sampler_list)) ])
+        for p in processes:
+            p.start()
+        try:
+            completed = ladder.coordinate(processes, num_rounds, after_round, statistics)
+        finally:
+            for p in processes:
+                p.join() #Block until all subprocesses are done.
+            statistics.to_file(ladder_statistics_filename(), adaptive_ladder.scales)
+    if not completed or any(p.exitcode!=0 for p in processes):
+        raise ConnectedPipeError("Replica exchange failed, because a replica process errored. "
+                                 "See exception.log in the output directory of the replica.")
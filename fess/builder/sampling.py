@@ -9,6 +9,8 @@ import logging
 import random
 import math
 
+from fess.builder.profiling import NO_TIMER
+
 log=logging.getLogger(__name__)
 class NoopRevertWarning(UserWarning):
     pass
@@ -49,6 +51,9 @@ class MCMCSampler:
         #: Keep track of the number of performed sampling steps.
         self.step_counter = 0
 
+        #: Receives the phases of every step. See fess.builder.profiling
+        self.phase_timer = NO_TIMER
+
     def eval_energy(self):
         if self.sm.fulfills_constraint_energy():
             if self.sm.constraint_energy is None:
@@ -80,18 +85,23 @@ class MCMCSampler:
         """
         self.step_counter += 1
         if self.rerun_prev_energy:
+            self.phase_timer.switch("energy")
             # The energy of staying may get worse with every reject step
             self.prev_energy = self.energy_function.eval_energy(self.sm.bg , sampled_stats=self.sm.elem_defs)
         #Make a sinle move (i.e. change the Spatial Model)
+        self.phase_timer.switch("move")
         movestring = self.mover.move(self.sm)
         # Accept or reject the new spatial model based on the energy.
         # This stores the new energy as self.prev_energy
+        self.phase_timer.switch("energy")
         ms, accepted = self.accept_reject()
         movestring += ms
+        self.phase_timer.switch("statistics")
         self.stats_collector.update_statistics( self.sm, self.prev_energy,
                                                 self.prev_constituing, movestring,
                                                 self.last_clashes,
                                                 self.last_bad_mls )
+        self.phase_timer.switch(None)
         return accepted
 
     def accept_reject(self):
@@ -135,6 +145,8 @@ class MCMCSampler:
         self.prev_energy = energy
         self.prev_constituing =  self.energy_function.constituing_energies
         self.energy_function.accept_last_measure()
+        if self.sm.constraint_energy is not None:
+            self.sm.constraint_energy.commit_step()
         for e in self.energy_function.iterate_energies():
             if hasattr(e, "accepted_projDir"):
                 self.sm.bg.project_from=e.accepted_projDir
@@ -145,6 +157,8 @@ class MCMCSampler:
 
     def reject(self):
         self.energy_function.reject_last_measure()
+        if self.sm.constraint_energy is not None:
+            self.sm.constraint_energy.rollback_step()
         try:
             self.mover.revert(self.sm)
         except RuntimeError as e:
@@ -152,5 +166,6 @@ class MCMCSampler:
             #This warning will be ignored in ReplicaExchangeSimulations
             warnings.warn(e.message, NoopRevertWarning)
         # We need to recaluculate the prev_energy, because Energy might have been recalibrated.
-        log.debug("MCMCSampler After rejecting: reject calling eval_energy again")
-        self.prev_energy = self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+        # Only the contributions that changed are evaluated again.
+        log.debug("MCMCSampler After rejecting: reject calling eval_accepted_energy")
+        self.prev_energy = self.energy_function.eval_accepted_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
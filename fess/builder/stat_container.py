@@ -6,6 +6,7 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 import sys
 import random
 import math
+import bisect
 from collections import defaultdict
 import logging
 import string
@@ -20,6 +21,7 @@ import forgi.threedee.model.stats as ftmstats
 from fess import data_file
 from fess.builder import config
 import fess.motif.annotate as fma
+from ._stats_cache import load_cached
 from six.moves import range
 from six.moves import zip
 
@@ -95,7 +97,13 @@ def parse_stats_file(file_handle):
             stats[key][stat.bp_length].append(stat)
     return stats
 
-def read_stats_file(filename):
+def read_stats_file(filename, cache_dir=None):
+    """
+    :param cache_dir: If given, use a binary cache of the parsed stats in this directory.
+                      See fess.builder._stats_cache
+    """
+    if cache_dir is not None:
+        return load_cached(filename, cache_dir, read_stats_file)
     log.info("Reading stats-file %s", filename)
     with open (filename) as f:
         try:
@@ -140,39 +148,129 @@ def make_continuous( discrete_angle_stats):
     except np.linalg.LinAlgError as lae:
         print("Singular matrix, dimensions:", dims, file=sys.stderr)
 
-class ContinuouseStatSampler:
+class ContinuousAngleStat(ftmstats.AngleStat):
+    """
+    An AngleStat drawn from a continuous distribution.
+
+    Its pdb_name is only formatted from the parameters when it is accessed,
+    e.g. for writing the stat to a file.
+    """
+    def __init__(self, key, u, v, t, r1, u1, v1):
+        super(ContinuousAngleStat, self).__init__(stat_type="angle", pdb_name=None,
+                                                  dim1=key[0], dim2=key[1],
+                                                  u=u, v=v, t=t, r1=r1, u1=u1, v1=v1,
+                                                  ang_type=key[2], define=[], seq="", vres={})
+
+    @property
+    def pdb_name(self):
+        if self._pdb_name is None:
+            self._pdb_name = 'cont-{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}'.format(
+                                    self.u, self.v, self.t, self.r1, self.u1, self.v1)
+        return self._pdb_name
+
+    @pdb_name.setter
+    def pdb_name(self, value):
+        self._pdb_name = value
+
+class ContinuouseStatSampler(object):
     def __init__(self, all_stats, key):
-        kde = make_continuous(all_stats)
-        self.kde = kde
+        import scipy.stats as ss
         self.key = key
         data=[]
         for d in all_stats:
             data += [[d.u, d.v, d.t, d.r1, d.u1, d.v1]]
         self.data = np.array(data)
+        if len(self.data) < 3:
+            raise ValueError("Insufficient stats to make continuouse")
+        #: Only the distance r1 is sampled from the data, the angles are uniform.
+        self.r1_kde = ss.gaussian_kde(self.data[:, 3])
+        self._kde = None
+
+    @property
+    def kde(self):
+        """
+        The six-dimensional KDE of the data. Only created on demand.
+        """
+        if self._kde is None:
+            import scipy.stats as ss
+            self._kde = ss.gaussian_kde(self.data.T)
+        return self._kde
+
     def sample(self):
-        import scipy.stats as ss
-        log.debug("DATA %s with shape %s", self.data, self.data.shape)
-        r1 = ss.gaussian_kde(self.data[:, 3]).resample(1)[0][0]
-        log.debug("r1 is %s", r1)
-        rnd = np.random.rand(5) # 5 random values from 0 to 1
-        u = rnd[0]*np.pi
-        v = rnd[1]*2*np.pi-np.pi
-        t = rnd[2]*2*np.pi-np.pi
-        u1 = rnd[3]*np.pi
-        v1 = rnd[4]*2*np.pi-np.pi
-
-        #sample = self.kde.resample(1).T
-        log.debug("continuouse stat sample %s", (u,v,t,r1,u1,v1))
-        #u,v,t,r1,u1,v1 = sample[0]
-        stat = ftmstats.AngleStat(stat_type="angle", pdb_name='cont-{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}'.format(u,v,t,r1,u1,v1),
-                                dim1=self.key[0], dim2=self.key[1], u=u, v=v, t=t, r1=r1, u1=u1, v1=v1,
-                                ang_type=self.key[2], define=[], seq="", vres={})
-        return stat
+        """
+        :returns: A single ContinuousAngleStat
+        """
+        return self.sample_many(1)[0]
+
+    def sample_many(self, n):
+        """
+        Draw n stats with one call to numpy's random module per parameter set.
+
+        :returns: A list of n ContinuousAngleStats
+        """
+        r1 = self.r1_kde.resample(n)[0]
+        rnd = np.random.rand(n, 5) # 5 random values from 0 to 1 per sample
+        u = rnd[:,0]*np.pi
+        v = rnd[:,1]*2*np.pi-np.pi
+        t = rnd[:,2]*2*np.pi-np.pi
+        u1 = rnd[:,3]*np.pi
+        v1 = rnd[:,4]*2*np.pi-np.pi
+        params = np.column_stack((u, v, t, r1, u1, v1)).tolist()
+        return [ ContinuousAngleStat(self.key, *p) for p in params ]
+
+class WeightedStats(object):
+    """
+    Sample from a list of stats with the given weights.
+
+    The cumulative weights are precomputed, so drawing a stat takes
+    O(log n) time instead of scanning all weights.
+    """
+    def __init__(self, weights, stats):
+        """
+        :param weights: A list of non-negative floats
+        :param stats: A list of stats of the same length
+        """
+        if len(weights) != len(stats) or not stats:
+            raise ValueError("Need the same, non-zero number of weights and stats.")
+        self.stats = stats
+        self.cumulative_weights = np.cumsum(weights).tolist()
+        self.total_weight = self.cumulative_weights[-1]
+        self._cumulative_array = None
+
+    def sample(self):
+        """
+        :returns: A single stat. Uses the random module.
+        """
+        r = random.uniform(0, self.total_weight)
+        i = bisect.bisect_left(self.cumulative_weights, r)
+        return self.stats[min(i, len(self.stats)-1)]
+
+    def sample_many(self, n):
+        """
+        :param n: The number of stats to draw (with replacement).
+        :returns: A list of n stats. Uses numpy's random module.
+        """
+        if self._cumulative_array is None:
+            self._cumulative_array = np.array(self.cumulative_weights)
+        r = np.random.uniform(0, self.total_weight, n)
+        indices = np.minimum(np.searchsorted(self._cumulative_array, r, side="left"),
+                             len(self.stats)-1)
+        return [ self.stats[i] for i in indices ]
 
 
 class StatStorage(object):
-    def __init__(self, filename, fallback_filenames = None, continuouse=None, blacklist=[]):
+    def __init__(self, filename, fallback_filenames = None, continuouse=None, blacklist=[],
+                 cache_dir=None):
+        """
+        :param cache_dir: The directory for the binary cache of parsed stats files.
+                          If it is None, config.Configuration.stats_cache_dir is used.
+                          Use False to always parse the stats files.
+        """
         self.filename = filename
+        if cache_dir is None:
+            cache_dir = config.Configuration.stats_cache_dir
+        #: The cache directory or None, if the stats files are not cached.
+        self.cache_dir = cache_dir or None
         if fallback_filenames is None:
             fallback_filenames = []
         self.fallbacks = fallback_filenames
@@ -213,10 +311,10 @@ class StatStorage(object):
 
     def _iter_stat_sources(self):
         if self._sources is None:
-            self._sources = [read_stats_file(self.filename)]
+            self._sources = [read_stats_file(self.filename, self.cache_dir)]
         for i in range(len(self.fallbacks)+1):
             if i>=len(self._sources):
-                self._sources.append(read_stats_file(self.fallbacks[i-1]))
+                self._sources.append(read_stats_file(self.fallbacks[i-1], self.cache_dir))
             yield self._sources[i]
 
     @lru_cache(maxsize = 128)
@@ -288,7 +386,7 @@ class StatStorage(object):
             self._has_reported.add((stat_type, key, min_entries))
         return weights, choose_from
 
-    def sample_for(self, bg, elem, min_entries = 100):
+    def sample_for(self, bg, elem, min_entries = 100, topology = None):
         """
         Sample a stat for the given coarse-grained element elem of bulge graph bg.
 
@@ -305,35 +403,67 @@ class StatStorage(object):
         :param elem: The element name, e.g. "s0"
         :param min_entries: If less than min-entries stats are found, try to use
                     the fallback-files to gather enough stats to sample from.
+        :param topology: None or the fess.builder.models.TopologyIndex of bg,
+                    which caches the possible stats for elem.
         :param return: A single Stat object, sampled from the possible stats.
         """
         if elem in self.continuouse:
             return self._sample_continuouse_stat(bg, elem, min_entries)
+        elif topology is not None:
+            return topology.weighted_stats(self, elem, min_entries).sample()
         else:
+            # TODO: Penalize stats found with JARED, but for another loop
+            return self.weighted_stats_for(bg, elem, min_entries).sample()
+
+    def weighted_stats_for(self, bg, elem, min_entries = 100, key = None):
+        """
+        The possible stats for an element and their weights.
+
+        :param key: The result of self.key_from_bg_and_elem(bg, elem), if known
+        :returns: A WeightedStats instance
+        """
+        if key is None:
             key = self.key_from_bg_and_elem(bg, elem)
-            log.debug("Calling _possible_stats with %r, %r", letter_to_stat_type[elem[0]], key)
-            weights, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries)
-            r = random.uniform(0, sum(weights))
-            for i, w in enumerate(weights):
-                if r<=w:
-                    # TODO: Penalize stats found with JARED, but for another loop
-                    return stats[i]
-                r-=w
-            assert False
-            return stats[0] #Fallback if asserts are disabled. Should be unreachable.
-
-    def _sample_continuouse_stat(self, bg, elem, min_entries=100):
+        log.debug("Calling _possible_stats with %r, %r", letter_to_stat_type[elem[0]], key)
+        return self._weighted_stats(letter_to_stat_type[elem[0]], key, min_entries)
+
+    def sample_many(self, bg, elem, n, min_entries = 100):
+        """
+        Like sample_for, but draw n stats at once.
+
+        :returns: A list of n stats, sampled with replacement.
+        """
+        if elem in self.continuouse:
+            return self._sample_continuouse_stat(bg, elem, min_entries, n)
+        return self.weighted_stats_for(bg, elem, min_entries).sample_many(n)
+
+    @lru_cache(maxsize = 256)
+    def _weighted_stats(self, stat_type, key, min_entries):
+        """
+        :returns: A WeightedStats instance for the result of self._possible_stats
+        """
+        weights, stats = self._possible_stats(stat_type, key, min_entries)
+        return WeightedStats(weights, stats)
+
+    def _sample_continuouse_stat(self, bg, elem, min_entries=100, n=None):
+        """
+        :param n: If given, return a list of n stats instead of a single stat.
+        """
         key = self.key_from_bg_and_elem(bg, elem)
-        kde = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
-        return kde.sample()
+        sampler = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
+        if n is None:
+            return sampler.sample()
+        return sampler.sample_many(n)
 
-    def _iterate_continuouse_stat(self, bg, elem, min_entries=100):
+    def _iterate_continuouse_stat(self, bg, elem, min_entries=100, batch_size=100):
         key = self.key_from_bg_and_elem(bg, elem)
-        kde = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
+        sampler = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
         log.debug("Starting to iterate continuouse stats")
         while True:
-            yield kde.sample()
+            for stat in sampler.sample_many(batch_size):
+                yield stat
 
+    @lru_cache(maxsize = 256)
     def _get_statsampler(self, stat_type, key, min_entries):
         log.debug("Getting continuouse kde-based sampler for %s", key)
         all_stats = list(self.iterate_stats(stat_type, key, min_entries, False))
@@ -352,11 +482,20 @@ class StatStorage(object):
             if not cycle:
                 break  # Exhaust the generator
 
-    def load_stat_by_name(self, bg, elem, name):
-        key = self.key_from_bg_and_elem(bg, elem)
+    def all_stats_for(self, bg, elem, key=None):
+        """
+        All stats that can be used for the element, in a fixed order.
 
+        :param key: The stat key of the element, if it is already known.
+        """
+        if key is None:
+            key = self.key_from_bg_and_elem(bg, elem)
         _, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries=float('inf'),
                                         enable_logging=False)
+        return stats
+
+    def load_stat_by_name(self, bg, elem, name):
+        stats = self.all_stats_for(bg, elem)
         found = None
         for stat in stats:
             if stat.pdb_name == name:
@@ -434,9 +573,11 @@ def seq_and_pyrpur_similarity(sequences, stat):
     return score
 
 class SequenceDependentStatStorage(StatStorage):
-    def __init__(self, filename, fallback_filenames = None, sequence_score = seq_and_pyrpur_similarity):
+    def __init__(self, filename, fallback_filenames = None, sequence_score = seq_and_pyrpur_similarity,
+                 cache_dir=None):
         self.sequence_score = sequence_score
-        super(SequenceDependentStatStorage, self).__init__(filename, fallback_filenames)
+        super(SequenceDependentStatStorage, self).__init__(filename, fallback_filenames,
+                                                           cache_dir=cache_dir)
 
     @staticmethod
     def key_from_bg_and_elem(bg, elem):
@@ -523,6 +664,10 @@ def update_parser(parser):
                                 'or multiloops. The stats of these elements will be sampled from'
                                 ' a continuouse distribution. EXPERIMENTAL, DONT USE THIS.')
     stat_options.add_argument('--blacklist-stats', type=str, help="A comma seperate list of pdb-ids. Disallow stats from these pdb ids.")
+    stat_options.add_argument('--no-stats-cache', action="store_true",
+                              help="Always parse the stats files. By default, parsed stats files\n"
+                                   " are cached in the directory given by\n"
+                                   " fess.builder.config.Configuration.stats_cache_dir")
 
 def from_args(args, cg):
     if args.sequence_based:
@@ -534,6 +679,8 @@ def from_args(args, cg):
         kwargs["continuouse"] = args.continuouse_stats.split(",")
     if args.blacklist_stats:
         kwargs["blacklist"] = args.blacklist_stats.split(",")
+    if args.no_stats_cache:
+        kwargs["cache_dir"] = False
     if args.jar3d:
         jared_out    = op.join(config.Configuration.sampling_output_dir, "jar3d.stats")
         jared_tmp    = op.join(config.Configuration.sampling_output_dir, "jar3d")
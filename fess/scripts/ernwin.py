@@ -24,6 +24,7 @@ import fess.builder.monitor as fbm
 import fess.builder.move as fbmov
 import fess.builder._other_movers
 import fess.builder.replicaExchange as fbr
+import fess.builder.profiling as fbprof
 import fess.builder.builder as fbb
 import fess.builder.models as fbmodel
 import fess.builder.sampling as fbs
@@ -43,6 +44,24 @@ parser.add_argument('--seed', action='store',
 parser.add_argument('-i', '--iterations', action='store', default=10000, help='Number of structures to generate', type=int)
 parser.add_argument('--replica-exchange', type=int, help="Experimental")
 parser.add_argument('--replica-exchange-every-n', type=int, default=1, help="After how many steps try a replica exchange?")
+parser.add_argument('--replica-exchange-swap', choices=["structures", "temperatures"], default="structures",
+                    help="What replicas exchange.\n"
+                         "structures: Exchange the structures between the temperatures.\n"
+                         "temperatures: Exchange the energy prefactors and leave the\n"
+                         "              structures in place. The energies of the\n"
+                         "              replicas may differ only in their prefactors.\n"
+                         "              The output of every replica goes to replica_NN,\n"
+                         "              the output per temperature to temperature_NN/out.log\n"
+                         "              and the temperature of every replica to\n"
+                         "              replica_temperatures.txt")
+parser.add_argument('--replica-exchange-adapt', type=int, default=0, metavar="STEPS",
+                    help="Adapt the prefactors of the replicas during the first STEPS\n"
+                         "sampling steps, until exchanges between all neighboring\n"
+                         "temperatures are accepted equally often.\n"
+                         "The energies of all replicas have to be the same up to a\n"
+                         "factor, which decreases from the first to the last replica.\n"
+                         "The prefactors of the first and last replica stay fixed.\n"
+                         "Acceptance rates for the final ladder are written to ladder.txt")
 parser.add_argument('--parallel', action="store_true",
                     help="Spawn parallel processes.\n"
                          "Only used if either --replica-exchange or --num_builds\n"
@@ -68,7 +87,7 @@ parser.add_argument('--reference', action='store', type=str,
 
 
 # Each of the following modules of ernwin adds its own options to the parser.
-for module in [fbstat, fess.directory_utils, fbe, fbmov, fbm, fbb, fbmodel]:
+for module in [fbstat, fess.directory_utils, fbe, fbmov, fbm, fbb, fbmodel, fbprof]:
     module.update_parser(parser)
 
 
@@ -141,18 +160,22 @@ def run(args, cg, main_dir, reference_cg):
             samplers.append(sampler)
             if not args.replica_exchange and args.parallel:
                 p = multiprocessing.Process(target=sample_one_trajectory,
-                                            args = (sampler, args.iterations))
+                                            args = (sampler, args.iterations, args))
                 processes.append(p)
                 p.start()
     if not args.parallel and not args.replica_exchange:
         for sampler in samplers:
-            sample_one_trajectory(sampler, args.iterations)
+            sample_one_trajectory(sampler, args.iterations, args)
     elif args.replica_exchange:
+        swap_temperatures = args.replica_exchange_swap=="temperatures"
+        if swap_temperatures:
+            fbr.check_temperature_swap(args, samplers)
         if args.parallel:
-            fbr.start_parallel_replica_exchange(samplers, args, stat_source)
+            fbr.start_parallel_replica_exchange(samplers, args, stat_source, swap_temperatures)
         else:
-            re = fbr.ReplicaExchange(samplers)
-            re.run(args.iterations)
+            re = fbr.ReplicaExchange(samplers, swap_temperatures, args.replica_exchange_adapt)
+            with fbprof.from_args(args, "replica_exchange").profile(re, *samplers):
+                re.run(args.iterations)
 
     # Join all processes, if any were started.
     for p in processes:
@@ -161,8 +184,9 @@ def run(args, cg, main_dir, reference_cg):
 #if args.reconstruct:
 #    raise NotImplementedError("TODO")
 
-def sample_one_trajectory(sampler, iterations):
-    with sampler.stats_collector.open_outfile():
+def sample_one_trajectory(sampler, iterations, args):
+    profiler = fbprof.from_args(args, os.path.basename(sampler.stats_collector.out_dir))
+    with profiler.profile(sampler), sampler.stats_collector.open_outfile():
         for i in range(iterations):
             sampler.step()
         sampler.stats_collector.collector.to_file()
@@ -202,7 +226,13 @@ def setup_sampler(args, sm, stat_source, sampling_energy, replica_nr=None, origi
     else:
         show_min_rmsd=False
     mover = fbmov.from_args(args, stat_source, sm, replica_nr)
-    if args.replica_exchange:
+    if args.replica_exchange and args.replica_exchange_swap=="temperatures":
+        # The temperature of this sampler changes during sampling.
+        out_dir = os.path.join(config.Configuration.sampling_output_dir,
+                          "replica_{:02d}".format(replica_nr+1))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+    elif args.replica_exchange:
         out_dir = os.path.join(config.Configuration.sampling_output_dir,
                           "temperature_{:02d}".format(replica_nr+1))
         if not os.path.exists(out_dir):
@@ -213,6 +243,8 @@ def setup_sampler(args, sm, stat_source, sampling_energy, replica_nr=None, origi
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
+    if args.spill_measures:
+        sampling_energy.spill_measures(out_dir)
     monitor = fbm.from_args(args, original_cg, sampling_energy, stat_source, out_dir, show_min_rmsd)
     sampler = fbs.MCMCSampler(sm, sampling_energy, mover, monitor)
     return sampler
@@ -0,0 +1,12 @@
+"""
+Stats files parsed by the tests are cached in a temporary directory,
+which is removed when the tests finish.
+"""
+import atexit
+import shutil
+import tempfile
+
+from fess.builder import config
+
+config.Configuration.stats_cache_dir = tempfile.mkdtemp(prefix="ernwin_test_stats_cache")
+atexit.register(shutil.rmtree, config.Configuration.stats_cache_dir, True)
@@ -10,13 +10,16 @@ import sys
 import random
 from six.moves import range
 try:
-    from unittest.mock import Mock #python3
+    from unittest import mock #python3
+    from unittest.mock import Mock
 except:
+    import mock
     from mock import Mock
 
 # Scientific import
 import numpy as np
 import pandas as pd
+import scipy.stats
 
 import numpy.testing as nptest
 
@@ -27,6 +30,7 @@ import forgi.threedee.utilities.vector as ftuv
 
 import fess.builder.energy as fbe
 from fess.builder.energy_abcs import EnergyFunction, CoarseGrainEnergy
+from fess.builder._kde import TabulatedKDE
 import fess.builder.models as fbm
 from fess.builder.stat_container import StatStorage
 
@@ -116,6 +120,65 @@ class TestClashEnergy(unittest.TestCase):
         print(self.energy.bad_bulges)
         self.assertEqual(self.energy.bad_bulges, [("s1", "s11"), ("s0", "s11"), ("s11", "s2")])
 
+class TestIncrementalClashEnergy(unittest.TestCase):
+    def setUp(self):
+        self.cg=ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-structure1.coord')
+        self.cg_clash=ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-clash.coord')
+        self.cg.add_all_virtual_residues()
+        self.cg_clash.add_all_virtual_residues()
+        self.full_energy=fbe.StemVirtualResClashEnergy()
+        self.energy=fbe.IncrementalStemVirtualResClashEnergy()
+
+    def test_same_as_full_energy(self):
+        for cg in [self.cg, self.cg_clash]:
+            self.assertAlmostEqual(self.energy.eval_energy(cg),
+                                   self.full_energy.eval_energy(cg))
+            self.assertEqual(sorted(self.energy.bad_bulges),
+                             sorted(self.full_energy.bad_bulges))
+        self.assertEqual(self.energy.eval_energy(self.cg_clash, nodes=["s0", "s1"]), 0.)
+        with self.assertRaises(KeyError):
+            self.energy.eval_energy(self.cg, nodes=["s220", "s9"])
+
+    def test_only_moved_stems_rechecked(self):
+        self.energy.eval_energy(self.cg_clash)
+        self.energy.accept_last_measure()
+        old_pairs = dict(self.energy._pair_cache)
+        start, end = self.cg_clash.coords["s11"]
+        self.cg_clash.coords["s11"] = start + 100., end + 100.
+        self.cg_clash.add_all_virtual_residues()
+        e = self.energy.eval_energy(self.cg_clash)
+        self.assertAlmostEqual(e, self.full_energy.eval_energy(self.cg_clash))
+        self.assertEqual(e, 0.)
+        for key, val in self.energy._pair_cache.items():
+            if "s11" in key:
+                self.assertNotEqual(val[:2], old_pairs[key][:2])
+            else:
+                self.assertIs(val, old_pairs[key])
+
+    def test_far_stems_not_rechecked(self):
+        self.energy.eval_energy(self.cg_clash)
+        self.energy.accept_last_measure()
+        start, end = self.cg_clash.coords["s11"]
+        self.cg_clash.coords["s11"] = start + 1000., end + 1000.
+        self.cg_clash.add_all_virtual_residues()
+        with mock.patch.object(self.energy, "_pair_clashes",
+                               wraps=self.energy._pair_clashes) as pair_clashes:
+            self.assertEqual(self.energy.eval_energy(self.cg_clash), 0.)
+        # s11 has no neighbors in the spatial index anymore.
+        self.assertEqual(pair_clashes.call_count, 0)
+        self.assertEqual(self.energy._neighbors("s11"), set())
+
+    def test_reject_restores_cache(self):
+        e_clash = self.energy.eval_energy(self.cg_clash)
+        self.energy.accept_last_measure()
+        old_pairs = dict(self.energy._pair_cache)
+        old_grid = { cell: set(stems) for cell, stems in self.energy._grid.items() }
+        self.energy.eval_energy(self.cg)
+        self.energy.reject_last_measure()
+        self.assertEqual(self.energy._pair_cache, old_pairs)
+        self.assertEqual(dict(self.energy._grid), old_grid)
+        self.assertAlmostEqual(self.energy.eval_energy(self.cg_clash), e_clash)
+
 class TestJunctionConstraintEnergy(unittest.TestCase):
     def setUp(self):
         self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
@@ -418,6 +481,19 @@ class TestCoarseGrainEnergyABC(unittest.TestCase):
         e._resample_background_kde.assert_not_called()
         e.reject_last_measure()
         e._resample_background_kde.assert_called_once_with()
+    def test_background_kde_is_updated_incrementally(self):
+        e = self.energy_function
+        e._last_measure = 5
+        for i in range(3):
+            e.accept_last_measure()
+        kde = e._background_kde
+        self.assertEqual(len(kde), len(e.accepted_measures))
+        nptest.assert_allclose(e.reference_distribution([1,10,100]),
+                               scipy.stats.gaussian_kde(e.accepted_measures)([1,10,100]), rtol=0.01)
+        for i in range(3):
+            e.reject_last_measure()
+        self.assertIs(e._background_kde, kde)
+        self.assertEqual(len(kde), len(e.accepted_measures))
     def test_reset_distribution(self):
         e = self.energy_function
         orig_target = e.target_distribution([1,10,100])
@@ -483,6 +559,59 @@ class TestCombinedEnergy(unittest.TestCase):
         self.assertTrue(e.hasinstance(int))
         self.assertTrue(e.hasinstance(float))
         self.assertFalse(e.hasinstance(str))
+    def test_eval_accepted_energy_only_reevaluates_changed(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        rog = fbe.RadiusOfGyrationEnergy(cg.seq_length)
+        const = fbe.ConstantEnergy(3)
+        e = fbe.CombinedEnergy([rog, const])
+        energy = e.eval_energy(cg)
+        e.accept_last_measure()
+        rog.eval_energy = Mock(wraps=rog.eval_energy)
+        const.eval_energy = Mock(wraps=const.eval_energy)
+        e.reject_last_measure()
+        self.assertEqual(e.eval_accepted_energy(cg), energy)
+        rog.eval_energy.assert_not_called()
+        const.eval_energy.assert_not_called()
+        # In the third step, the reference distribution is resampled.
+        e.reject_last_measure()
+        energy = e.eval_accepted_energy(cg)
+        constituing = e.constituing_energies
+        self.assertEqual(rog.eval_energy.call_count, 1)
+        const.eval_energy.assert_not_called()
+        self.assertAlmostEqual(energy, e.eval_energy(cg))
+        self.assertEqual(constituing, e.constituing_energies)
+    def test_eval_accepted_energy_for_different_structure(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        rog = fbe.RadiusOfGyrationEnergy(cg.seq_length)
+        e = fbe.CombinedEnergy([rog])
+        e.eval_energy(cg)
+        e.accept_last_measure()
+        add_stem_coordinates(cg, "s0", [100., 0., 0.])
+        rog.eval_energy = Mock(wraps=rog.eval_energy)
+        self.assertAlmostEqual(e.eval_accepted_energy(cg), e.eval_energy(cg))
+        self.assertEqual(rog.eval_energy.call_count, 2)
+    def test_geometry_shared_between_contributions(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        e = fbe.CombinedEnergy([fbe.RadiusOfGyrationEnergy(cg.seq_length),
+                                fbe.CombinedEnergy([fbe.NormalDistributedRogEnergy(cg.seq_length, 35)])])
+        with mock.patch.object(cg, "radius_of_gyration", wraps=cg.radius_of_gyration) as rog:
+            energy = e.eval_energy(cg)
+        self.assertEqual(rog.call_count, 1)
+        # A new evaluation does not use old values
+        add_stem_coordinates(cg, "s0", [100., 0., 0.])
+        self.assertNotEqual(e.eval_energy(cg), energy)
+    def test_empty_energy_without_caching(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        e = fbe.CombinedEnergy([])
+        self.assertEqual(e.eval_energy(cg, nodes=["s0"]), 0.)
+        self.assertEqual(e.eval_energy(cg, background=False), 0.)
+    def test_verbose_prints_every_contribution(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        e = fbe.CombinedEnergy([fbe.ConstantEnergy(3), fbe.RadiusOfGyrationEnergy(cg.seq_length)])
+        with mock.patch("fess.builder.energy.print", create=True) as printed:
+            e.eval_energy(cg, verbose=True)
+        names = [ call[0][1] for call in printed.call_args_list if len(call[0])==3 ]
+        self.assertEqual(names, ["3CNST", "ROG"])
 
 
 
@@ -512,6 +641,58 @@ class TestGyrationRadiusEnergies(unittest.TestCase):
         energyfunction.accept_last_measure()
         self.assertEqual(energyfunction.accepted_measures[-1], self.cg.radius_of_gyration("fast"))
 
+    def test_ROG_tabulated_target_follows_adjustment(self):
+        energyfunction = fbe.RadiusOfGyrationEnergy(self.cg.seq_length, adjustment=1.0)
+        energyfunction._adj_stepwidth = 0.2
+        energyfunction._update_adj()
+        ref = scipy.stats.gaussian_kde(np.asarray(energyfunction.target_values)*1.2)
+        xs = np.linspace(10, 60, 20)
+        nptest.assert_allclose(energyfunction.target_distribution(xs), ref(xs), rtol=10**-3)
+        exact = fbe.RadiusOfGyrationEnergy(self.cg.seq_length, adjustment=1.2, kde_tolerance=0)
+        self.assertIsNone(exact.kde_tolerance)
+        self.assertAlmostEqual(energyfunction.eval_energy(self.cg), exact.eval_energy(self.cg),
+                               places=3)
+
+    def test_kde_tolerance_only_for_created_energies(self):
+        default = fbe.CoarseGrainEnergy.kde_tolerance
+        exact, = fbe.EnergyFunction.from_string("ROG", cg=self.cg, kde_tolerance=0)
+        self.assertIsNone(exact.kde_tolerance)
+        self.assertNotIsInstance(exact.reference_distribution, TabulatedKDE)
+        self.assertEqual(fbe.CoarseGrainEnergy.kde_tolerance, default)
+        tabulated, = fbe.EnergyFunction.from_string("ROG", cg=self.cg)
+        self.assertEqual(tabulated.kde_tolerance, default)
+        self.assertIsInstance(tabulated.reference_distribution, TabulatedKDE)
+
+class TestPDDEnergy(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        self.cg.add_all_virtual_residues()
+        self.energy = fbe.PDDEnergy.from_cg(None, None, "R", self.cg, "__cg__", gnom_unit="A")
+
+    def test_pair_distance_counts(self):
+        points = np.random.RandomState(1).normal(0, 20, size=(300, 3))
+        dists, counts = ftuv.pair_distance_distribution(list(points), 2.)
+        nptest.assert_array_equal(fbe.pair_distance_counts(points, 2.), counts)
+        with mock.patch.object(fbe, "PDD_BLOCKSIZE", 1000):
+            nptest.assert_array_equal(fbe.pair_distance_counts(points, 2.), counts)
+            split = fbe.pair_distance_counts(points[:100], 2., points[100:])
+            for part in [points[:100], points[100:]]:
+                split = fbe._add_counts(split, fbe.pair_distance_counts(part, 2.))
+            nptest.assert_array_equal(split, counts)
+
+    def test_incremental_pdd_same_as_full(self):
+        self.energy.eval_energy(self.cg)
+        start, end = self.cg.coords["s11"]
+        self.cg.coords["s11"] = start + 10., end + 10.
+        self.cg.add_all_virtual_residues()
+        dists, counts = self.energy.get_pdd_incremental(self.cg)
+        ref_dists, ref_counts = self.energy.get_pdd(self.cg, "R", self.energy._stepwidth)
+        nptest.assert_array_equal(counts, ref_counts)
+        nptest.assert_array_equal(dists, ref_dists)
+        energy = self.energy.eval_energy(self.cg)
+        self.energy._pdd_cache = None
+        self.assertEqual(self.energy.eval_energy(self.cg), energy)
+
 class TestProjectionMatchEnergySetup(unittest.TestCase):
     def test_ProjectionMatchEnergy_init(self):
         try:
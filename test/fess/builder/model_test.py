@@ -482,6 +482,36 @@ class TestModifyingMSTWithoutLoadSampledElements(unittest.TestCase):
         # Commented out: With newer versions, the elem_defs can aldo contain info about broken segments.
         # self.assertNotIn( "m3", sm.elem_defs)
 
+class TestTopologyIndex(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = stat_container.StatStorage('test/fess/data/real.stats')
+        self.sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/4way.cg'))
+
+    def test_topology_is_cached(self):
+        self.assertIs(self.sm.topology, self.sm.topology)
+
+    def test_stat_key(self):
+        for elem in self.sm.bg.defines:
+            self.assertEqual(self.sm.topology.stat_key(self.stat_source, elem),
+                             self.stat_source.key_from_bg_and_elem(self.sm.bg, elem))
+
+    def test_movable_elements(self):
+        movable = self.sm.topology.movable_elements(set(["s0", "m1"]))
+        self.assertEqual(movable, sorted(movable))
+        self.assertNotIn("s0", movable)
+        self.assertNotIn("m1", movable)
+        self.assertEqual(len(movable), len(self.sm.bg.defines)-2)
+        self.assertEqual(self.sm.topology.movable_elements(set()), sorted(self.sm.bg.defines))
+
+    def test_changing_mst_invalidates_topology(self):
+        old_topology = self.sm.topology
+        self.sm.set_multiloop_break_segment("m1")
+        self.assertNotIn("m1", self.sm.bg.mst)
+        self.assertIsNot(self.sm.topology, old_topology)
+        for elem in self.sm.bg.mloop_iterator():
+            self.assertEqual(self.sm.topology.stat_key(self.stat_source, elem),
+                             self.stat_source.key_from_bg_and_elem(self.sm.bg, elem))
+
 class TestModel(unittest.TestCase):
     def setUp(self):
         self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
@@ -602,6 +632,76 @@ class TestNewTraverse(unittest.TestCase):
         self.sm.new_traverse_and_build()
         self.assertGreater(ftmsim.cg_stem_rmsd(self.sm.bg, self.cg_copy), 0)
 
+    def test_new_traverse_and_build_only_rebuilds_subtree(self):
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["m0"] = self.stat_source.sample_for(self.cg, "m0")
+        sm_full = copy.deepcopy(self.sm)
+        sm_full.new_traverse_and_build()
+        nodes = self.sm.new_traverse_and_build(start="m0", include_start=True)
+        self.assertEqual(nodes, ["m0", "s1", "i0", "s2"])
+        self.assertEqual(self.sm.moved_elements, set(nodes) | self.cg.edges["s1"] | self.cg.edges["s2"])
+        for elem in self.cg.defines:
+            nptest.assert_allclose(self.sm.bg.coords[elem], sm_full.bg.coords[elem])
+        for stem in self.cg.stem_iterator():
+            nptest.assert_allclose(self.sm.bg.twists[stem], sm_full.bg.twists[stem])
+            for i in range(self.cg.stem_length(stem)):
+                nptest.assert_allclose(self.sm.bg.v3dposs[stem][i], sm_full.bg.v3dposs[stem][i])
+
+    def test_new_traverse_and_build_moves_subtree_rigidly(self):
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["m3"] = self.stat_source.sample_for(self.cg, "m3")
+        self.sm.new_traverse_and_build(start="m3", include_start=True)
+        # Building from scratch gives the same coordinates
+        sm_new = fbm.SpatialModel(copy.deepcopy(self.sm.bg))
+        sm_new.elem_defs = self.sm.elem_defs
+        sm_new.new_traverse_and_build()
+        for elem in self.cg.defines:
+            nptest.assert_allclose(self.sm.bg.coords[elem], sm_new.bg.coords[elem], atol=10**-8)
+        # The transformed virtual residues are the same as recalculated ones
+        for stem in self.cg.stem_iterator():
+            nptest.assert_allclose(self.sm.bg.twists[stem], sm_new.bg.twists[stem], atol=10**-8)
+            nptest.assert_allclose(self.sm.bg.stem_invs[stem], sm_new.bg.stem_invs[stem], atol=10**-8)
+            for i in range(self.cg.stem_length(stem)):
+                nptest.assert_allclose(self.sm.bg.v3dposs[stem][i], sm_new.bg.v3dposs[stem][i], atol=10**-8)
+                nptest.assert_allclose(self.sm.bg.vbases[stem][i], sm_new.bg.vbases[stem][i], atol=10**-8)
+                nptest.assert_allclose(self.sm.bg.vinvs[stem][i], sm_new.bg.vinvs[stem][i], atol=10**-8)
+
+    def test_new_traverse_and_build_after_partial_build(self):
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["m3"] = self.stat_source.sample_for(self.cg, "m3")
+        # Only s5 is placed, the stems placed relative to s5 are not updated.
+        self.sm.new_traverse_and_build(start="m3", max_steps=1)
+        self.sm.new_traverse_and_build()
+        sm_new = fbm.SpatialModel(copy.deepcopy(self.sm.bg))
+        sm_new.elem_defs = self.sm.elem_defs
+        sm_new.new_traverse_and_build()
+        for elem in self.cg.defines:
+            nptest.assert_allclose(self.sm.bg.coords[elem], sm_new.bg.coords[elem], atol=10**-8)
+
+    def test_new_traverse_and_build_unchanged_stats_do_not_move(self):
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["i2"] = self.stat_source.sample_for(self.cg, "i2")
+        self.sm.new_traverse_and_build()
+        self.assertEqual(self.sm.moved_elements,
+                         set(["s10", "s11", "s12", "i2", "i3", "i4"]))
+        self.sm.new_traverse_and_build()
+        self.assertEqual(self.sm.moved_elements, set())
+
+    def test_new_traverse_and_build_start_s_builds_all_children(self):
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+        nodes = self.sm.new_traverse_and_build(start="s5")
+        self.assertEqual(set(nodes), set(["m8", "s7", "m4", "s6", "m7", "s8", "i1", "s9",
+                                          "i2", "s10", "i3", "s11", "i4", "s12"]))
+        # Stems are built in build order
+        expected = [ elem for s1, l, s2 in self.sm.bg.build_order for elem in (l, s2) if elem in nodes ]
+        self.assertEqual(nodes, expected)
+        self.assertEqual(self.sm.new_traverse_and_build(start="s12"), [])
+
     def test_new_traverse_and_build_steps_really_builds(self):
         self.sm.load_sampled_elems(stat_source=self.stat_source)
         #We need to traverse_and_build at least once from the start!
@@ -611,6 +711,57 @@ class TestNewTraverse(unittest.TestCase):
         self.sm.new_traverse_and_build(max_steps=5)
         self.assertGreater(ftmsim.cg_stem_rmsd(self.sm.bg, self.cg_copy), 0)
 
+class TestStemStore(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/4GXY_A.cg')
+        self.sm = fbm.SpatialModel(self.cg)
+        self.stat_source = stat_container.StatStorage('test/fess/data/real.stats')
+        self.sm.load_sampled_elems(stat_source=self.stat_source)
+        self.sm.new_traverse_and_build()
+
+    def test_stems_are_views_into_store(self):
+        for stem in self.cg.stem_iterator():
+            nptest.assert_array_equal(self.sm.stems[stem].mids, self.cg.coords[stem])
+            self.assertTrue(np.shares_memory(self.sm.stems[stem].mids, self.sm.stem_store.mids))
+            self.assertTrue(np.shares_memory(self.sm.stems[stem].twists, self.sm.stem_store.twists))
+
+    def test_deepcopy_keeps_views(self):
+        sm_copy = copy.deepcopy(self.sm)
+        self.assertTrue(np.shares_memory(sm_copy.stems["s1"].mids, sm_copy.stem_store.mids))
+        self.assertFalse(np.shares_memory(sm_copy.stems["s1"].mids, self.sm.stem_store.mids))
+
+    def test_snapshot_copies_only_changed_stems(self):
+        # With cached virtual atoms, forgi deletes the virtual residues of moved stems.
+        self.cg.virtual_atoms(1)
+        vres_old = { stem: self.sm.bg.v3dposs[stem] for stem in self.cg.stem_iterator() }
+        mids_old = np.copy(self.sm.stem_store.mids)
+        snapshot = self.sm.snapshot()
+        self.sm.elem_defs["i0"] = self.stat_source.sample_for(self.cg, "i0")
+        self.sm.new_traverse_and_build(start="i0")
+        moved = set(self.cg.stem_iterator()) & self.sm.moved_elements
+        self.assertEqual(set(snapshot.stem_rows), set(self.sm._stem_indices[stem] for stem in moved))
+        self.assertEqual(set(snapshot.vres), moved)
+        for stem in self.cg.stem_iterator():
+            if stem not in moved:
+                self.assertIs(self.sm.bg.v3dposs[stem], vres_old[stem])
+        self.sm.restore_snapshot(snapshot)
+        nptest.assert_array_equal(self.sm.stem_store.mids, mids_old)
+        for stem in self.cg.stem_iterator():
+            self.assertIs(self.sm.bg.v3dposs[stem], vres_old[stem])
+
+    def test_only_last_snapshot_restored(self):
+        snapshot = self.sm.snapshot()
+        self.sm.snapshot()
+        with self.assertRaises(ValueError):
+            self.sm.restore_snapshot(snapshot)
+
+    def test_standalone_stem_model(self):
+        stem = fbm.StemModel("s0", mids=(np.array([0.,0.,0.]),np.array([0.,0.,10.])))
+        self.assertFalse(hasattr(stem, "__dict__"))
+        nptest.assert_array_equal(stem.reverse().mids, [[0.,0.,10.], [0.,0.,0.]])
+        nptest.assert_array_equal(stem.mids, [[0.,0.,0.], [0.,0.,10.]])
+        self.assertAlmostEqual(stem.length(), 10.)
+
 class ReconstructionTests(unittest.TestCase):
     def test_get_stem_rotation_matrix(self):
         stem1 = fbm.StemModel(mids=(np.array([0.,0.,0.]),np.array([0.,0.,10.])), twists=(np.array([0., 1., 0.]),np.array([0., -1., 0.])))
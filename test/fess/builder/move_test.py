@@ -144,6 +144,35 @@ class TestMoverBaseClassPublicAPI(unittest.TestCase):
             log.info(self.mover.move(self.sm))
             self.mover.revert(self.sm)
             self.assertEqual(self.sm.bg.coords, coords_old)
+    def test_revert_restores_snapshot_without_rebuild(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg")
+        sm = SpatialModel(cg)
+        sm.sample_stats(self.stat_source_real)
+        sm.new_traverse_and_build()
+        for i in range(5):
+            coords_old = sm.bg.coords.get_array()
+            twists_old = sm.bg.twists.get_array()
+            vres_old = { stem: dict(sm.bg.v3dposs[stem]) for stem in sm.bg.stem_iterator() }
+            self.mover.move(sm)
+            moved_elems = list(self.mover._prev_stats)
+            with mock.patch.object(sm, "new_traverse_and_build") as build, \
+                 mock.patch.object(sm, "save_sampled_elems", wraps=sm.save_sampled_elems) as save:
+                self.mover.revert(sm)
+            self.assertFalse(build.called)
+            # Only the reverted elements are saved again
+            save.assert_called_once_with(moved_elems)
+            sampled = dict(sm.bg.sampled)
+            sm.save_sampled_elems()
+            self.assertEqual(sm.bg.sampled, sampled)
+            nptest.assert_array_equal(sm.bg.coords.get_array(), coords_old)
+            nptest.assert_array_equal(sm.bg.twists.get_array(), twists_old)
+            for stem in sm.bg.stem_iterator():
+                nptest.assert_array_equal(sm.stems[stem].mids, sm.bg.coords[stem])
+                for j, vres in vres_old[stem].items():
+                    nptest.assert_array_equal(sm.bg.v3dposs[stem][j][0], vres[0])
+        # A full rebuild does not change the reverted structure
+        sm.new_traverse_and_build(start="start")
+        nptest.assert_allclose(sm.bg.coords.get_array(), coords_old)
 
 class TestConvenienceFunctions(unittest.TestCase):
     def setUp(self):
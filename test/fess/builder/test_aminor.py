@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.classification.aminor as ftca
+
+import fess.builder.aminor as fba
+
+
+class TestBatchedInteractions(unittest.TestCase):
+    def setUp(self):
+        self.cgs = [ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg'),
+                    ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/pseudoknot.cg')]
+
+    def test_potential_interactions_same_as_forgi(self):
+        for cg in self.cgs:
+            stems = list(cg.stem_iterator())
+            for loop_type in "ih":
+                ref_geos, ref_labels = ftca.potential_interactions(cg, loop_type)
+                loops = [ loop for loop in cg.defines
+                          if loop[0]==loop_type and 'A' in "".join(cg.get_define_seq_str(loop)) ]
+                geos, labels = fba.potential_interactions(cg, loops, stems)
+                self.assertGreater(len(geos), 0)
+                self.assertEqual([list(l) for l in labels], [list(l) for l in ref_labels])
+                nptest.assert_allclose(geos, ref_geos, atol=10**-10)
+
+    def test_all_interactions_same_as_forgi(self):
+        for cg in self.cgs:
+            self.assertEqual(sorted(map(tuple, fba.all_interactions(cg))),
+                             sorted(map(tuple, ftca.all_interactions(cg))))
+
+    def test_no_loops(self):
+        cg = self.cgs[0]
+        geos, labels = fba.potential_interactions(cg, [], list(cg.stem_iterator()))
+        self.assertEqual(len(geos), 0)
+        self.assertEqual(len(labels), 0)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import unittest
+import random
 import logging
 
 
@@ -23,3 +24,33 @@ class TestBitarray(unittest.TestCase):
         log.error(all_sampled)
         self.assertEqual(len(all_sampled), 210)
         self.assertIn("aB2%", all_sampled)
+
+class TestStatCombinations(unittest.TestCase):
+    def setUp(self):
+        self.choices = {"lc":"abcde", "uc": "ABC", "num": "12", "sym": "!@#$%^&"}
+
+    def test_same_as_stat_combinations(self):
+        random.seed(2)
+        expected = list(fbc._sample_unique_stat_combinations(self.choices))
+        random.seed(2)
+        combinations = fbc.StatCombinations(self.choices)
+        drawn = []
+        for n in [1, 16, 64, 256]:
+            drawn += [ combinations.combination(row) for row in combinations.draw(n) ]
+        self.assertEqual(drawn, expected)
+        self.assertEqual(len(combinations.draw(5)), 0)
+
+    def test_rewind(self):
+        random.seed(2)
+        gen = fbc._sample_unique_stat_combinations(self.choices)
+        expected = [next(gen) for _ in range(13)]
+        state = random.getstate()
+        random.seed(2)
+        combinations = fbc.StatCombinations(self.choices)
+        batch = combinations.draw(10)
+        batch = combinations.draw(20)
+        combinations.rewind(3)
+        self.assertEqual(random.getstate(), state)
+        self.assertEqual(combinations.last(), expected[-1])
+        # The rewound combinations can be drawn again
+        self.assertEqual(sum(len(combinations.draw(50)) for _ in range(10)), 210-13)
@@ -0,0 +1,47 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.utilities.vector as ftuv
+
+from fess.builder._geometry_cache import GeometryCache, segment_distances
+import fess.builder.energy as fbe
+
+
+class TestSegmentDistances(unittest.TestCase):
+    def test_same_as_line_segment_distance(self):
+        random = np.random.RandomState(1)
+        starts = random.normal(0, 10, size=(30, 3))
+        ends = starts + random.normal(0, 10, size=(30, 3))
+        # Parallel and degenerate segments
+        starts[1], ends[1] = starts[0] + 1, ends[0] + 1
+        ends[2] = starts[2]
+        matrix = segment_distances(starts, ends, starts[:20], ends[:20])
+        self.assertEqual(matrix.shape, (30, 20))
+        for i in range(30):
+            for j in range(20):
+                ref = ftuv.vec_distance(*ftuv.line_segment_distance(starts[i], ends[i],
+                                                                    starts[j], ends[j]))
+                self.assertAlmostEqual(matrix[i, j], ref)
+
+
+class TestGeometryCache(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+
+    def test_segment_distance_matrix(self):
+        geometry = GeometryCache(self.cg)
+        hloops = list(self.cg.hloop_iterator())
+        matrix, index = geometry.segment_distance_matrix(hloops)
+        self.assertIs(geometry.segment_distance_matrix(hloops)[0], matrix)
+        for h1 in hloops:
+            self.assertAlmostEqual(fbe._minimal_h_h_distance(self.cg, h1, hloops, geometry),
+                                   min(matrix[index[h1], index[h2]] for h2 in hloops if h2!=h1))
+        self.assertEqual(fbe._minimal_h_h_distance(self.cg, "h0", ["h0"]), float("inf"))
@@ -0,0 +1,133 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import itertools as it
+import random
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.utilities.vector as ftuv
+
+import fess.builder.create as fbc
+import fess.builder.models as fbm
+import fess.builder.move as fbmov
+from fess.builder.stat_container import StatStorage
+from fess.builder._junction_closure import JunctionClosure, _SpatialHash
+
+
+class TestJunctionClosure(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = StatStorage("test/fess/data/real.stats")
+        random.seed(1)
+        self.sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/4way.cg"))
+        self.sm.sample_stats(self.stat_source)
+        self.sm.new_traverse_and_build()
+        self.mover = fbmov.EnergeticJunctionMover(-1, self.stat_source)
+        self.use_asserts = ftuv.USE_ASSERTS
+        ftuv.USE_ASSERTS = False
+
+    def tearDown(self):
+        ftuv.USE_ASSERTS = self.use_asserts
+
+    def closure_for(self, elems):
+        whole_loop = self.mover._sort_loop(self.sm, list(self.sm.bg.shortest_mlonly_multiloop(elems[0])))
+        loop = whole_loop[min(whole_loop.index(elem) for elem in elems):]
+        combinations = fbc.StatCombinations.for_elems(self.sm.bg, elems, self.stat_source)
+        closure = JunctionClosure.for_loop(self.sm, combinations.elems, loop, whole_loop,
+                                           combinations.choices)
+        return closure, combinations, loop, whole_loop
+
+    def assert_same_as_check_junction(self, elems, n):
+        closure, combinations, loop, whole_loop = self.closure_for(elems)
+        batch = combinations.draw(n)
+        closes = closure.closes(batch)
+        expected = [ self.mover._check_junction(self.sm, combinations.combination(indices),
+                                                loop, whole_loop)
+                     for indices in batch ]
+        nptest.assert_array_equal(closes, expected)
+        return closes
+
+    def test_same_as_check_junction_whole_loop(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX30[1FJC1]", self.stat_source)
+        elems = self.mover._get_elements(self.sm)
+        closes = self.assert_same_as_check_junction(elems, 300)
+        self.assertTrue(0 < np.sum(closes) < 300)
+
+    def test_same_as_check_junction_part_of_loop(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX30[1FJC1]", self.stat_source)
+        whole_loop = self.mover._get_elements(self.sm)
+        # The stat of the broken segment is taken from elem_defs
+        broken = whole_loop[-1]
+        self.sm.elem_defs[broken] = self.stat_source.sample_for(self.sm.bg, broken)
+        self.assert_same_as_check_junction(whole_loop[1:3], 300)
+
+    def assert_closing_combinations_complete(self, elems):
+        closure, combinations, _, _ = self.closure_for(elems)
+        all_indices = np.array(list(it.product(*[range(len(c)) for c in combinations.choices])))
+        expected = set(map(tuple, all_indices[closure.closes(all_indices)].tolist()))
+        self.assertEqual(closure.closing_combinations(), expected)
+        return expected
+
+    def test_closing_combinations_part_of_loop(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX30[1FJC1]", self.stat_source)
+        whole_loop = self.mover._get_elements(self.sm)
+        broken = whole_loop[-1]
+        self.sm.elem_defs[broken] = self.stat_source.sample_for(self.sm.bg, broken)
+        self.assertGreater(len(self.assert_closing_combinations_complete(whole_loop[1:3])), 0)
+
+    def test_closing_combinations_with_broken_segment(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX8[1FJC1]", self.stat_source)
+        whole_loop = self.mover._get_elements(self.sm)
+        self.assertGreater(len(self.assert_closing_combinations_complete(whole_loop[2:])), 0)
+
+    def test_switches_to_closing_combinations(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX30[1FJC1]", self.stat_source)
+        whole_loop = self.mover._get_elements(self.sm)
+        broken = whole_loop[-1]
+        self.sm.elem_defs[broken] = self.stat_source.sample_for(self.sm.bg, broken)
+        closure, combinations, loop, whole_loop = self.closure_for(whole_loop[1:3])
+        self.assertIsNotNone(closure._enumeration_size)
+        batch = combinations.draw(closure._enumeration_size)
+        expected = closure.closes(batch)
+        self.assertIsNone(closure._closing)
+        nptest.assert_array_equal(closure.closes(batch), expected)
+        self.assertIsNotNone(closure._closing)
+
+    def test_no_closing_combinations_without_max_energy(self):
+        fbm._perml_energy_to_sm(self.sm, "FJC1", self.stat_source)
+        closure, _, _, _ = self.closure_for(self.mover._get_elements(self.sm))
+        self.assertIsNone(closure._enumeration_size)
+
+    def test_prefilter_only_adds_false_positives(self):
+        fbm._perml_energy_to_sm(self.sm, "MAX30[1FJC1]", self.stat_source)
+        closure, _, _, _ = self.closure_for(self.mover._get_elements(self.sm))
+        # Rounding errors around the cutoff are let through, _check_junction decides.
+        nptest.assert_array_equal(closure._may_close(np.array([29.9, 30.-1e-12, 30., 30.+1e-12, 30.1])),
+                                  [True, True, True, True, False])
+        nptest.assert_array_equal(closure._precheck([np.array([10., 10.]), np.array([40.-1e-12, 40.+1e-12]),
+                                                     np.array([0., 0.])]),
+                                  [True, True])
+        self.assertFalse(closure._precheck([np.array([10.]), np.array([40.1]), np.array([0.])])[0])
+
+    def test_unsupported_energy(self):
+        fbm._perml_energy_to_sm(self.sm, "JDIST", self.stat_source)
+        closure, _, _, _ = self.closure_for(self.mover._get_elements(self.sm))
+        self.assertIsNone(closure)
+
+
+class TestSpatialHash(unittest.TestCase):
+    def test_pairs_same_as_all_distances(self):
+        points1 = np.random.uniform(-20, 20, (300, 3))
+        points2 = np.random.uniform(-10, 30, (200, 3))
+        spatial_hash = _SpatialHash(points2, 4.)
+        i1, i2 = spatial_hash.pairs(points1)
+        distances = np.sqrt(np.sum((points1[:,np.newaxis]-points2[np.newaxis])**2, axis=-1))
+        expected = set(zip(*np.nonzero(distances<4.)))
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(set(zip(i1.tolist(), i2.tolist())), expected)
+        self.assertTrue(np.all(spatial_hash.counts(points1)>=np.sum(distances<4., axis=1)))
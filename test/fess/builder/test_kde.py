@@ -0,0 +1,89 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+import scipy.stats
+
+from fess.builder._kde import BinnedKDE, TabulatedKDE
+
+
+class TestBinnedKDE(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(1)
+        self.values = list(random.normal(30, 5, 500))
+        self.xs = np.linspace(0, 60, 50)
+
+    def test_same_as_gaussian_kde(self):
+        density = BinnedKDE(self.values).density()
+        ref = scipy.stats.gaussian_kde(self.values)
+        nptest.assert_allclose(density(self.xs), ref(self.xs), atol=1e-4)
+        self.assertEqual(density(31.).shape, (1,))
+
+    def test_far_away_values(self):
+        density = BinnedKDE(self.values).density()
+        ref = scipy.stats.gaussian_kde(self.values)
+        nptest.assert_allclose(density([8, 52]), ref([8, 52]), rtol=0.1)
+        self.assertGreater(density(-10)[0], 0)
+        self.assertGreater(density(70)[0], 0)
+
+    def test_add_values_incrementally(self):
+        kde = BinnedKDE(self.values[:300])
+        kde.density() # Sets up the grid
+        for value in self.values[300:]:
+            kde.add(value)
+        kde.add(float("nan"))
+        self.assertEqual(len(kde), len(self.values))
+        nptest.assert_allclose(kde.density()(self.xs),
+                               scipy.stats.gaussian_kde(self.values)(self.xs), atol=1e-4)
+
+    def test_grid_grows(self):
+        kde = BinnedKDE(self.values)
+        kde.density() # Sets up the grid
+        kde.add(200.)
+        values = self.values + [200.]
+        nptest.assert_allclose(kde.density()([30, 200]),
+                               scipy.stats.gaussian_kde(values)([30, 200]), rtol=0.01)
+
+    def test_grid_is_coarsened(self):
+        kde = BinnedKDE(self.values)
+        kde.density() # Sets up the grid
+        kde.MAX_POINTS = 100
+        kde.add(100.)
+        self.assertLessEqual(len(kde._counts), 100)
+        self.assertAlmostEqual(np.sum(kde._counts), len(self.values)+1)
+
+    def test_density_needs_two_different_values(self):
+        self.assertIsNone(BinnedKDE().density())
+        self.assertIsNone(BinnedKDE([1., 1.]).density())
+        self.assertIsNotNone(BinnedKDE([1., 1., 2.]).density())
+
+
+class TestTabulatedKDE(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(1)
+        self.kde = scipy.stats.gaussian_kde(np.concatenate([random.normal(30, 5, 300),
+                                                            random.normal(60, 2, 100)]))
+        self.xs = np.linspace(-20, 110, 1000)
+
+    def test_same_as_gaussian_kde(self):
+        table = TabulatedKDE.tabulate(self.kde, 10**-4)
+        self.assertIsInstance(table, TabulatedKDE)
+        nptest.assert_allclose(table(self.xs), self.kde(self.xs), rtol=10**-4)
+        self.assertEqual(table(31.).shape, (1,))
+
+    def test_scaled(self):
+        table = TabulatedKDE.tabulate(self.kde, 10**-4).scaled(1.5)
+        ref = scipy.stats.gaussian_kde(self.kde.dataset*1.5)
+        nptest.assert_allclose(table(self.xs*1.5), ref(self.xs*1.5), rtol=10**-4)
+        # Outside of the grid
+        nptest.assert_allclose(table([-100, 250]), ref([-100, 250]), rtol=10**-8)
+
+    def test_unreachable_tolerance(self):
+        class CoarseTabulatedKDE(TabulatedKDE):
+            MAX_INTERVALS = 128
+        self.assertIs(CoarseTabulatedKDE.tabulate(self.kde, 10**-10), self.kde)
@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+from fess.builder._measure_storage import MeasureStorage
+
+
+class TestMeasureStorage(unittest.TestCase):
+    def setUp(self):
+        self.values = [1., 1., 1., 2.5, 3., 3., 1., 4., 4., 4., 4., 5.]
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_behaves_like_list(self):
+        storage = MeasureStorage(self.values)
+        self.assertEqual(len(storage), len(self.values))
+        self.assertEqual(list(storage), self.values)
+        for i in range(-len(self.values), len(self.values)):
+            self.assertEqual(storage[i], self.values[i])
+        self.assertEqual(storage[3:8], self.values[3:8])
+        self.assertEqual(storage[-5:], self.values[-5:])
+        self.assertEqual(storage[::3], self.values[::3])
+        self.assertEqual(storage[20:], [])
+        nptest.assert_array_equal(np.array(storage), self.values)
+        with self.assertRaises(IndexError):
+            storage[len(self.values)]
+        self.assertFalse(MeasureStorage())
+
+    def test_repeated_values_are_run_length_encoded(self):
+        storage = MeasureStorage(self.values)
+        self.assertEqual(storage._n_runs, 6)
+        storage.append(storage[-1])
+        self.assertEqual(storage._n_runs, 6)
+
+    def test_arrays(self):
+        values = [np.array([1., 2.]), np.array([1., 2.]), np.array([0., 3.])]
+        storage = MeasureStorage(values)
+        self.assertEqual(storage._n_runs, 2)
+        nptest.assert_array_equal(storage[1], values[1])
+        nptest.assert_array_equal(np.array(storage), values)
+        with self.assertRaises(ValueError):
+            storage.append(np.array([1., 2., 3.]))
+
+    def test_spill_keeps_full_history(self):
+        random = np.random.RandomState(1)
+        values = list(np.repeat(random.normal(size=200), random.randint(1, 4, size=200)))
+        filename = os.path.join(self.tmpdir, "measures.spill")
+        storage = MeasureStorage(values[:50], spill_file=filename, max_runs=20)
+        for value in values[50:]:
+            storage.append(value)
+        self.assertLessEqual(storage._n_runs, 20)
+        self.assertGreater(os.path.getsize(filename), 0)
+        self.assertEqual(len(storage), len(values))
+        self.assertEqual(list(storage), values)
+        self.assertEqual(storage[5], values[5])
+        self.assertEqual(storage[-10:], values[-10:])
+        self.assertEqual(storage[100:300], values[100:300])
+        nptest.assert_array_equal(np.array(storage), values)
@@ -96,6 +96,16 @@ class TestMSTchangingMoverPublicAPI(TestMoverBaseClassPublicAPI):
         self.mover.revert(self.sm)
         self.assertEqual(self.sm.bg.mst, initial_mst)
         self.mover._get_elem = old_get_elem
+    def test_revert_restores_snapshot_without_rebuild(self):
+        """The snapshot is not valid for a changed MST. Revert has to rebuild the structure."""
+        initial_coords = copy.deepcopy(self.sm.bg.coords)
+        self.mover._get_elem = lambda *args:"m1"
+        log.info(self.mover.move(self.sm))
+        with mock.patch.object(self.sm, "new_traverse_and_build",
+                               wraps=self.sm.new_traverse_and_build) as build:
+            self.mover.revert(self.sm)
+        self.assertTrue(build.called)
+        self.assertEqual(self.sm.bg.coords, initial_coords)
 
 
 class TestConnectedElementMoverPublicAPI(TestNMoverPublicAPI):
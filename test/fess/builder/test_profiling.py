@@ -0,0 +1,86 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import argparse
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from fess.builder import config
+import fess.builder.profiling as fbprof
+
+
+class Timed(object):
+    phase_timer = fbprof.NO_TIMER
+
+    def work(self):
+        self.phase_timer.switch("sum")
+        sum(range(1000))
+        self.phase_timer.switch(None)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.old_dir = config.Configuration.sampling_output_dir
+        config.Configuration.sampling_output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(config.Configuration.sampling_output_dir)
+        config.Configuration.sampling_output_dir = self.old_dir
+
+    def profiler(self, *args):
+        parser = argparse.ArgumentParser()
+        fbprof.update_parser(parser)
+        return fbprof.from_args(parser.parse_args(list(args)), "test")
+
+    def test_no_profile(self):
+        obj = Timed()
+        with self.profiler().profile(obj):
+            obj.work()
+        self.assertEqual(os.listdir(config.Configuration.sampling_output_dir), [])
+
+    def test_phase_timer(self):
+        timer = fbprof.PhaseTimer()
+        timer.switch("a")
+        timer.switch("b")
+        timer.switch("a")
+        timer.switch(None)
+        self.assertEqual(dict(timer.counts), {"a":2, "b":1})
+        self.assertGreaterEqual(timer.totals["a"], 0)
+
+    def test_timer(self):
+        obj = Timed()
+        profiler = self.profiler("--profile", "timer")
+        with profiler.profile(obj):
+            self.assertIs(obj.phase_timer, profiler.timer)
+            for i in range(3):
+                obj.work()
+        self.assertIs(obj.phase_timer, fbprof.NO_TIMER)
+        with open(profiler.filename) as f:
+            lines = [ line.split("\t") for line in f ]
+        self.assertEqual(lines[0][0], "Phase")
+        self.assertEqual(lines[1][:2], ["sum", "3"])
+        self.assertEqual(lines[-1][0], "total")
+
+    def test_cprofile(self):
+        profiler = self.profiler("--profile", "cprofile")
+        with profiler.profile():
+            Timed().work()
+        self.assertTrue(profiler.filename.endswith("profile_test.prof"))
+        stats = pstats.Stats(profiler.filename)
+        self.assertTrue(any(func[2] == "work" for func in stats.stats))
+
+    def test_sampling(self):
+        profiler = self.profiler("--profile", "sampling", "--profile-interval", "0.001")
+        with profiler.profile():
+            sum(i*i for i in range(3000000))
+        with open(profiler.filename) as f:
+            lines = f.readlines()
+        self.assertGreater(len(lines), 0)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertIn("test_sampling", stack)
+        self.assertGreater(int(count), 0)
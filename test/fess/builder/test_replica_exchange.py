@@ -0,0 +1,223 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import multiprocessing
+import os
+import random
+import unittest
+try:
+    from unittest.mock import patch, MagicMock
+except ImportError:
+    from mock import patch, MagicMock  # Python2
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.energy as fbe
+import fess.builder.models as fbm
+import fess.builder.move as fbmov
+import fess.builder.replicaExchange as fbr
+import fess.builder.sampling as fbs
+from fess.builder.stat_container import StatStorage
+
+
+def _replica(ladder, replica, energies, partner_energies, num_rounds, results):
+    """
+    A replica process without structures. In every round, it publishes
+    fixed energies and records, whether it was exchanged.
+    """
+    try:
+        for exchange_round in range(num_rounds):
+            ladder.publish_state(replica, bytes([replica]*3))
+            ladder.energies[replica] = energies[replica]
+            ladder.end_phase(replica)
+            partner = ladder.partner(replica, exchange_round, ladder.num_replicas)
+            if partner is not None:
+                assert ladder.read_state(partner) == bytes([partner]*3)
+                ladder.partner_energies[replica] = partner_energies[replica]
+            ladder.end_phase(replica)
+            results.put((replica, exchange_round, partner, bool(ladder.accepted[replica])))
+    except fbr.ConnectedPipeError:
+        results.put((replica, "aborted"))
+
+def _temperature_replica(ladder, replica, num_rounds, results):
+    """
+    A replica process, which always accepts to swap its temperature.
+    """
+    for exchange_round in range(num_rounds):
+        ladder.publish_parameters(replica, [(replica, 0., float("inf"))])
+        ladder.energies[replica] = 0.
+        ladder.end_phase(replica)
+        temperature = ladder.temperatures[replica]
+        partner = ladder.partner(temperature, exchange_round, ladder.num_replicas)
+        if partner is not None:
+            assert ladder.read_parameters(ladder.replica_at(partner))[0][0] == ladder.replica_at(partner)
+            ladder.partner_energies[replica] = 0.
+        ladder.end_phase(replica)
+    results.put(replica)
+
+def _failing_replica(ladder, replica, results):
+    ladder.abort()
+
+def _dying_replica(ladder, replica, results):
+    """
+    A replica process, which exits without aborting the ladder (like a killed process).
+    """
+    os._exit(1)
+
+
+class TestSharedReplicaLadder(unittest.TestCase):
+    def test_partner_alternates(self):
+        self.assertEqual([fbr.SharedReplicaLadder.partner(i, 0, 5) for i in range(5)],
+                         [1, 0, 3, 2, None])
+        self.assertEqual([fbr.SharedReplicaLadder.partner(i, 1, 5) for i in range(5)],
+                         [None, 2, 1, 4, 3])
+
+    def test_publish_and_read_state(self):
+        ladder = fbr.SharedReplicaLadder(3, 5)
+        ladder.publish_state(1, b"abc")
+        ladder.publish_state(2, b"defgh")
+        ladder.publish_state(1, b"ij")
+        self.assertEqual(ladder.read_state(1), b"ij")
+        self.assertEqual(ladder.read_state(2), b"defgh")
+        self.assertEqual(list(ladder.versions), [0, 2, 1])
+        with self.assertRaises(ValueError):
+            ladder.publish_state(0, b"too long")
+
+    def test_publish_and_read_parameters(self):
+        ladder = fbr.SharedReplicaLadder(2, 0, 6, swap_temperatures=True)
+        ladder.publish_parameters(1, [(0.5, 0., float("inf")), (2., 0.1, 10.)])
+        self.assertEqual(ladder.read_parameters(1), [(0.5, 0., float("inf")), (2., 0.1, 10.)])
+
+    def start(self, targets):
+        results = multiprocessing.Queue()
+        processes = [ multiprocessing.Process(target=target, args=args+(results,))
+                      for target, args in targets ]
+        for p in processes:
+            p.start()
+        return processes, results
+
+    def test_coordinate(self):
+        ladder = fbr.SharedReplicaLadder(4, 3)
+        # Exchanges between 0 and 1 lower the energy,
+        # exchanges involving replica 2 are never accepted.
+        energies = [1., 1., 1., 1.]
+        partner_energies = [0., 0., 1000., 0.]
+        targets = [ (_replica, (ladder, i, energies, partner_energies, 4)) for i in range(4) ]
+        processes, queue = self.start(targets)
+        self.assertTrue(ladder.coordinate(processes, 4))
+        results = [ queue.get(timeout=10) for i in range(16) ]
+        for p in processes:
+            p.join()
+        for replica, exchange_round, partner, accepted in results:
+            if exchange_round%2==0:
+                self.assertEqual(partner, replica^1)
+                self.assertEqual(accepted, replica<2)
+            elif replica in [1, 2]:
+                self.assertEqual(partner, 3-replica)
+                self.assertFalse(accepted)
+            else:
+                self.assertIsNone(partner)
+
+    def test_abort(self):
+        ladder = fbr.SharedReplicaLadder(3, 3)
+        targets = [ (_replica, (ladder, 0, [0.]*3, [0.]*3, 5)),
+                    (_failing_replica, (ladder, 1)),
+                    (_replica, (ladder, 2, [0.]*3, [0.]*3, 5)) ]
+        processes, results = self.start(targets)
+        self.assertFalse(ladder.coordinate(processes, 5))
+        self.assertEqual(sorted(results.get(timeout=10) for i in range(2)),
+                         [(0, "aborted"), (2, "aborted")])
+        for p in processes:
+            p.join()
+        self.assertTrue(ladder.aborted.value)
+
+    def test_dead_replica(self):
+        ladder = fbr.SharedReplicaLadder(2, 3)
+        targets = [ (_replica, (ladder, 0, [0.]*2, [0.]*2, 5)),
+                    (_dying_replica, (ladder, 1)) ]
+        processes, results = self.start(targets)
+        self.assertFalse(ladder.coordinate(processes, 5))
+        self.assertEqual(results.get(timeout=10), (0, "aborted"))
+        for p in processes:
+            p.join()
+        self.assertTrue(ladder.aborted.value)
+
+    def test_coordinate_swaps_temperatures(self):
+        ladder = fbr.SharedReplicaLadder(4, 0, 3, swap_temperatures=True)
+        rounds = []
+        processes, results = self.start([ (_temperature_replica, (ladder, i, 3)) for i in range(4) ])
+        self.assertTrue(ladder.coordinate(processes, 3, lambda r: rounds.append(list(ladder.temperatures))))
+        self.assertEqual(sorted(results.get(timeout=10) for i in range(4)), [0, 1, 2, 3])
+        for p in processes:
+            p.join()
+        # Even rounds swap the temperatures 0-1 and 2-3, odd rounds 1-2.
+        self.assertEqual(rounds, [[1, 0, 3, 2], [2, 0, 3, 1], [3, 1, 2, 0]])
+
+
+class TestReplicaExchange(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = StatStorage("test/fess/data/real.stats")
+
+    def sampler(self, seed, prefactor):
+        random.seed(seed)
+        sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg"))
+        sm.sample_stats(self.stat_source)
+        sm.new_traverse_and_build()
+        energy = fbe.CombinedEnergy([fbe.RadiusOfGyrationEnergy(sm.bg.seq_length, prefactor=prefactor)])
+        return fbs.MCMCSampler(sm, energy, fbmov.Mover(self.stat_source), MagicMock())
+
+    def test_rejected_exchange_keeps_accepted_move(self):
+        sampler1 = self.sampler(1, 1.)
+        sampler2 = self.sampler(2, 0.5)
+        accepted = []
+        for sampler in [sampler1, sampler2]:
+            sampler.mover.move(sampler.sm)
+            sampler.accept(sampler.energy_function.eval_energy(sampler.sm.bg,
+                                                               sampled_stats=sampler.sm.elem_defs))
+            accepted.append((sampler.sm, dict(sampler.sm.elem_defs)))
+        with patch("random.random", return_value=float("inf")):
+            self.assertFalse(fbr.try_replica_exchange(sampler1, sampler2))
+        for sampler, (sm, elem_defs) in zip([sampler1, sampler2], accepted):
+            self.assertIs(sampler.sm, sm)
+            self.assertEqual(sampler.sm.elem_defs, elem_defs)
+            self.assertAlmostEqual(sampler.prev_energy, sampler.energy_function.eval_energy(
+                                        sampler.sm.bg, sampled_stats=sampler.sm.elem_defs))
+
+
+class TestTemperatureSwap(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = StatStorage("test/fess/data/real.stats")
+
+    def sampler(self, seed, prefactor):
+        random.seed(seed)
+        sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg"))
+        sm.sample_stats(self.stat_source)
+        sm.new_traverse_and_build()
+        energy = fbe.CombinedEnergy([fbe.RadiusOfGyrationEnergy(sm.bg.seq_length, prefactor=prefactor)])
+        return fbs.MCMCSampler(sm, energy, None, None)
+
+    def test_swap_accepted(self):
+        sampler1 = self.sampler(1, 1.)
+        sampler2 = self.sampler(2, 0.5)
+        sm1 = sampler1.sm
+        with patch("random.random", return_value=0.):
+            self.assertTrue(fbr.try_temperature_swap(sampler1, sampler2))
+        self.assertIs(sampler1.sm, sm1)
+        self.assertEqual(sampler1.energy_function.energies[0].prefactor, 0.5)
+        self.assertEqual(sampler2.energy_function.energies[0].prefactor, 1.)
+        for sampler in [sampler1, sampler2]:
+            self.assertAlmostEqual(sampler.prev_energy, sampler.energy_function.eval_energy(
+                                        sampler.sm.bg, sampled_stats=sampler.sm.elem_defs))
+
+    def test_swap_rejected(self):
+        sampler1 = self.sampler(1, 1.)
+        sampler2 = self.sampler(2, 0.5)
+        energies = [sampler1.prev_energy, sampler2.prev_energy]
+        with patch("random.random", return_value=float("inf")):
+            self.assertFalse(fbr.try_temperature_swap(sampler1, sampler2))
+        self.assertEqual(sampler1.energy_function.energies[0].prefactor, 1.)
+        self.assertEqual(sampler2.energy_function.energies[0].prefactor, 0.5)
+        self.assertAlmostEqual(sampler1.prev_energy, energies[0])
+        self.assertAlmostEqual(sampler2.prev_energy, energies[1])
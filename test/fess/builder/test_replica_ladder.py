@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+from fess.builder._replica_ladder import (AdaptiveLadder, LadderStatistics,
+                                          ADAPTATION_INTERVAL)
+
+
+def ladder_parameters(prefactors):
+    return [ [(pf, 0., float("inf")), (2*pf, 0., float("inf"))] for pf in prefactors ]
+
+
+class TestLadderStatistics(unittest.TestCase):
+    def test_record(self):
+        stats = LadderStatistics(3)
+        stats.record(0, True)
+        stats.record(1, False)
+        self.assertEqual(stats.walker_at, [1, 0, 2])
+        nptest.assert_array_equal(stats.attempts, [1, 1])
+        nptest.assert_array_equal(stats.accepted, [1, 0])
+
+    def test_round_trip(self):
+        stats = LadderStatistics(2)
+        stats.end_round()
+        # Walker 1 arrives at the bottom, then walker 0 comes back.
+        stats.record(0, True)
+        stats.end_round()
+        self.assertEqual(stats.round_trips, 1)
+        stats.record(0, True)
+        stats.end_round()
+        self.assertEqual(stats.round_trips, 2)
+        self.assertEqual(stats.walker_at, [0, 1])
+
+    def test_fraction_up(self):
+        stats = LadderStatistics(3)
+        stats.end_round()
+        stats.record(0, True)
+        stats.end_round()
+        # Round 1: walker 0 (up) at 0, walker 2 (down) at 2.
+        # Round 2: walker 1 (unlabeled) at 0 becomes up, walker 0 (up) at 1.
+        nptest.assert_array_equal(stats.fraction_up()[[0, 2]], [1., 0.])
+        self.assertEqual(stats.fraction_up()[1], 1.)
+
+    def test_reset_keeps_walkers(self):
+        stats = LadderStatistics(3)
+        stats.record(1, True)
+        stats.end_round()
+        stats.reset()
+        self.assertEqual(stats.walker_at, [0, 2, 1])
+        nptest.assert_array_equal(stats.attempts, [0, 0])
+        nptest.assert_array_equal(stats.up_counts, [0, 0, 0])
+
+
+class TestAdaptiveLadder(unittest.TestCase):
+    def test_fixed_ladder(self):
+        parameters = ladder_parameters([1., 0.5, 0.25])
+        ladder = AdaptiveLadder(parameters, 0)
+        nptest.assert_allclose(ladder.scales, [1., 0.5, 0.25])
+        self.assertFalse(ladder.update(LadderStatistics(3), ADAPTATION_INTERVAL-1))
+        self.assertEqual(ladder.parameters(1), parameters[1])
+
+    def test_update_equalizes_acceptance(self):
+        ladder = AdaptiveLadder(ladder_parameters([1., 0.5, 0.25]), 1000)
+        stats = LadderStatistics(3)
+        for i in range(ADAPTATION_INTERVAL):
+            stats.record(0, True)
+            stats.record(1, False)
+            stats.end_round()
+            self.assertEqual(ladder.update(stats, i), i==ADAPTATION_INTERVAL-1)
+        scales = ladder.scales
+        # The endpoints are fixed
+        self.assertAlmostEqual(scales[0], 1.)
+        self.assertAlmostEqual(scales[-1], 0.25)
+        # The pair with the higher acceptance rate gets further apart
+        self.assertLess(scales[1], 0.5)
+        self.assertGreater(scales[1], 0.25)
+        pf = ladder.parameters(1)
+        self.assertAlmostEqual(pf[0][0], scales[1])
+        self.assertAlmostEqual(pf[1][0], 2*scales[1])
+        self.assertEqual(pf[0][1:], (0., float("inf")))
+
+    def test_burn_in_end_resets_statistics(self):
+        ladder = AdaptiveLadder(ladder_parameters([1., 0.5, 0.25]), 5)
+        stats = LadderStatistics(3)
+        stats.record(0, True)
+        self.assertFalse(ladder.update(stats, 4))
+        nptest.assert_array_equal(stats.attempts, [0, 0])
+        self.assertFalse(ladder.update(stats, ADAPTATION_INTERVAL-1))
+
+    def test_invalid_ladders(self):
+        with self.assertRaises(ValueError):
+            AdaptiveLadder(ladder_parameters([1., 2., 0.5]), 10)
+        with self.assertRaises(ValueError):
+            AdaptiveLadder([[(1., 0., np.inf), (1., 0., np.inf)],
+                            [(0.5, 0., np.inf), (1., 0., np.inf)]], 10)
+        with self.assertRaises(ValueError):
+            AdaptiveLadder([[(1., 0.1, 10.)], [(0.5, 0.1, 10.)]], 10)
+        # Without adaptation, any ladder is allowed.
+        AdaptiveLadder(ladder_parameters([1., 2., 0.5]), 0)
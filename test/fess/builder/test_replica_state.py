@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import random
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.models as fbm
+from fess.builder.stat_container import StatStorage
+from fess.builder._replica_state import ReplicaStateCodec
+
+
+class TestReplicaStateCodec(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = StatStorage("test/fess/data/real.stats")
+
+    def sm_for(self, filename, seed):
+        random.seed(seed)
+        sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file(filename))
+        sm.sample_stats(self.stat_source)
+        sm.new_traverse_and_build()
+        return sm
+
+    def assert_same_structure(self, sm1, sm2):
+        nptest.assert_array_equal(sm1.bg.coords.get_array(), sm2.bg.coords.get_array())
+        nptest.assert_array_equal(sm1.bg.twists.get_array(), sm2.bg.twists.get_array())
+        self.assertEqual(sm1.bg.mst, sm2.bg.mst)
+        self.assertEqual(sorted(sm1.elem_defs), sorted(sm2.elem_defs))
+        for stem in sm1.bg.stem_iterator():
+            for i in range(sm1.bg.stem_length(stem)):
+                nptest.assert_allclose(sm1.bg.v3dposs[stem][i][0], sm2.bg.v3dposs[stem][i][0])
+
+    def test_decode_into_other_structure(self):
+        sm1 = self.sm_for("test/fess/data/1GID_A.cg", 1)
+        sm2 = self.sm_for("test/fess/data/1GID_A.cg", 2)
+        codec = ReplicaStateCodec(sm1.bg, self.stat_source)
+        codec.decode(codec.encode(sm1), sm2)
+        self.assert_same_structure(sm1, sm2)
+        # The stats are taken from the stat_source, not copied.
+        for elem, stat in sm1.elem_defs.items():
+            self.assertIs(sm2.elem_defs[elem], stat)
+        # sm2 is a valid SpatialModel for these stats
+        sm2.new_traverse_and_build()
+        self.assertEqual(sm2.moved_elements, set())
+        self.assert_same_structure(sm1, sm2)
+
+    def test_only_moved_stems_change(self):
+        sm1 = self.sm_for("test/fess/data/1GID_A.cg", 1)
+        sm2 = self.sm_for("test/fess/data/1GID_A.cg", 1)
+        codec = ReplicaStateCodec(sm1.bg, self.stat_source)
+        sm1.elem_defs["s0"] = self.stat_source.sample_for(sm1.bg, "s0")
+        sm1.new_traverse_and_build(start="s0", include_start=True)
+        codec.decode(codec.encode(sm1), sm2)
+        self.assert_same_structure(sm1, sm2)
+        self.assertGreater(len(sm2.moved_elements), 0)
+        self.assertLess(len(sm2.moved_elements), len(sm2.bg.defines))
+        self.assertLessEqual(sm2.moved_elements, sm1.moved_elements)
+
+    def test_different_mst(self):
+        sm1 = self.sm_for("test/fess/data/4way.cg", 1)
+        sm2 = self.sm_for("test/fess/data/4way.cg", 2)
+        sm1.set_multiloop_break_segment("m1")
+        sm1.new_traverse_and_build()
+        self.assertNotEqual(sm1.bg.mst, sm2.bg.mst)
+        codec = ReplicaStateCodec(sm1.bg, self.stat_source)
+        message = codec.encode(sm1)
+        codec.decode(message, sm2)
+        self.assert_same_structure(sm1, sm2)
+        sm2.new_traverse_and_build()
+        self.assertEqual(sm2.moved_elements, set())
+
+    def test_stats_not_in_stat_source(self):
+        sm1 = self.sm_for("test/fess/data/1GID_A.cg", 1)
+        sm2 = self.sm_for("test/fess/data/1GID_A.cg", 2)
+        codec = ReplicaStateCodec(sm1.bg, self.stat_source)
+        size = len(codec.encode(sm1))
+        # A stat calculated from the coordinates
+        stat, = [ s for s in sm1.bg.get_bulge_angle_stats("i0")
+                  if s.ang_type == sm1.bg.get_angle_type("i0") ]
+        sm1.elem_defs["i0"] = stat
+        sm1.new_traverse_and_build(start="i0")
+        message = codec.encode(sm1)
+        self.assertGreater(len(message), size)
+        codec.decode(message, sm2)
+        self.assert_same_structure(sm1, sm2)
+        self.assertAlmostEqual(sm2.elem_defs["i0"].u, stat.u)
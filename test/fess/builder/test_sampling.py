@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import random
+import unittest
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock  # Python2
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.energy as fbe
+import fess.builder.models as fbm
+import fess.builder.move as fbmov
+import fess.builder.sampling as fbs
+from fess.builder.stat_container import StatStorage
+
+
+class TestConstraintEnergySteps(unittest.TestCase):
+    def setUp(self):
+        self.stat_source = StatStorage("test/fess/data/real.stats")
+        random.seed(1)
+        sm = fbm.SpatialModel(ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg"))
+        sm.sample_stats(self.stat_source)
+        sm.new_traverse_and_build()
+        energy = fbe.CombinedEnergy([fbe.RadiusOfGyrationEnergy(sm.bg.seq_length)])
+        self.sampler = fbs.MCMCSampler(sm, energy, fbmov.Mover(self.stat_source), MagicMock())
+
+    def step(self, accept):
+        sm = self.sampler.sm
+        self.sampler.mover.move(sm)
+        sm.constraint_energy.eval_energy(sm.bg)
+        if accept:
+            self.sampler.accept(self.sampler.energy_function.eval_energy(sm.bg, sampled_stats=sm.elem_defs))
+        else:
+            self.sampler.reject()
+
+    def test_clash_schedule_not_advanced(self):
+        clash = fbe.StemVirtualResClashEnergy()
+        self.sampler.sm.constraint_energy = fbe.CombinedEnergy([clash])
+        self.step(True)
+        self.step(False)
+        self.assertEqual(clash.step, 0)
+        self.assertEqual(len(clash.accepted_measures), 0)
+
+    def test_incremental_clash_rolled_back(self):
+        clash = fbe.IncrementalStemVirtualResClashEnergy()
+        sm = self.sampler.sm
+        sm.constraint_energy = fbe.CombinedEnergy([clash])
+        self.step(True)
+        stems = dict(clash._stem_cache)
+        self.step(False)
+        self.assertEqual(clash._stem_cache, stems)
+        self.assertEqual(clash.step, 0)
+        self.assertEqual(clash.eval_energy(sm.bg), fbe.StemVirtualResClashEnergy().eval_energy(sm.bg))
@@ -5,15 +5,22 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 from future.utils import viewkeys
 import unittest
 import sys
+import random
+import os
+import pickle
+import shutil
+import tempfile
 from six.moves import range
 try: #py 3K
     from io import StringIO
 except ImportError:
     from StringIO import StringIO
 import fess.builder.stat_container as fbstat
+from fess.builder import config
 import forgi.threedee.model.stats as ftmstats
 import forgi.threedee.model.coarse_grain as ftmc
 from collections import Counter
+import numpy as np
 try:
     from unittest.mock import mock_open, patch
 except ImportError:
@@ -71,6 +78,78 @@ class ReadFileTests(unittest.TestCase):
         self.assertEqual(stats["5prime"][4],
                          [ftmstats.LoopStat("5prime test:f_0 4 20.4034805163 1.47912394946 -0.0715301558972")])
 
+class StatsCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assert_same_stats(self, stats, ref):
+        self.assertEqual(set(stats), set(ref))
+        for stat_type in ref:
+            self.assertEqual(list(stats[stat_type].keys()), list(ref[stat_type].keys()))
+            for key in ref[stat_type]:
+                for stat, ref_stat in zip(stats[stat_type][key], ref[stat_type][key]):
+                    self.assertEqual(type(stat), type(ref_stat))
+                    self.assertEqual(str(stat), str(ref_stat))
+                    self.assertEqual(stat.define, ref_stat.define)
+
+    def test_cached_stats_equal_parsed_stats(self):
+        ref = fbstat.read_stats_file("test/fess/data/test1.stats")
+        fbstat.read_stats_file("test/fess/data/test1.stats", self.tmpdir)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        with patch("fess.builder.stat_container.parse_stats_file") as parse:
+            stats = fbstat.read_stats_file("test/fess/data/test1.stats", self.tmpdir)
+        self.assertEqual(parse.call_count, 0)
+        self.assert_same_stats(stats, ref)
+        self.assertEqual(stats["angle"][(1, 1000, 6)][0].vbase[0][2], -2.2471)
+        self.assertNotIn((4, 5, 1), stats["angle"])
+
+    def test_cached_stats_are_memory_mapped(self):
+        stats = fbstat.read_stats_file("test/fess/data/test1.stats", self.tmpdir)
+        self.assertIsInstance(stats["stem"]._pools._float_array, np.memmap)
+        first = stats["stem"][5][0]
+        self.assertIs(stats["stem"][5][0], first)
+        unpickled = pickle.loads(pickle.dumps(stats))
+        self.assertIsInstance(unpickled["stem"]._pools._float_array, np.memmap)
+        self.assertEqual(str(unpickled["stem"][5][0]), str(first))
+
+    def test_changed_file_invalidates_cache(self):
+        filename = os.path.join(self.tmpdir, "a.stats")
+        shutil.copy("test/fess/data/test1.stats", filename)
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        fbstat.read_stats_file(filename, cache_dir)
+        with open(filename, "a") as f:
+            f.write("stem test:s_1 7 10.208 2.44697849523 47 53 59 65 UCCGGAA UUCCGG\n")
+        stats = fbstat.read_stats_file(filename, cache_dir)
+        self.assertEqual(len(stats["stem"][7]), 1)
+        # The cache of the old file was replaced.
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_cache_of_other_file_with_same_name_is_kept(self):
+        os.mkdir(os.path.join(self.tmpdir, "other"))
+        filenames = [ os.path.join(self.tmpdir, "a.stats"), os.path.join(self.tmpdir, "other", "a.stats") ]
+        for filename in filenames:
+            shutil.copy("test/fess/data/test1.stats", filename)
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        for filename in filenames:
+            fbstat.read_stats_file(filename, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_stat_storage_reads_configured_cache_dir(self):
+        with patch.object(config.Configuration, "stats_cache_dir", self.tmpdir):
+            self.assertEqual(fbstat.StatStorage("test/fess/data/test1.stats").cache_dir, self.tmpdir)
+            self.assertIsNone(fbstat.StatStorage("test/fess/data/test1.stats", cache_dir=False).cache_dir)
+        with patch.object(config.Configuration, "stats_cache_dir", None):
+            self.assertIsNone(fbstat.StatStorage("test/fess/data/test1.stats").cache_dir)
+
+    def test_stat_storage_with_cache(self):
+        st = fbstat.StatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats"],
+                                cache_dir=self.tmpdir)
+        self.assertEqual(st._possible_stats("stem", 6, 2)[1][0].pdb_name, "fallback1:s_0")
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
 class StatStorageTest(unittest.TestCase):
     def test_stat_files_are_loaded_lazily(self):
         stats_open = mock_open()
@@ -136,6 +215,69 @@ class StatStorageTest(unittest.TestCase):
         _, poss_stats = st._possible_stats("stem",5, 2)
         self.assertEqual(len(poss_stats), 3) #Even if we requested a minimum of 2 stats, we end up with 3.
 
+class WeightedStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.weights = [1, 0.5, 0.25, 2., 0.25]
+        self.stats = ["a", "b", "c", "d", "e"]
+
+    def test_sample_same_as_linear_scan(self):
+        ws = fbstat.WeightedStats(self.weights, self.stats)
+        random.seed(1)
+        sampled = [ws.sample() for _ in range(200)]
+        random.seed(1)
+        for stat in sampled:
+            r = random.uniform(0, sum(self.weights))
+            for i, w in enumerate(self.weights):
+                if r <= w:
+                    self.assertEqual(stat, self.stats[i])
+                    break
+                r -= w
+
+    def test_sample_many(self):
+        ws = fbstat.WeightedStats(self.weights, self.stats)
+        np.random.seed(1)
+        c = Counter(ws.sample_many(4000))
+        self.assertEqual(sum(c.values()), 4000)
+        for stat, weight in zip(self.stats, self.weights):
+            self.assertAlmostEqual(c[stat]/4000, weight/4., delta=0.03)
+
+    def test_zero_weights_are_never_sampled(self):
+        ws = fbstat.WeightedStats([0, 1, 0], ["a", "b", "c"])
+        self.assertEqual(set(ws.sample_many(100)), {"b"})
+        with self.assertRaises(ValueError):
+            fbstat.WeightedStats([], [])
+
+class ContinuouseStatSamplerTests(unittest.TestCase):
+    def setUp(self):
+        self.st = fbstat.StatStorage("test/fess/data/real.stats", continuouse=["m0"])
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/4way.cg")
+        self.key = self.st.key_from_bg_and_elem(self.cg, "m0")
+
+    def test_sampler_is_cached(self):
+        self.assertIs(self.st._get_statsampler("angle", self.key, 100),
+                      self.st._get_statsampler("angle", self.key, 100))
+
+    def test_sample_many(self):
+        sampler = self.st._get_statsampler("angle", self.key, 100)
+        np.random.seed(1)
+        single = [ sampler.sample() for _ in range(3) ]
+        stats = sampler.sample_many(500)
+        self.assertEqual(len(stats), 500)
+        for stat in single + stats:
+            self.assertEqual((stat.dim1, stat.dim2, stat.ang_type), self.key)
+            self.assertTrue(0 <= stat.u <= np.pi)
+            self.assertTrue(-np.pi <= stat.v1 <= np.pi)
+        self.assertAlmostEqual(np.mean([stat.r1 for stat in stats]),
+                               np.mean(sampler.data[:, 3]), delta=np.std(sampler.data[:, 3])/2)
+
+    def test_pdb_name_is_formatted_lazily(self):
+        stat = self.st.sample_for(self.cg, "m0")
+        self.assertIsNone(stat._pdb_name)
+        self.assertTrue(stat.pdb_name.startswith("cont-{:.1f}_".format(stat.u)))
+        self.assertIn(stat.pdb_name, str(stat))
+        stat.pdb_name = "renamed"
+        self.assertEqual(stat.pdb_name, "renamed")
+
 class StatStoragePublicAPITests(unittest.TestCase):
     def setUp(self):
         self.st = fbstat.StatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"])
@@ -158,6 +300,13 @@ class StatStoragePublicAPITests(unittest.TestCase):
         self.assertGreater(mc[2][1], 25) #Expectation value 50
         self.assertLess(mc[2][1], 75)
 
+    def test_sample_many(self):
+        stats = self.st.sample_many(self.cg, "s0", 300, 2)
+        self.assertEqual(len(stats), 300)
+        c = Counter(stat.pdb_name for stat in stats)
+        self.assertEqual(c.most_common(1)[0][0], "test:s_0")
+        self.assertEqual(len(c), 3)
+
     def test_iterate_stats(self):
         #With minimal 10 stats, the 3 stats found in the 3 files are used.
         if True: #with self.assertWarnsRegex(UserWarning, "Only .* stats found for .* with key .*"): #Only python 3.3+